@@ -4,8 +4,10 @@ import os.path
 
 from e3.fs import mkdir
 
+from SUITE import buildcache
 from SUITE.context import thistest
-from SUITE.tutils import RUNTIME_INFO, xcov
+from SUITE.tutils import (BUILD_CACHE, RUNTIME_INFO, XCOV, build_cache_tools,
+                          xcov, xcov_suite_args)
 
 
 def default_dump_trigger():
@@ -47,6 +49,9 @@ def xcov_instrument(gprsw, covlevel, extra_args=[], dump_trigger=None,
         in the current directory.
 
     See SUITE.tutils.xcov for the other supported options.
+
+    If a build cache is in use and the root project was generated by gprfor,
+    reuse the artifacts of an identical instrumentation if there is one.
     """
     # Create the object directory so that gnatcov does not warn that it
     # does not exist. This is specific to the source trace mode because
@@ -64,7 +69,24 @@ def xcov_instrument(gprsw, covlevel, extra_args=[], dump_trigger=None,
     if thistest.options.pretty_print:
         args.append('--pretty-print')
 
-    xcov(args, out=out, err=err, register_failure=register_failure)
+    def instrument():
+        p = xcov(args, out=out, err=err, register_failure=register_failure)
+        return p.status == 0
+
+    # Only plain "gnatcov instrument" runs with a single output file are
+    # cacheable: valgrind checks and alternate programs need actual runs.
+    projects = (
+        BUILD_CACHE and out and not err
+        and not thistest.options.enable_valgrind
+        and thistest.suite_covpgm_for('instrument') is None
+        and buildcache.project_closure(gprsw.root_project))
+    if projects:
+        BUILD_CACHE.run(
+            'instrument',
+            xcov_suite_args(args[0], args[1:]) + args,
+            projects, build_cache_tools([XCOV]), out, instrument)
+    else:
+        instrument()
 
 
 def xcov_convert_base64(base64_file, output_trace_file, out=None, err=None,
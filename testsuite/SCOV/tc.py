@@ -31,7 +31,7 @@ from SCOV.internals.driver import (SCOV_helper_bin_traces,
                                    SCOV_helper_src_traces)
 from SCOV.internals.driver import WdirControl
 from SCOV.tctl import CAT
-from SUITE.context import TEST_DIR
+from SUITE import context
 from SUITE.context import thistest
 from SUITE.cutils import to_list, contents_of, FatalError
 from SUITE.qdata import Qdata, QDentry
@@ -91,13 +91,13 @@ class TestCase:
     def __category_from_dir(self):
         """Compute test category from directory location."""
         # Canonicalize directory separators to simplify the maching logic
-        test_dir = TEST_DIR.replace('\\', '/')
+        test_dir = context.TEST_DIR.replace('\\', '/')
         for cat in CAT.critcats:
             if re.search(r"/%s" % cat.name, test_dir):
                 return cat
 
         raise FatalError("Unable to infer test category from subdir '%s'"
-                         % TEST_DIR)
+                         % context.TEST_DIR)
 
     def __drivers_from(self, cspec):
         """
@@ -143,6 +143,8 @@ class TestCase:
         if not self.all_cspecs:
             self.__expand_shared_controllers(drivers=False, cspecs=True)
 
+        thistest.use_files(*(self.all_drivers + self.all_cspecs))
+
         # Step 2: Determine a few test parameters common to all drivers
         # -------------------------------------------------------------
 
@@ -162,7 +164,7 @@ class TestCase:
         # Step 3: Setup qualification data for this testcase
         # --------------------------------------------------
 
-        self.qdata = Qdata(tcid=TEST_DIR)
+        self.qdata = Qdata(tcid=context.TEST_DIR)
 
     # Helpers for run
 
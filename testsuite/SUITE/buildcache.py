@@ -0,0 +1,421 @@
+"""
+Build cache shared across testcases.
+
+Many testcases build the very same programs from the very same sources, with
+the very same options, and in source traces mode, instrument the very same
+projects. This module provides a content-addressed cache for the artifacts
+that "gprbuild" and "gnatcov instrument" produce: when an identical build or
+instrumentation already happened (in this run or in a previous one), its
+artifacts are copied into the testcase directories instead of being produced
+again.
+
+The cache key for an operation covers:
+
+* its full command line;
+* the text of the project files involved, as generated by SUITE.tutils.gprfor
+  (only projects generated this way are cacheable, as their source and
+  object directories are known), the absolute name and the contents of all
+  files in their source directories, and the contents of their object
+  directories before the operation (for instance instrumented sources before
+  a build);
+* the same for the projects they extend, which must be either generated by
+  gprfor or registered with register_support_project: in the latter case, the
+  whole directory tree of the project file counts as its sources;
+* the identity (path, size, modification time) of the tools involved and of
+  the testsuite support files, and the environment variables that affect
+  project files lookup.
+
+Artifacts are the files that the operation creates or modifies in object
+directories (recursively) and in executable directories, plus the file that
+holds the operation output. The cache stores private copies of them and
+restores them as copies as well (not as hard links): testcases and uncached
+operations are free to modify restored artifacts, even in place, without
+altering the cache.
+
+The cache does not grow unbounded: `BuildCache.evict`, which the testsuite
+driver calls at the end of each run, removes the least recently used entries
+until the cache fits in a given size.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from e3.os.fs import which
+
+
+class ProjectInfo(object):
+    """Build relevant attributes of a project file generated by gprfor."""
+
+    def __init__(self, filename, text, srcdirs, objdir, exedir, deps,
+                 extends=None):
+        """
+        :param str filename: Absolute name of the project file.
+        :param str text: Contents of the project file.
+        :param list[str] srcdirs: Absolute names of its source directories.
+        :param None|str objdir: Absolute name of its object directory, if
+            operations can write there.
+        :param None|str exedir: Absolute name of its executable directory, if
+            operations can write there.
+        :param list[str] deps: Project files it depends on, as written in
+            "with" clauses.
+        :param None|str extends: Absolute name of the project file it
+            extends, if any.
+        """
+        self.filename = filename
+        self.text = text
+        self.srcdirs = srcdirs
+        self.objdir = objdir
+        self.exedir = exedir
+        self.deps = deps
+        self.extends = extends
+
+
+PROJECTS = {}
+"""
+Project files generated by gprfor, plus support project files. Mapping:
+absolute project file name -> ProjectInfo.
+
+:type: dict[str, ProjectInfo]
+"""
+
+DEFAULT_MAX_SIZE = 4096
+"""Default maximum size of the cache directory, in MiB."""
+
+ENV_VARS = ('GPR_PROJECT_PATH', 'ADA_PROJECT_PATH', 'PATH')
+"""Environment variables that affect the result of builds."""
+
+_tools_identity = {}
+
+
+def _gpr_filename(filename):
+    if not filename.endswith('.gpr'):
+        filename += '.gpr'
+    return os.path.abspath(filename)
+
+
+def register_project(filename, text, srcdirs, objdir, exedir, deps,
+                     extends=None):
+    """
+    Register a project file just generated by gprfor. Relative directory
+    names are interpreted from the current directory, like gprfor does.
+    """
+    filename = os.path.abspath(filename)
+    PROJECTS[filename] = ProjectInfo(
+        filename, text,
+        [os.path.abspath(d) for d in srcdirs],
+        os.path.abspath(objdir),
+        os.path.abspath(exedir),
+        list(deps),
+        _gpr_filename(extends) if extends else None)
+
+
+def register_support_project(filename):
+    """
+    Register a project file that is not generated by gprfor but that
+    generated projects extend, such as the testsuite support base project.
+
+    As what it brings in is not known precisely, the whole directory tree
+    that contains it is considered as its sources. Operations must not
+    write artifacts there.
+    """
+    filename = _gpr_filename(filename)
+    if filename in PROJECTS:
+        return
+    try:
+        with open(filename) as f:
+            text = f.read()
+    except (IOError, OSError):
+        return
+    PROJECTS[filename] = ProjectInfo(
+        filename, text, [os.path.join(os.path.dirname(filename), '**')],
+        None, None, [])
+
+
+def project_closure(project):
+    """
+    Return the list of ProjectInfo for `project` (a project file name) and
+    all the projects it depends on or extends, or None if one of them was not
+    registered or was modified since then.
+    """
+    result = []
+    visited = set()
+
+    def visit(filename):
+        filename = _gpr_filename(filename)
+        if filename in visited:
+            return True
+        visited.add(filename)
+
+        info = PROJECTS.get(filename)
+        if info is None:
+            return False
+        try:
+            with open(filename) as f:
+                if f.read() != info.text:
+                    return False
+        except (IOError, OSError):
+            return False
+
+        result.append(info)
+        gprdir = os.path.dirname(filename)
+        if info.extends and not visit(info.extends):
+            return False
+        return all(visit(os.path.join(gprdir, dep)) for dep in info.deps)
+
+    return result if visit(project) else None
+
+
+def _files_in(dirname, recursive):
+    """
+    Return the sorted list of the names of regular files in `dirname`,
+    including in its subdirectories if `recursive`.
+    """
+    result = []
+    if not os.path.isdir(dirname):
+        return result
+
+    def scan(d):
+        for entry in os.scandir(d):
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    scan(entry.path)
+            elif entry.is_file():
+                result.append(entry.path)
+
+    scan(dirname)
+    return sorted(result)
+
+
+def _hash_file(h, filename, name=None):
+    """
+    Update the `h` hash object with the contents of the `filename` file,
+    designated as `name` (`filename` by default).
+    """
+    h.update((name or filename).encode('utf-8'))
+    h.update(b'\0')
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    h.update(b'\0')
+
+
+def _stat_identity(filename):
+    st = os.stat(filename)
+    return [filename, st.st_size, st.st_mtime_ns]
+
+
+def tools_identity(tools, support_dir):
+    """
+    Return a JSON-able identity for the `tools` programs (looked up in the
+    PATH) and for the files in the `support_dir` directory. Computed once per
+    process.
+    """
+    key = (tuple(tools), support_dir)
+    result = _tools_identity.get(key)
+    if result is None:
+        result = []
+        for tool in tools:
+            path = which(tool)
+            result.append(_stat_identity(path) if path else [tool])
+        result.extend(_stat_identity(f)
+                      for f in _files_in(support_dir, recursive=True))
+        _tools_identity[key] = result
+    return result
+
+
+def compute_key(kind, cmd, projects, tools):
+    """
+    Return the cache key (hexadecimal digest) for an operation.
+
+    :param str kind: Kind of operation ("gprbuild", "instrument", ...).
+    :param list[str] cmd: Operation command line.
+    :param list[ProjectInfo] projects: Projects involved (see
+        project_closure).
+    :param tools: Identity of the tools involved (see tools_identity).
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps({
+        'kind': kind,
+        'cmd': cmd,
+        'cwd_to_projects': [os.path.relpath(p.filename) for p in projects],
+        'tools': tools,
+        'env': {var: os.environ.get(var) for var in ENV_VARS},
+    }, sort_keys=True).encode('utf-8'))
+
+    # Files designated on the command line (configuration project file,
+    # configuration pragmas file, ...) are inputs as well.
+    for arg in cmd:
+        filename = arg.split('=', 1)[-1]
+        if os.path.isfile(filename):
+            _hash_file(h, filename)
+
+    for p in projects:
+        h.update(p.text.encode('utf-8'))
+        for d in p.srcdirs:
+            recursive = d.endswith('**')
+            d = d.rstrip('*')
+            for f in _files_in(d, recursive):
+                _hash_file(h, f)
+        if p.objdir:
+            for f in _files_in(p.objdir, recursive=True):
+                _hash_file(h, f, os.path.relpath(f, p.objdir))
+
+    return h.hexdigest()
+
+
+def _snapshot(files):
+    result = {}
+    for f in files:
+        st = os.stat(f)
+        result[f] = (st.st_ino, st.st_size, st.st_mtime_ns)
+    return result
+
+
+class BuildCache(object):
+    """Cache of artifacts, stored in a directory."""
+
+    def __init__(self, root):
+        """
+        :param str root: Directory for the cache. Created if needed.
+        """
+        self.root = os.path.abspath(root)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _outputs(self, projects):
+        """
+        Return the list of files that may be artifacts for operations on
+        `projects`.
+        """
+        result = set()
+        for p in projects:
+            if p.objdir:
+                result.update(_files_in(p.objdir, recursive=True))
+            if p.exedir:
+                result.update(_files_in(p.exedir, recursive=False))
+        return result
+
+    def _restore(self, entry_dir):
+        """
+        Copy the artifacts stored in `entry_dir` to their location, relative
+        to the current directory. Return whether successful.
+        """
+        try:
+            with open(os.path.join(entry_dir, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+
+        for index, filename in enumerate(manifest):
+            stored = os.path.join(entry_dir, str(index))
+            dirname = os.path.dirname(filename)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            if os.path.lexists(filename):
+                os.remove(filename)
+            try:
+                shutil.copy2(stored, filename)
+            except (IOError, OSError):
+                # The entry may have been evicted meanwhile by another
+                # testsuite run sharing the cache.
+                return False
+
+        # Mark the entry as recently used, for eviction
+        try:
+            os.utime(entry_dir, None)
+        except OSError:
+            pass
+        return True
+
+    def _store(self, key, files):
+        """Store copies of `files` as the artifacts for `key`."""
+        entry_dir = self._entry_dir(key)
+        parent = os.path.dirname(entry_dir)
+        if not os.path.isdir(parent):
+            os.makedirs(parent, exist_ok=True)
+
+        # Fill a temporary directory and then rename it, so that concurrent
+        # testcases never see partial entries.
+        tmp_dir = tempfile.mkdtemp(dir=parent, prefix='tmp-')
+        try:
+            manifest = []
+            for index, filename in enumerate(sorted(files)):
+                shutil.copy2(filename, os.path.join(tmp_dir, str(index)))
+                manifest.append(os.path.relpath(filename))
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmp_dir, entry_dir)
+        except OSError as exc:
+            # Another testcase may have stored the same entry meanwhile
+            if exc.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+    def evict(self, max_size=DEFAULT_MAX_SIZE):
+        """
+        Remove the least recently used entries until the cache holds at most
+        `max_size` MiB, as well as leftovers from interrupted stores. Must not
+        run while testcases use the cache.
+        """
+        entries = []
+        total_size = 0
+        if not os.path.isdir(self.root):
+            return
+
+        for parent in os.scandir(self.root):
+            if not parent.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(parent.path):
+                if entry.name.startswith('tmp-'):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    continue
+                size = sum(os.path.getsize(f)
+                           for f in _files_in(entry.path, recursive=False))
+                entries.append((entry.stat().st_mtime_ns, entry.path, size))
+                total_size += size
+
+        entries.sort()
+        for _, path, size in entries:
+            if total_size <= max_size << 20:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+    def run(self, kind, cmd, projects, tools, out, action):
+        """
+        Run an operation through the cache.
+
+        If artifacts for the operation are available, copy them in place.
+        Otherwise, call `action`, which must return whether the operation
+        succeeded, and then store the artifacts it produced if so.
+
+        :param str kind: See compute_key.
+        :param list[str] cmd: See compute_key.
+        :param list[ProjectInfo] projects: See compute_key.
+        :param tools: See compute_key.
+        :param str out: Name of the file for the operation output.
+        :param () -> bool action: Operation to run on cache miss.
+        :return: Whether the artifacts came from the cache.
+        """
+        key = compute_key(kind, cmd, projects, tools)
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir) and self._restore(entry_dir):
+            return True
+
+        before = _snapshot(self._outputs(projects))
+
+        if action():
+            after = _snapshot(self._outputs(projects))
+            artifacts = [f for f, ident in after.items()
+                         if before.get(f) != ident]
+            if os.path.isfile(out):
+                artifacts.append(os.path.abspath(out))
+            self._store(key, set(artifacts))
+        return False
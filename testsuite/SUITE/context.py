@@ -22,6 +22,7 @@ from SUITE import control
 from SUITE.control import GPRCLEAN, BUILDER, env
 from SUITE.cutils import (exit_if, indent, indent_after_first_line, lines_of,
                           ndirs_in)
+from SUITE.impact import dump_test_impact
 
 
 # This module is loaded as part of a Run operation for a test.py
@@ -195,6 +196,10 @@ class Test (object):
         # number of times it has been used in order to generate multiple logs.
         self.callgrind_count = 0
 
+        # Absolute names of the files and directories this test depends on,
+        # for test-impact selection (see SUITE.impact).
+        self.used_files = set()
+
         # By default, hide the warning that says that non-instrumented native
         # coverage is deprecated, as it would make all tests fail. Testcases
         # that check the presence of this warning can just remove this
@@ -290,6 +295,17 @@ class Test (object):
         self.flush()
         self.report.close()
 
+        if self.options.impact_file:
+            dump_test_impact(self.options.impact_file, self.used_files,
+                             ROOT_DIR)
+
+    def use_files(self, *filenames):
+        """
+        Register that this test depends on FILENAMES (files or directories),
+        for test-impact selection.
+        """
+        self.used_files.update(os.path.abspath(f) for f in filenames)
+
     def create_callgrind_id(self):
         """Return a test-unique ID to identify a callgrind run."""
         self.callgrind_count += 1
@@ -316,6 +332,10 @@ class Test (object):
 
         parser.add_argument('--tags', default="")
 
+        parser.add_argument('--impact-file', metavar='FILE',
+                            help='The filename where to store the list of'
+                                 ' files this test depends on.')
+
         control.add_shared_options_to(parser, toplevel=False)
 
         main.parse_args()
@@ -354,11 +374,29 @@ class Test (object):
         return os.path.join(ROOT_DIR, 'support')
 
 
+def _add_test_support_path():
+    """
+    Allow import of a common "test_support" module from test.py when there is
+    a test_support.py available uptree.
+    """
+    parent_dir = os.path.dirname(os.getcwd())
+    if (os.path.exists(os.path.join(parent_dir, 'test_support.py'))):
+        sys.path.append(parent_dir)
+
+
+def reset_for_test(test_py):
+    """
+    Re-initialize this module for the TEST_PY testcase script, as if it was
+    imported from it. This lets persistent workers (see SUITE.testworker) run
+    several testcases in the same interpreter. The current directory must be
+    the toplevel one, and sys.argv must hold the testcase command line.
+    """
+    global TEST_DIR
+    TEST_DIR = os.path.dirname(test_py)
+    thistest.__init__()
+    _add_test_support_path()
+
+
 # Instantiate a Test object for the individual test module that imports us
 thistest = Test()
-
-# Allow import of a common "test_support" module from test.py when
-# there is a test_support.py available uptree.
-__parent_dir = os.path.dirname(os.getcwd())
-if (os.path.exists(os.path.join(__parent_dir, 'test_support.py'))):
-    sys.path.append(__parent_dir)
+_add_test_support_path()
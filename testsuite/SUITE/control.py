@@ -457,6 +457,12 @@ def add_shared_options_to(parser, toplevel):
         help="Artifacts to be used for consolidation specs.",
         choices=('traces', 'checkpoints'))
 
+    # --build-cache
+    parser.add_argument(
+        '--build-cache', dest='build_cache', metavar='DIR',
+        help='Directory for a cache of build and instrumentation artifacts,'
+             ' shared across testcases. Ignored in qualification mode.')
+
     # --pretty-print
     parser.add_argument(
         '--pretty-print', action='store_true',
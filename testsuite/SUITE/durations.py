@@ -0,0 +1,140 @@
+"""
+Testcase durations database.
+
+This module keeps track of how long each testcase took to run in previous
+testsuite runs, so that the testsuite can start the longest testcases first
+(longest-processing-time-first scheduling) and estimate the time left before
+the end of a run.
+
+Durations are stored in a small JSON file, separately for each set of
+testsuite discriminants, as durations for a given testcase differ a lot
+depending on the target, the runtime, the trace mode, etc.
+"""
+
+import logging
+import os.path
+import threading
+
+from SUITE.dutils import jdump_to, jload_from
+
+
+logger = logging.getLogger('SUITE.durations')
+
+
+class DurationsDB(object):
+    """
+    Durations of testcases in previous runs, for a given set of testsuite
+    discriminants.
+    """
+
+    def __init__(self, filename, discriminants):
+        """
+        :param str filename: Name of the JSON file that holds durations. It
+            does not need to exist.
+        :param list[str] discriminants: Testsuite discriminants for the
+            current run.
+        """
+        self.filename = filename
+        self.key = ' '.join(sorted(discriminants))
+
+        # Mapping: discriminants key -> (mapping: test name -> duration)
+        self.all_durations = {}
+        if os.path.exists(filename):
+            try:
+                self.all_durations = jload_from(filename)
+            except ValueError:
+                logger.warning('Ignoring corrupted durations database: {}'
+                               .format(filename))
+        self.durations = dict(self.all_durations.get(self.key, {}))
+
+        # Durations measured during the current run
+        self.new_durations = {}
+
+        # Estimated durations for the testcases that are still running or
+        # waiting to be run in the current run (see start_run).
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.jobs = 1
+
+    def estimate(self, test_name):
+        """
+        Return the estimated duration (in seconds) for the testcase called
+        TEST_NAME, or None if it was never run.
+
+        Tests that generate testcases (group.py) get the sum of the durations
+        for the testcases they generate.
+        """
+        try:
+            return self.durations[test_name]
+        except KeyError:
+            pass
+        prefix = test_name + '-'
+        generated = [d for name, d in self.durations.items()
+                     if name.startswith(prefix)]
+        return sum(generated) if generated else None
+
+    def schedule(self, parsed_tests):
+        """
+        Return the PARSED_TESTS list (e3 ParsedTest instances) sorted so that
+        the longest testcases come first. Testcases that were never run are
+        considered to take the average duration of known testcases.
+        """
+        estimates = {t.test_name: self.estimate(t.test_name)
+                     for t in parsed_tests}
+        known = [e for e in estimates.values() if e is not None]
+        default = sum(known) / len(known) if known else 0.0
+        for name, estimate in estimates.items():
+            if estimate is None:
+                estimates[name] = default
+
+        # Python's sort is stable, so testcases with the same estimate remain
+        # in discovery order.
+        return sorted(parsed_tests,
+                      key=lambda t: estimates[t.test_name],
+                      reverse=True)
+
+    def start_run(self, parsed_tests, jobs):
+        """
+        Start tracking the time left to run PARSED_TESTS, which run on JOBS
+        parallel jobs.
+        """
+        with self.lock:
+            self.jobs = max(1, jobs)
+            self.pending = {t.test_name: self.estimate(t.test_name) or 0.0
+                            for t in parsed_tests}
+        logger.info('Estimated run time: {}'.format(self._remaining_str()))
+
+    def record(self, test_name, duration):
+        """
+        Record that the testcase called TEST_NAME ran in DURATION seconds, and
+        log an estimate of the remaining time for the current run.
+        """
+        with self.lock:
+            self.new_durations[test_name] = duration
+
+            # Generated testcases are accounted for in their group.py test
+            # estimate: consume it as they complete.
+            if test_name in self.pending:
+                del self.pending[test_name]
+            else:
+                for name in self.pending:
+                    if test_name.startswith(name + '-'):
+                        self.pending[name] = max(
+                            0.0, self.pending[name] - duration)
+                        break
+
+            remaining = self._remaining_str()
+        logger.info('{} done in {:.1f}s, estimated time left: {}'
+                    .format(test_name, duration, remaining))
+
+    def _remaining_str(self):
+        seconds = int(sum(self.pending.values()) / self.jobs)
+        return '{}:{:02}:{:02}'.format(
+            seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+    def save(self):
+        """Write durations (including new ones) to the database file."""
+        durations = dict(self.durations)
+        durations.update(self.new_durations)
+        self.all_durations[self.key] = durations
+        jdump_to(self.filename, self.all_durations)
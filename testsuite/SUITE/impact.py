@@ -0,0 +1,200 @@
+"""
+Test-impact data: which files each testcase depends on.
+
+Testcases record the files they use (sources from gprfor source directories,
+test drivers, ...), see Test.use_files in SUITE.context, and dump them at the
+end of their execution along with the testsuite modules they imported. The
+testsuite driver merges these with the *.opt files that control each
+testcase in a small JSON database (ImpactDB).
+
+Given a set of changed files, the database then tells which testcases may be
+affected by the change, and why, so that the testsuite can run only these.
+This is an over-approximation: testcases without impact data, or for which a
+change may have an effect that cannot be tracked (testsuite driver modules,
+files outside of the testsuite such as gnatcov sources), are always
+selected.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import threading
+
+from SUITE.dutils import jdump_to, jload_from
+
+
+logger = logging.getLogger('SUITE.impact')
+
+
+def _is_under(filename, dirname):
+    return filename.startswith(os.path.join(dirname, ''))
+
+
+def loaded_modules_in(root_dir):
+    """
+    Return the set of absolute names for the Python modules currently loaded
+    from the `root_dir` directory tree.
+    """
+    result = set()
+    for module in list(sys.modules.values()):
+        filename = getattr(module, '__file__', None)
+        if filename:
+            filename = os.path.abspath(filename)
+            if _is_under(filename, root_dir):
+                result.add(filename)
+    return result
+
+
+def dump_test_impact(filename, used_files, root_dir):
+    """
+    Write to `filename` the impact data for the current testcase: the
+    `used_files` set of absolute file/directory names, plus the testsuite
+    modules loaded from `root_dir`.
+    """
+    jdump_to(filename, sorted(set(used_files) | loaded_modules_in(root_dir)))
+
+
+def changed_files_since(ref, root_dir):
+    """
+    Return the list of absolute names for the files that changed in the Git
+    working tree containing `root_dir` since the `ref` commit.
+
+    Untracked files are ignored, as testcases leave a lot of them in the
+    tree: new files must be added to the index to be taken into account.
+    """
+    def git(*args):
+        return subprocess.check_output(
+            ['git'] + list(args), cwd=root_dir, universal_newlines=True
+        ).splitlines()
+
+    top_dir = git('rev-parse', '--show-toplevel')[0]
+    return sorted(set(os.path.abspath(os.path.join(top_dir, n))
+                      for n in git('diff', '--name-only', ref)))
+
+
+class ImpactDB(object):
+    """
+    Impact data for all testcases, stored in a JSON file.
+
+    For each testcase name, the database holds the name of the corresponding
+    ParsedTest (testcases generated by group.py share their group's one) and
+    the list of files and directories it uses. Names are relative to the
+    testsuite root directory.
+    """
+
+    def __init__(self, filename, root_dir):
+        """
+        :param str filename: Name of the JSON file that holds impact data.
+            It does not need to exist.
+        :param str root_dir: Testsuite root directory.
+        """
+        self.filename = filename
+        self.root_dir = os.path.abspath(root_dir)
+        self.lock = threading.Lock()
+
+        self.tests = {}
+        self.driver_files = []
+        if os.path.exists(filename):
+            try:
+                data = jload_from(filename)
+                self.tests = data['tests']
+                self.driver_files = data['driver_files']
+            except (ValueError, KeyError, TypeError):
+                logger.warning('Ignoring corrupted impact database: {}'
+                               .format(filename))
+
+    def _rel(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.root_dir)
+
+    def _abs(self, filename):
+        return os.path.normpath(os.path.join(self.root_dir, filename))
+
+    def record(self, test_name, parsed_test_name, opt_files, impact_file):
+        """
+        Record impact data for the `test_name` testcase, which comes from the
+        `parsed_test_name` test, from its `opt_files` control files and the
+        `impact_file` it dumped (see dump_test_impact). If the testcase did
+        not dump impact data, forget about it, so that it is always selected.
+        """
+        try:
+            used_files = jload_from(impact_file)
+        except (IOError, OSError, ValueError):
+            used_files = None
+
+        with self.lock:
+            if used_files is None:
+                self.tests.pop(test_name, None)
+                return
+            self.tests[test_name] = {
+                'parsed_test': parsed_test_name,
+                'files': sorted(set(self._rel(f)
+                                    for f in list(opt_files) + used_files)),
+            }
+
+    def save(self):
+        """Write the database, including testsuite driver modules."""
+        self.driver_files = sorted(
+            self._rel(f) for f in loaded_modules_in(self.root_dir))
+        jdump_to(self.filename, {'tests': self.tests,
+                                 'driver_files': self.driver_files})
+
+    def select(self, parsed_tests, changed_files):
+        """
+        Select the tests in `parsed_tests` (e3 ParsedTest instances) that may
+        be affected by a change in the `changed_files` list of absolute file
+        names.
+
+        Return the list of selected tests and a mapping: test name -> list of
+        reasons for its selection.
+        """
+        changed_files = [os.path.abspath(f) for f in changed_files]
+        reasons = {}
+
+        def select_all(reason):
+            for t in parsed_tests:
+                reasons.setdefault(t.test_name, []).append(reason)
+
+        # Files used by each ParsedTest (i.e. including generated testcases)
+        used_files = {}
+        for record in self.tests.values():
+            used_files.setdefault(record['parsed_test'], set()).update(
+                self._abs(f) for f in record['files'])
+        driver_files = set(self._abs(f) for f in self.driver_files)
+
+        for t in parsed_tests:
+            if t.test_name not in used_files:
+                reasons[t.test_name] = ['no impact data from previous runs']
+
+        for f in changed_files:
+            rel = self._rel(f)
+            matched = False
+
+            if f in driver_files:
+                select_all('testsuite driver file changed: {}'.format(rel))
+                continue
+
+            for t in parsed_tests:
+                test_dir = os.path.abspath(t.test_dir)
+                if _is_under(f, test_dir):
+                    reason = 'file in testcase directory changed: {}'
+                elif any(f == u or _is_under(f, u)
+                         for u in used_files.get(t.test_name, ())):
+                    reason = 'used file changed: {}'
+                else:
+                    continue
+                reasons.setdefault(t.test_name, []).append(reason.format(rel))
+                matched = True
+
+            if not matched:
+                if _is_under(f, self.root_dir):
+                    logger.info('Changed file used by no testcase: {}'
+                                .format(rel))
+                else:
+                    # Files outside of the testsuite may be gnatcov sources,
+                    # which all testcases depend on.
+                    select_all('file outside of the testsuite changed: {}'
+                               .format(rel))
+
+        selected = [t for t in parsed_tests if t.test_name in reasons]
+        return selected, reasons
@@ -0,0 +1,52 @@
+"""
+Thread pool for filesystem operations, with a bounded queue.
+
+Filesystem operations such as the removal of testcase artifacts spend most of
+their time waiting for I/O: running them on a few threads lets them overlap,
+while the bounded queue makes producers wait when the pool cannot keep up,
+instead of accumulating an unbounded amount of pending work.
+"""
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+IO_POOL_WORKERS = 8
+"""Default number of threads in an IOPool."""
+
+IO_POOL_MAX_PENDING = 256
+"""Default number of operations an IOPool accepts before submitters wait."""
+
+
+class IOPool(object):
+    """Pool of threads to run filesystem operations."""
+
+    def __init__(self, workers=IO_POOL_WORKERS,
+                 max_pending=IO_POOL_MAX_PENDING):
+        """
+        :param int workers: Number of threads in the pool.
+        :param int max_pending: Maximum number of operations that are queued
+            or running at a given time.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule a call to `fn` with `args` and `kwargs` and return the
+        corresponding concurrent.futures.Future. Block while the queue is
+        full.
+        """
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self):
+        """Wait for all pending operations and stop threads."""
+        self.executor.shutdown(wait=True)
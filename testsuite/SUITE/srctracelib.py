@@ -4,14 +4,17 @@
 Decoder for source trace files.
 
 This module can be used as a script to read and decode a source trace file,
-possibly enabling debug output to investigate malformed files.
+possibly enabling debug output to investigate malformed files ("decode"
+command, the default), or to merge source trace files ("merge" command).
 """
 
 from __future__ import absolute_import, division, print_function
 
 import argparse
+import sys
 
-from SUITE.stream_decoder import ByteStreamDecoder, Struct, swap_bytes
+from SUITE.stream_decoder import (BufferDecoder, ByteStreamDecoder, Struct,
+                                  swap_bytes)
 
 
 trace_file_header_struct = Struct(
@@ -86,6 +89,11 @@ def write_aligned(fp, data, alignment):
         fp.write(padding)
 
 
+def format_fingerprint(fingerprint):
+    """Return the hexadecimal representation of a unit `fingerprint`."""
+    return ''.join('{:02x}'.format(b) for b in fingerprint)
+
+
 class SrcTraceFile(object):
     """
     In-memory representation of a source trace file.
@@ -114,6 +122,11 @@ class SrcTraceFile(object):
         """
         Read a trace file from the `fp` file. Return a TraceFile instance.
         """
+        # Unless decoding traces are enabled, load the whole file at once so
+        # that headers are then decoded in place from memory.
+        if not fp.enabled:
+            fp = BufferDecoder(fp.read(-1))
+
         header = trace_file_header_struct.read(fp)
 
         magic = header['magic']
@@ -177,9 +190,9 @@ class SrcTraceFile(object):
 
     def dump(self):
         def format_buffer(b):
-            bounds = ('[{}-{}]'.format(0, len(b.bits) - 1)
-                      if len(b.bits) else '[empty range]')
-            content = (' '.join(str(i) for i, bit in enumerate(b.bits) if bit)
+            bounds = ('[{}-{}]'.format(0, len(b) - 1)
+                      if len(b) else '[empty range]')
+            content = (' '.join(str(i) for i in b.set_indexes())
                        or '<empty>')
             return '{} {}'.format(bounds, content)
 
@@ -189,8 +202,7 @@ class SrcTraceFile(object):
         print('')
         for e in self.entries:
             print('  Unit {} ({}, fingerprint={})'.format(
-                e.unit_name, e.unit_part,
-                ''.join('{:02x}'.format(b) for b in e.fingerprint)))
+                e.unit_name, e.unit_part, format_fingerprint(e.fingerprint)))
             print('  Stmt buffer: {}'.format(format_buffer(e.stmt_buffer)))
             print('  Dc buffer:   {}'.format(format_buffer(e.dc_buffer)))
             print('  MCDC buffer: {}'.format(format_buffer(e.mcdc_buffer)))
@@ -315,9 +327,9 @@ class TraceEntry(object):
         """Write this trace info entry to the `fp` file."""
         trace_entry_header_struct.write(fp, {
             'unit_name_length': len(self.unit_name),
-            'stmt_bit_count': len(self.stmt_buffer.bits),
-            'dc_bit_count': len(self.dc_buffer.bits),
-            'mcdc_bit_count': len(self.mcdc_buffer.bits),
+            'stmt_bit_count': len(self.stmt_buffer),
+            'dc_bit_count': len(self.dc_buffer),
+            'mcdc_bit_count': len(self.mcdc_buffer),
             'unit_part': self.UNIT_PART_CODES[self.unit_part],
             'bit_buffer_encoding':
                 self.BIT_BUFFER_ENCODING_CODES['lsb_first_bytes'],
@@ -335,10 +347,42 @@ class TraceEntry(object):
 class TraceBuffer(object):
     """
     In-memory representation of a coverage buffer.
+
+    Bits are packed in a bytearray according to the lsb_first_bytes encoding:
+    bit N is the (N % 8)th least significant bit of the (N // 8)th byte. Bits
+    past the end of the buffer in the last byte are always cleared.
     """
 
-    def __init__(self, bits):
-        self.bits = bits
+    def __init__(self, bit_count, data=None):
+        """
+        :param int bit_count: Number of bits in this buffer.
+        :param bytes|bytearray|None data: Packed bits. If None, all bits are
+            cleared.
+        """
+        bytes_count = self.byte_count(bit_count)
+        if data is None:
+            data = bytearray(bytes_count)
+        else:
+            data = bytearray(data)
+            if len(data) != bytes_count:
+                raise ValueError('{} bytes expected for {} bits, got {}'
+                                 .format(bytes_count, bit_count, len(data)))
+            if bit_count % 8:
+                data[-1] &= (1 << (bit_count % 8)) - 1
+
+        self.bit_count = bit_count
+        self.data = data
+
+    @classmethod
+    def from_bits(cls, bits):
+        """
+        Create a coverage buffer from a sequence of booleans.
+        """
+        result = cls(len(bits))
+        for i, bit in enumerate(bits):
+            if bit:
+                result[i] = True
+        return result
 
     @staticmethod
     def byte_count(bit_count):
@@ -351,50 +395,217 @@ class TraceBuffer(object):
             bytes_count += 1
         return bytes_count
 
+    @property
+    def bits(self):
+        """
+        List of booleans for all bits in this buffer.
+        """
+        return list(self)
+
+    def __len__(self):
+        return self.bit_count
+
+    def _check_index(self, index):
+        if not 0 <= index < self.bit_count:
+            raise IndexError('bit index out of range: {}'.format(index))
+
+    def __getitem__(self, index):
+        self._check_index(index)
+        return bool(self.data[index >> 3] & (1 << (index & 7)))
+
+    def __setitem__(self, index, value):
+        self._check_index(index)
+        mask = 1 << (index & 7)
+        if value:
+            self.data[index >> 3] |= mask
+        else:
+            self.data[index >> 3] &= ~mask & 0xff
+
+    def __iter__(self):
+        for i in range(self.bit_count):
+            yield bool(self.data[i >> 3] & (1 << (i & 7)))
+
+    def __eq__(self, other):
+        return (isinstance(other, TraceBuffer)
+                and self.bit_count == other.bit_count
+                and self.data == other.data)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def set_indexes(self):
+        """
+        Yield the indexes of all set bits, in increasing order.
+        """
+        for byte_index, byte in enumerate(self.data):
+            bit_index = 8 * byte_index
+            while byte:
+                if byte & 1:
+                    yield bit_index
+                byte >>= 1
+                bit_index += 1
+
+    def count(self):
+        """
+        Return the number of set bits.
+        """
+        return bin(self.as_int()).count('1')
+
+    def as_int(self):
+        """
+        Return an integer whose binary representation matches the bits in
+        this buffer: bit N in this buffer is bit N in the integer.
+        """
+        return int.from_bytes(bytes(self.data), 'little')
+
+    def _combine(self, other, operator):
+        if self.bit_count != other.bit_count:
+            raise ValueError('Cannot combine buffers of {} and {} bits'
+                             .format(self.bit_count, other.bit_count))
+        value = operator(self.as_int(), other.as_int())
+        return value.to_bytes(len(self.data), 'little')
+
+    def __or__(self, other):
+        return TraceBuffer(self.bit_count,
+                           self._combine(other, lambda x, y: x | y))
+
+    def __and__(self, other):
+        return TraceBuffer(self.bit_count,
+                           self._combine(other, lambda x, y: x & y))
+
+    def __ior__(self, other):
+        self.data[:] = self._combine(other, lambda x, y: x | y)
+        return self
+
+    def __iand__(self, other):
+        self.data[:] = self._combine(other, lambda x, y: x & y)
+        return self
+
     @classmethod
     def read(cls, fp, trace_file, bit_buffer_encoding, bit_count):
         assert bit_buffer_encoding == 'lsb_first_bytes'
 
         bytes_count = cls.byte_count(bit_count)
         bytes_and_padding = read_aligned(fp, bytes_count, trace_file.alignment)
+        return cls(bit_count, bytes_and_padding)
+
+    def write(self, fp, alignment):
+        """Write this coverage buffer to the `fp` file."""
+        write_aligned(fp, bytes(self.data), alignment)
 
-        bits = []
-        for byte_index in range(bytes_count):
-            byte = bytes_and_padding[byte_index]
-            for bit_index in range(8):
-                global_bit_index = 8 * byte_index + bit_index
-                if global_bit_index >= bit_count:
-                    return cls(bits)
 
-                bits.append(bool(byte & 1))
-                byte = byte >> 1
+def merge_src_traces(filenames):
+    """
+    Merge the `filenames` source trace files into a single one.
 
-        return cls(bits)
+    Trace entries are indexed by (unit name, unit part, fingerprint), and the
+    coverage buffers of trace entries that share the same key are OR-ed. Only
+    this index is kept in memory: source trace files are processed one after
+    the other. The alignment, endianity and trace info entries of the result
+    come from the first source trace file.
 
-    def write(self, fp, alignment):
-        """Write this coverage buffer to the `fp` file."""
-        bit_count = len(self.bits)
-        bytes_count = self.byte_count(bit_count)
-        buffer = [0] * bytes_count
+    Return a couple: the merged SrcTraceFile instance, and a list of
+    fingerprint mismatches, i.e. (unit_name, unit_part, fingerprints)
+    triplets for all units that have trace entries with different
+    fingerprints, so with different coverage obligations. Trace entries for
+    all fingerprints are kept in the result.
 
-        for global_bit_index, bit in enumerate(self.bits):
-            byte_index = global_bit_index // 8
-            bit_index = global_bit_index % 8
-            bit_value = int(bit) << bit_index
-            buffer[byte_index] |= bit_value
+    :param list[str] filenames: Source trace files to merge.
+    """
+    first_trace = None
+
+    # Mapping: (unit name, unit part, fingerprint) -> merged TraceEntry
+    index = {}
+
+    # Mapping: (unit name, unit part) -> list of fingerprints
+    fingerprints = {}
+
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            tf = SrcTraceFile.read(ByteStreamDecoder(f))
+        if first_trace is None:
+            first_trace = tf
+
+        for entry in tf.entries:
+            unit = (entry.unit_name, entry.unit_part)
+            key = unit + (entry.fingerprint, )
+            try:
+                merged = index[key]
+            except KeyError:
+                index[key] = entry
+                fingerprints.setdefault(unit, []).append(entry.fingerprint)
+                continue
+
+            try:
+                merged.stmt_buffer |= entry.stmt_buffer
+                merged.dc_buffer |= entry.dc_buffer
+                merged.mcdc_buffer |= entry.mcdc_buffer
+            except ValueError as exc:
+                raise ValueError('{}: unit {} ({}): {}'.format(
+                    filename, entry.unit_name.decode('utf-8'),
+                    entry.unit_part, exc
+                ))
+
+    if first_trace is None:
+        raise ValueError('At least one source trace file is required')
+
+    mismatches = [unit + (tuple(unit_fingerprints), )
+                  for unit, unit_fingerprints in fingerprints.items()
+                  if len(unit_fingerprints) > 1]
+    result = SrcTraceFile(first_trace.alignment, first_trace.endianity,
+                          first_trace.info_entries, list(index.values()))
+    return result, mismatches
+
+
+parser = argparse.ArgumentParser('Process source trace files')
+subparsers = parser.add_subparsers(dest='command')
+subparsers.required = True
+
+decode_parser = subparsers.add_parser(
+    'decode', help='Decode and dump a source trace file'
+)
+decode_parser.add_argument('--debug', '-d', action='store_true',
+                           help='Enable debug traces')
+decode_parser.add_argument('trace-file', help='Source trace file to decode')
 
-        write_aligned(fp, bytes(byte for byte in buffer), alignment)
+merge_parser = subparsers.add_parser(
+    'merge', help='Merge source trace files into a single one'
+)
+merge_parser.add_argument('--output', '-o', required=True,
+                          help='Source trace file to write')
+merge_parser.add_argument('trace-files', nargs='+',
+                          help='Source trace files to merge')
 
 
-parser = argparse.ArgumentParser('Decode a source trace file')
-parser.add_argument('--debug', '-d', action='store_true',
-                    help='Enable debug traces')
-parser.add_argument('trace-file', help='Source trace file to decode')
+def parse_args(argv=None):
+    """
+    Parse command-line arguments (`sys.argv` if `argv` is None). For
+    backward compatibility, a trace file given without command means the
+    "decode" command.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    positionals = [arg for arg in argv if not arg.startswith('-')]
+    if positionals and positionals[0] not in subparsers.choices:
+        argv = ['decode'] + argv
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
-    args = parser.parse_args()
-    with open(getattr(args, 'trace-file'), 'rb') as f:
-        tf = SrcTraceFile.read(ByteStreamDecoder(f, args.debug))
-
-    tf.dump()
+    args = parse_args()
+
+    if args.command == 'decode':
+        with open(getattr(args, 'trace-file'), 'rb') as f:
+            tf = SrcTraceFile.read(ByteStreamDecoder(f, args.debug))
+        tf.dump()
+
+    elif args.command == 'merge':
+        tf, mismatches = merge_src_traces(getattr(args, 'trace-files'))
+        for unit_name, unit_part, fingerprints in mismatches:
+            sys.stderr.write('warning: fingerprint mismatch for unit {} ({}):'
+                             ' {}\n'.format(
+                                 unit_name.decode('utf-8'), unit_part,
+                                 ', '.join(format_fingerprint(fp)
+                                           for fp in fingerprints)))
+        with open(args.output, 'wb') as f:
+            tf.write(f)
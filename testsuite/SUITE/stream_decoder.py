@@ -2,6 +2,21 @@ from contextlib import contextmanager
 import struct
 
 
+class NullContext(object):
+    """
+    Context manager that does nothing.
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_CONTEXT = NullContext()
+
+
 def swap_bytes(number, size):
     """Swap bytes in ``number``, assumed to be ``size``-bytes large."""
     result = 0
@@ -43,14 +58,22 @@ class ByteStreamDecoder(object):
             message = message.format(*args, **kwargs)
         print('{}{}'.format(self._indent_prefix, message))
 
-    @contextmanager
     def label_context(self, label):
         """
         Context manager to put a label on everything that is read while this
         context manager is active.
 
+        When decoding traces are disabled, labels are useless: return a
+        context manager that does nothing to avoid the overhead.
+
         :param str label: Label to use.
         """
+        if not self.enabled:
+            return NULL_CONTEXT
+        return self._label_context(label)
+
+    @contextmanager
+    def _label_context(self, label):
         self._print('{} ({:#0x}):', label, self.offset)
         self.label_stack.append(label)
         yield
@@ -95,6 +118,48 @@ class ByteStreamDecoder(object):
         return bytes
 
 
+class BufferDecoder(object):
+    """
+    Counterpart of ByteStreamDecoder to decode an in-memory buffer, without
+    decoding traces. Structures are decoded in place (see Struct.read_values)
+    instead of being copied first.
+    """
+
+    enabled = False
+
+    def __init__(self, buf, offset=0):
+        """
+        :param bytes|memoryview buf: Buffer to decode.
+        :param int offset: Offset in ``buf`` of the first byte to decode.
+        """
+        self.buf = buf
+        self.offset = offset
+
+    def label_context(self, label):
+        return NULL_CONTEXT
+
+    @property
+    def remaining(self):
+        """
+        Number of bytes left to decode.
+        """
+        return len(self.buf) - self.offset
+
+    def read(self, size=-1):
+        """
+        Read bytes from this buffer.
+
+        :param int size: Number of bytes to read. If negative, read all
+            remaining bytes.
+        :rtype: bytes
+        """
+        if size < 0:
+            size = self.remaining
+        result = bytes(self.buf[self.offset:self.offset + size])
+        self.offset += len(result)
+        return result
+
+
 class Struct(object):
     """
     Wrapper for struct.Struct to work with ByteStreamDecoder.
@@ -108,26 +173,120 @@ class Struct(object):
         :type fields: list[(str, str)]
         """
         self.label = label
+        self.names = [name for name, _ in fields]
         self.le_fields = [(name, struct.Struct('<' + fmt))
                           for name, fmt in fields]
         self.be_fields = [(name, struct.Struct('>' + fmt))
                           for name, fmt in fields]
 
+        # Compile all fields into a single structure for each endianness, so
+        # that decoding all fields takes only one call when we do not need
+        # per-field decoding traces.
+        fmt = ''.join(fmt for _, fmt in fields)
+        self.le_struct = struct.Struct('<' + fmt)
+        self.be_struct = struct.Struct('>' + fmt)
+
+        # Fields such as "20B" decode to several values: for each field,
+        # compute the slice of values it covers in the compiled structure, or
+        # None if all fields decode to a single value.
+        self.value_slices = []
+        start = 0
+        for _, structure in self.le_fields:
+            count = len(structure.unpack(bytes(structure.size)))
+            self.value_slices.append(
+                start if count == 1 else slice(start, start + count)
+            )
+            start += count
+        if start == len(fields):
+            self.value_slices = None
+
+    @property
+    def size(self):
+        """
+        Number of bytes needed to encode this structure.
+        """
+        return self.le_struct.size
+
     def _fields(self, big_endian=False):
         return (self.be_fields if big_endian else self.le_fields)
 
-    def read(self, fp, big_endian=False):
+    def _struct(self, big_endian=False):
+        return (self.be_struct if big_endian else self.le_struct)
+
+    def _group_values(self, values):
+        if self.value_slices is None:
+            return values
+        return tuple(values[s] for s in self.value_slices)
+
+    def unpack_from(self, buf, offset=0, big_endian=False):
+        """
+        Decode this structure from the ``buf`` buffer, starting at ``offset``.
+        Return a tuple that contains the value of each field, in declaration
+        order. Fields that decode to several values are tuples themselves.
+
+        :param bytes|memoryview buf: Buffer to decode.
+        :param int offset: Offset in ``buf`` of the first byte to decode.
+        :param bool big_endian: Whether to decode structure fields as big
+            endian (consider little endian by default).
+        """
+        return self._group_values(
+            self._struct(big_endian).unpack_from(buf, offset)
+        )
+
+    def iter_unpack(self, buf, offset=0, count=None, big_endian=False):
+        """
+        Decode ``count`` consecutive instances of this structure from the
+        ``buf`` buffer, starting at ``offset``, and yield tuples of field
+        values like ``unpack_from`` does.
+
+        :param int|None count: Number of structures to decode. If None, decode
+            as many structures as there are in the rest of ``buf``.
+        """
+        structure = self._struct(big_endian)
+        if count is None:
+            count = (len(buf) - offset) // structure.size
+        view = memoryview(buf)[offset:offset + count * structure.size]
+        assert len(view) == count * structure.size
+        values = structure.iter_unpack(view)
+        if self.value_slices is None:
+            return values
+        return (self._group_values(v) for v in values)
+
+    def read_values(self, fp, big_endian=False):
         """
         Read bytes from ``fp`` and decode these bytes according to the format
-        of this structure.
+        of this structure. Return None if ``fp`` was at the end of the file,
+        and a tuple of field values like ``unpack_from`` does otherwise.
 
-        :param ByteStreamDecoder fp: Stream from which to read and decode this
-            structure.
+        If decoding traces are disabled for ``fp``, this reads and decodes the
+        whole structure at once (in place for a BufferDecoder). Otherwise,
+        each field is read separately, to get a label for each field in
+        decoding traces.
+
+        :param ByteStreamDecoder|BufferDecoder fp: Stream from which to read
+            and decode this structure.
         :param bool big_endian: Whether to decode structure fields as big
             endian (consider little endian by default).
         """
+        if isinstance(fp, BufferDecoder):
+            structure = self._struct(big_endian)
+            if not fp.remaining:
+                return None
+            assert fp.remaining >= structure.size
+            values = structure.unpack_from(fp.buf, fp.offset)
+            fp.offset += structure.size
+            return self._group_values(values)
+
+        elif not fp.enabled:
+            structure = self._struct(big_endian)
+            buf = fp.read(structure.size)
+            if not buf:
+                return None
+            assert len(buf) == structure.size
+            return self._group_values(structure.unpack(buf))
+
         with fp.label_context(self.label):
-            result = {}
+            result = []
             for i, (name, structure) in enumerate(self._fields(big_endian)):
                 with fp.label_context(name):
                     buf = fp.read(structure.size)
@@ -137,8 +296,21 @@ class Struct(object):
                     field = structure.unpack(buf)
                     if len(field) == 1:
                         field = field[0]
-                    result[name] = field
-            return result
+                    result.append(field)
+            return tuple(result)
+
+    def read(self, fp, big_endian=False):
+        """
+        Read bytes from ``fp`` and decode these bytes according to the format
+        of this structure. Return None if ``fp`` was at the end of the file,
+        and a mapping from field names to field values otherwise.
+
+        See ``read_values`` for the description of arguments.
+        """
+        values = self.read_values(fp, big_endian)
+        if values is None:
+            return None
+        return dict(zip(self.names, values))
 
     def write(self, fp, field_values, big_endian=False):
         fields = self._fields(big_endian)
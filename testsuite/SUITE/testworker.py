@@ -0,0 +1,359 @@
+"""Persistent workers to run testcase scripts.
+
+Running each "test.py" in a fresh interpreter means that every testcase pays
+for the interpreter startup, the import of the SUITE/SCOV packages and e3, the
+parsing of its command line and the reading of the discriminants file. This
+module provides an alternative: long-lived worker processes that run
+testcase scripts one after the other, keeping imported modules around.
+
+Each testcase still runs in isolation: the worker restores its current
+directory, command line, environment, module search path and logging setup
+after each testcase, forgets about modules that are specific to a testcase
+(such as "test_support" ones) and re-initializes the "thistest" instance
+before running the next testcase (see SUITE.context.reset_for_test).
+
+Workers communicate with the testsuite driver through their standard input
+and output, one JSON object per line. Testcase outputs are redirected at the
+file descriptor level to a file chosen by the driver, so that the outputs of
+subprocesses are captured as well.
+
+This module is both the worker program (run it with "python -m
+SUITE.testworker") and the driver side pool of workers (TestPyWorkerPool). It
+must not import SUITE.context, as importing it runs testcase specific code.
+"""
+
+import json
+import logging
+import os
+import queue
+import runpy
+import signal
+import subprocess
+import sys
+import threading
+import traceback
+
+from e3.os.process import kill_process_tree
+
+
+WORKER_MAX_TESTS = 100
+"""
+Number of testcases a worker runs before it is replaced with a fresh one, to
+bound the effect of possible leaks (memory, file descriptors, ...).
+"""
+
+PRELOADED_MODULES = ['e3.fs', 'e3.os.fs', 'e3.os.process', 'e3.main',
+                     'SUITE.control', 'SUITE.cutils', 'SUITE.dutils',
+                     'SUITE.qdata', 'SUITE.gprutils']
+"""
+Modules that a worker imports at startup, before running any testcase. Modules
+that depend on "thistest" are imported when running the first testcase.
+"""
+
+KEPT_PACKAGES = ('SUITE', 'SCOV', 'e3')
+"""
+Modules imported by a testcase that are kept for the next ones, in addition
+to the modules from the Python installation.
+
+As these modules are not re-imported, they must not bind testcase specific
+state at import time: for instance, they must read SUITE.context.TEST_DIR
+when they use it rather than "from SUITE.context import TEST_DIR".
+"""
+
+
+class TestPyResult(object):
+    """
+    Outcome of a testcase run by a worker. Mimics the attributes of e3's Run
+    objects that the testsuite driver uses.
+    """
+
+    def __init__(self, status, out):
+        self.status = status
+        self.out = out
+
+
+class WorkerError(Exception):
+    """Raised when a worker process died or timed out."""
+    pass
+
+
+# =================
+# == Worker side ==
+# =================
+
+def _is_kept_module(module):
+    """
+    Whether `module`, imported while running a testcase, must be kept for the
+    next testcases.
+    """
+    name = getattr(module, '__name__', None) or ''
+    if name.split('.')[0] in KEPT_PACKAGES:
+        return True
+    filename = getattr(module, '__file__', None)
+    if filename is None:
+        return True
+    filename = os.path.abspath(filename)
+    return any(
+        filename.startswith(os.path.join(prefix, ''))
+        for prefix in {sys.prefix, sys.base_prefix, sys.exec_prefix}
+    )
+
+
+def run_one(test_py, args, cwd, output):
+    """
+    Run the `test_py` testcase script with `args` command line arguments,
+    from the `cwd` directory, writing its standard outputs to the `output`
+    file. Return its exit status.
+    """
+    saved_cwd = os.getcwd()
+    saved_argv = sys.argv
+    saved_path = list(sys.path)
+    saved_environ = dict(os.environ)
+    saved_modules = set(sys.modules)
+    root_logger = logging.getLogger()
+    saved_handlers = list(root_logger.handlers)
+    saved_level = root_logger.level
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = (os.dup(1), os.dup(2))
+    with open(output, 'wb') as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+
+    status = 0
+    try:
+        os.chdir(cwd)
+        sys.argv = [test_py] + list(args)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(test_py)))
+
+        # Testcase state lives in SUITE.context and SUITE.tutils: reset it if
+        # a previous testcase imported them. Otherwise, importing them will
+        # initialize it.
+        context = sys.modules.get('SUITE.context')
+        if context is not None:
+            context.reset_for_test(test_py)
+        tutils = sys.modules.get('SUITE.tutils')
+        if tutils is not None:
+            del tutils.run_processes[:]
+
+        runpy.run_path(test_py, run_name='__main__')
+
+    except SystemExit as exc:
+        if exc.code is None:
+            status = 0
+        elif isinstance(exc.code, int):
+            status = exc.code
+        else:
+            sys.stderr.write('{}\n'.format(exc.code))
+            status = 1
+
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+
+    finally:
+        # Close the report file of a testcase that did not complete
+        context = sys.modules.get('SUITE.context')
+        if context is not None and hasattr(context, 'thistest'):
+            report = getattr(context.thistest, 'report', None)
+            if report is not None and not report.report_fd.closed:
+                report.close()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        for fd in saved_fds:
+            os.close(fd)
+
+        for handler in root_logger.handlers[:]:
+            if handler not in saved_handlers:
+                root_logger.removeHandler(handler)
+                handler.close()
+        root_logger.setLevel(saved_level)
+
+        for name in set(sys.modules) - saved_modules:
+            if not _is_kept_module(sys.modules[name]):
+                del sys.modules[name]
+
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        sys.path[:] = saved_path
+        sys.argv = saved_argv
+        os.chdir(saved_cwd)
+
+    return status
+
+
+def worker_main():
+    """Serve testcase requests read on the standard input."""
+
+    # Keep the standard input and output for the communication with the
+    # driver, and make sure testcases do not use them.
+    requests = os.fdopen(os.dup(0), 'r')
+    replies = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    for name in PRELOADED_MODULES:
+        __import__(name)
+
+    for line in requests:
+        request = json.loads(line)
+        status = run_one(request['test_py'], request['args'],
+                         request['cwd'], request['output'])
+        replies.write(json.dumps({'status': status}) + '\n')
+        replies.flush()
+
+
+# =================
+# == Driver side ==
+# =================
+
+class TestPyWorker(object):
+    """Driver side handle for a worker process."""
+
+    def __init__(self, cwd):
+        """
+        :param str cwd: Directory from which to start the worker.
+        """
+        # Start the worker in its own session (process group on Windows), so
+        # that the processes a testcase spawns can be killed along with it.
+        if sys.platform == 'win32':
+            session_args = {
+                'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP
+            }
+        else:
+            session_args = {'start_new_session': True}
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'SUITE.testworker'],
+            cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True, **session_args
+        )
+        self.test_count = 0
+
+        # Read replies in a thread, so that waiting for them can time out on
+        # all platforms.
+        self.replies = queue.Queue()
+        self.reader = threading.Thread(target=self._read_replies)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read_replies(self):
+        for line in self.process.stdout:
+            self.replies.put(json.loads(line))
+        self.replies.put(None)
+
+    def run(self, test_py, args, cwd, output, timeout=None):
+        """
+        Run a testcase in this worker (see run_one) and return its exit
+        status. Raise a WorkerError if the worker dies or if the testcase
+        takes more than `timeout` seconds.
+        """
+        self.test_count += 1
+        try:
+            self.process.stdin.write(json.dumps({
+                'test_py': test_py, 'args': args,
+                'cwd': cwd, 'output': output
+            }) + '\n')
+            self.process.stdin.flush()
+        except (IOError, OSError) as exc:
+            raise WorkerError('Cannot send testcase to worker: {}'.format(exc))
+
+        try:
+            reply = self.replies.get(timeout=timeout)
+        except queue.Empty:
+            raise WorkerError('Timeout after {} seconds'.format(timeout))
+        if reply is None:
+            raise WorkerError('Worker exitted with status code {}'.format(
+                self.process.wait()))
+        return reply['status']
+
+    def stop(self):
+        """
+        Stop this worker, killing it if it is still running, as well as all
+        the processes it spawned (builds, emulators, test programs...).
+        """
+        if self.process.poll() is None:
+            kill_process_tree(self.process.pid)
+
+        # Processes whose parent died are no longer part of the worker's
+        # process tree, but they remain in its session.
+        if sys.platform != 'win32':
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.process.wait()
+        for f in (self.process.stdin, self.process.stdout):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+
+
+class TestPyWorkerPool(object):
+    """
+    Pool of persistent workers to run testcase scripts. Workers are started
+    on demand, so the pool never has more workers than testcases running
+    concurrently.
+    """
+
+    def __init__(self, cwd):
+        """
+        :param str cwd: Directory from which to start workers.
+        """
+        self.cwd = cwd
+        self.lock = threading.Lock()
+        self.idle_workers = []
+        self.busy_workers = set()
+
+    def run(self, cmd, cwd, output, timeout=None):
+        """
+        Run the testcase for the `cmd` command line ([python, test.py,
+        args...]) from the `cwd` directory, in an idle worker. Write its
+        standard outputs to the `output` file and return a TestPyResult.
+        """
+        with self.lock:
+            worker = (self.idle_workers.pop() if self.idle_workers
+                      else None)
+        if worker is None:
+            worker = TestPyWorker(self.cwd)
+        with self.lock:
+            self.busy_workers.add(worker)
+
+        try:
+            status = worker.run(cmd[1], cmd[2:], cwd, output, timeout)
+        except WorkerError as exc:
+            # The worker is in an unknown state: do not reuse it
+            worker.stop()
+            status = 1
+            with open(output, 'a') as f:
+                f.write('\n{}\n'.format(exc))
+        else:
+            if worker.test_count >= WORKER_MAX_TESTS:
+                worker.stop()
+        finally:
+            with self.lock:
+                self.busy_workers.discard(worker)
+                if worker.process.returncode is None:
+                    self.idle_workers.append(worker)
+
+        with open(output) as f:
+            return TestPyResult(status, f.read())
+
+    def shutdown(self):
+        """Stop all workers."""
+        with self.lock:
+            workers = self.idle_workers + list(self.busy_workers)
+            self.idle_workers = []
+            self.busy_workers = set()
+        for worker in workers:
+            worker.stop()
+
+
+if __name__ == '__main__':
+    worker_main()
@@ -6,10 +6,17 @@ from __future__ import absolute_import, division, print_function
 
 import argparse
 import binascii
+import bisect
 import datetime
+import mmap
+import operator
 import os
+import sys
 
-from SUITE.stream_decoder import ByteStreamDecoder, Struct
+from array import array
+from itertools import accumulate, islice
+
+from SUITE.stream_decoder import BufferDecoder, ByteStreamDecoder, Struct
 
 
 class Enum(object):
@@ -203,10 +210,10 @@ def unpack_from_file(fp, struct):
     :param file fp: File from which to read bytes.
     :param Struct struct: Struct instance to decode data.
     """
-    fields = struct.read(fp)
+    fields = struct.read_values(fp)
     if fields is None:
         return None
-    return [fields[name] for name, _ in struct.be_fields]
+    return list(fields)
 
 
 class TraceFile(object):
@@ -240,8 +247,11 @@ class TraceFile(object):
             return
 
         self.entries = entries
-        for entry in entries:
-            assert entry.bits == self.bits
+        if isinstance(entries, list):
+            for entry in entries:
+                assert entry.bits == self.bits
+        else:
+            assert entries.bits == self.bits
 
     @staticmethod
     def bits(header):
@@ -264,14 +274,81 @@ class TraceFile(object):
 
         entries = []
         if second_header:
-            while True:
-                entry = TraceEntry.read(fp, bits)
-                if not entry:
-                    break
-                entries.append(entry)
+            entries = list(TraceEntry.read_all(fp, bits))
+
+        return cls(first_header, infos, second_header, entries)
+
+    @classmethod
+    def read_mapped(cls, filename):
+        """
+        Memory-map the `filename` trace file and return a TraceFile instance
+        whose entries are a MappedTraceEntries sequence: trace entries are
+        decoded on demand instead of all being loaded in memory.
+
+        The mapping stays open as long as entries are accessible: call the
+        `close` method (or use the result as a context manager) to release it.
+        """
+        with open(filename, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fp = BufferDecoder(mapping)
+        first_header = unpack_from_file(fp, TraceHeaderStruct)
+        infos = TraceInfoList.read(fp)
+        second_header = unpack_from_file(fp, TraceHeaderStruct)
+
+        if second_header:
+            entries = MappedTraceEntries(
+                mapping, fp.offset, cls.bits(first_header),
+                big_endian=bool(second_header[4])
+            )
+        else:
+            entries = []
+            mapping.close()
+
+        return cls(first_header, infos, second_header, entries)
+
+    @classmethod
+    def read_streamed(cls, fp, chunk_entries=None):
+        """
+        Read the headers and the trace infos from the `fp` file and return a
+        TraceFile instance whose entries are a TraceEntryStream: trace entries
+        are read from `fp` in chunks, as they are iterated on. This makes it
+        possible to process trace files that do not fit in memory.
+
+        `fp` must not be used for anything else while entries are iterated on,
+        and entries can be iterated on only once.
 
+        :param int|None chunk_entries: If provided, number of trace entries
+            to read at once. Use TraceEntryStream.CHUNK_ENTRIES otherwise.
+        """
+        decoder = ByteStreamDecoder(fp)
+        first_header = unpack_from_file(decoder, TraceHeaderStruct)
+        infos = TraceInfoList.read(decoder)
+        second_header = unpack_from_file(decoder, TraceHeaderStruct)
+
+        entries = (
+            TraceEntryStream(fp, cls.bits(first_header),
+                             big_endian=bool(second_header[4]),
+                             chunk_entries=chunk_entries)
+            if second_header else []
+        )
         return cls(first_header, infos, second_header, entries)
 
+    def close(self):
+        """
+        Release the memory mapping for trace entries, if any. Trace entries
+        must not be accessed after this.
+        """
+        entries = getattr(self, 'entries', None)
+        if isinstance(entries, MappedTraceEntries):
+            entries.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def write(self, fp):
         """
         Write this trace file to the `fp` file.
@@ -281,8 +358,11 @@ class TraceFile(object):
         TraceHeaderStruct.write(fp, self.first_header)
         self.infos.write(fp)
         TraceHeaderStruct.write(fp, self.second_header)
-        for entry in self.entries:
-            entry.write(fp)
+        if isinstance(self.entries, TraceEntryArray):
+            self.entries.write(fp)
+        else:
+            for entry in self.entries:
+                entry.write(fp)
 
     def iter_entries(self, raw=False):
         """
@@ -290,34 +370,29 @@ class TraceFile(object):
 
         Unless `raw` is true, this interprets special trace entries, such as
         loadaddr (module loaded at PC). In this case, other trace entries are
-        returned (and potentially skipped) accordingly.
+        returned (and potentially skipped) accordingly, and only the trace
+        entries for the main module are yielded: see `iter_module_entries` to
+        get trace entries for shared objects as well.
         """
-        entries = iter(self.entries)
-        offset = 0
-
-        # If there is a kernel, skip all trace entries until we get a loadaddr
-        # special one.
-        if not raw and InfoKind.Kernel_File_Name in self.infos.infos:
-            while True:
-                loadaddr = next(entries)
-                if (
-                    loadaddr.is_special and
-                    loadaddr.size == TraceSpecial.Loadaddr
-                ):
-                    offset = loadaddr.pc
-                    break
+        if raw:
+            for e in self.entries:
+                yield TraceEntry(e.bits, e.pc, e.size, e.op, e.infos)
+            return
 
-        # Now go through the remaining list of trace entries
-        for e in entries:
-            # TODO: handle special trace entries that can show up here
-            # (load_shared_object, ...)
-            assert not e.is_special
+        for shared_object, e in relocate_entries(self.entries, self.infos):
+            if shared_object is None:
+                yield e
 
-            # Discard trace entries for code below the module of interest
-            if not raw and e.pc < offset:
-                continue
+    def iter_module_entries(self):
+        """
+        Yield (shared_object, trace_entry) couples for all trace entries in
+        this trace file, interpreting special trace entries.
 
-            yield TraceEntry(e.bits, e.pc - offset, e.size, e.op, e.infos)
+        `shared_object` is None for trace entries in the main module, and the
+        corresponding SharedObject instance otherwise. In both cases, the
+        trace entry is relocated as if its module was loaded at address 0.
+        """
+        return relocate_entries(self.entries, self.infos)
 
 
 class TraceInfo(object):
@@ -478,21 +553,74 @@ class TraceEntry(object):
             if not fields:
                 return None
 
-            # Remove padding
-            padding = fields.pop()
-            assert padding == 0, repr(padding)
-            if bits == 64:
-                padding = fields.pop()
-                assert padding == 0, repr(padding)
-
-            result = cls(bits, *fields)
-            if (
-                result.is_special
-                and result.size == TraceSpecial.LoadSharedObject
-            ):
+            result = cls.from_fields(bits, fields)
+            if result.loads_shared_object:
                 result.infos = TraceInfoList.read(fp)
             return result
 
+    @classmethod
+    def read_all(cls, fp, bits):
+        """
+        Read all trace entries until the end of the `fp` file and yield
+        TraceEntry instances for them.
+
+        Unless decoding traces are enabled for `fp`, this reads all remaining
+        bytes at once and decodes runs of trace entries with a single
+        Struct.iter_unpack call.
+        """
+        if fp.enabled:
+            while True:
+                entry = cls.read(fp, bits)
+                if not entry:
+                    return
+                yield entry
+
+        structure = cls.struct(bits)
+        decoder = BufferDecoder(fp.read(-1))
+        while decoder.remaining:
+            count = decoder.remaining // structure.size
+            assert count, (
+                'Trace entries are truncated: {} trailing bytes'.format(
+                    decoder.remaining
+                )
+            )
+            for fields in structure.iter_unpack(decoder.buf, decoder.offset,
+                                                count):
+                decoder.offset += structure.size
+                entry = cls.from_fields(bits, list(fields))
+
+                # Trace infos follow "load shared object" special trace
+                # entries: decode them and start a new run of trace entries
+                # after them.
+                if entry.loads_shared_object:
+                    entry.infos = TraceInfoList.read(decoder)
+                    yield entry
+                    break
+                yield entry
+
+    @classmethod
+    def from_fields(cls, bits, fields):
+        """
+        Create a TraceEntry instance from the list of field values decoded
+        with the `cls.struct(bits)` structure.
+        """
+        # Remove padding
+        padding = fields.pop()
+        assert padding == 0, repr(padding)
+        if bits == 64:
+            padding = fields.pop()
+            assert padding == 0, repr(padding)
+
+        return cls(bits, *fields)
+
+    @property
+    def loads_shared_object(self):
+        """
+        Whether this is a "load shared object" special trace entry, i.e. a
+        trace entry followed by a list of trace infos.
+        """
+        return self.is_special and self.size == TraceSpecial.LoadSharedObject
+
     def write(self, fp):
         """
         Write this trace entry to the `fp` file.
@@ -505,6 +633,465 @@ class TraceEntry(object):
             self.infos.write(fp)
 
 
+TRACE_ENTRY_LAYOUTS = {
+    # Number of bits in the target PC -> (memoryview format for the PC,
+    # offset for the size field, offset for the op field). See Trace_Entry32
+    # and Trace_Entry64 in qemu_traces.ads.
+    32: ('I', 4, 6),
+    64: ('Q', 8, 10),
+}
+
+SPECIAL_OP_TABLE = bytes(
+    1 if op & TraceOp.Special else 0 for op in range(256)
+)
+"""
+Translation table to turn a string of trace entry op fields into a string
+where only special trace entries have a non-null byte.
+"""
+
+
+def byteswapped(column):
+    """
+    Return an array that contains the items in the `column` memoryview with
+    their bytes swapped.
+    """
+    result = array(column.format, column.tobytes())
+    result.byteswap()
+    return result
+
+
+class TraceEntryArray(object):
+    """
+    Columnar view over a contiguous run of trace entries.
+
+    The `pc`, `size` and `op` attributes are sequences of integers, with one
+    item per trace entry. When the trace file was produced on a host that has
+    our endianness, they are strided memoryviews over the original buffer, so
+    that nothing is copied. Otherwise, they are arrays decoded from it.
+    """
+
+    def __init__(self, buf, bits, big_endian=False, infos=None):
+        """
+        :param memoryview buf: Bytes for trace entries. Its size must be a
+            multiple of the size of one trace entry.
+        :param int bits: Number of bits in the target PC.
+        :param bool big_endian: Whether trace entries are big-endian.
+        :param None|TraceInfoList infos: Informations associated to the last
+            trace entry in this run.
+        """
+        entry_size = TraceEntry.struct(bits).size
+        assert len(buf) % entry_size == 0, (
+            'Trace entries are truncated: {} trailing bytes'.format(
+                len(buf) % entry_size
+            )
+        )
+
+        self.bits = bits
+        self.infos = infos
+        self.buf = buf.cast('B')
+
+        pc_format, size_offset, op_offset = TRACE_ENTRY_LAYOUTS[bits]
+        pc_view = self.buf.cast(pc_format)
+        size_view = self.buf.cast('H')
+        self.pc = pc_view[::entry_size // pc_view.itemsize]
+        self.size = size_view[size_offset // 2::entry_size // 2]
+        self.op = self.buf[op_offset::entry_size]
+        pc_view.release()
+        size_view.release()
+
+        if big_endian != (sys.byteorder == 'big'):
+            pc_view, size_view = self.pc, self.size
+            self.pc = byteswapped(pc_view)
+            self.size = byteswapped(size_view)
+            pc_view.release()
+            size_view.release()
+
+    def __len__(self):
+        return len(self.op)
+
+    def __getitem__(self, index):
+        """
+        Return the `index`th trace entry in this run, as a TraceEntry instance.
+        """
+        if index < 0:
+            index += len(self)
+        return TraceEntry(
+            self.bits, self.pc[index], self.size[index], self.op[index],
+            self.infos if index == len(self) - 1 else None
+        )
+
+    def __iter__(self):
+        bits = self.bits
+        columns = zip(self.pc, self.size, self.op)
+        if self.infos is not None:
+            columns = islice(columns, len(self) - 1)
+        for pc, size, op in columns:
+            yield TraceEntry(bits, pc, size, op)
+        if self.infos is not None:
+            yield self[-1]
+
+    def find_special(self, size=None, start=0):
+        """
+        Return the index of the first special trace entry whose size field
+        is `size` (or of the first special trace entry if `size` is None),
+        starting at index `start`, or None if there is no such entry.
+        """
+        specials = self.op.tobytes().translate(SPECIAL_OP_TABLE)
+        index = specials.find(b'\x01', start)
+        while index != -1:
+            if size is None or self.size[index] == size:
+                return index
+            index = specials.find(b'\x01', index + 1)
+        return None
+
+    def write(self, fp):
+        """
+        Write the trace entries in this run to the `fp` file, as is.
+        """
+        fp.write(self.buf)
+        if self.infos:
+            self.infos.write(fp)
+
+    def release(self):
+        """
+        Release all views on the underlying buffer.
+        """
+        for column in (self.pc, self.size, self.op, self.buf):
+            if isinstance(column, memoryview):
+                column.release()
+
+
+class MappedTraceEntries(object):
+    """
+    Lazy sequence of TraceEntry instances for the trace entries section of a
+    memory-mapped trace file.
+
+    As special "load shared object" trace entries are followed by a variable
+    length list of trace infos, the section is split into runs of fixed-size
+    trace entries (see TraceEntryArray), each run ending with such a special
+    trace entry, except the last one.
+    """
+
+    def __init__(self, mapping, offset, bits, big_endian=False):
+        """
+        :param mmap.mmap mapping: Memory mapping for the trace file. This
+            instance takes ownership of it.
+        :param int offset: Offset in `mapping` of the first trace entry.
+        :param int bits: Number of bits in the target PC.
+        :param bool big_endian: Whether trace entries are big-endian.
+        """
+        self.mapping = mapping
+        self.bits = bits
+        self.runs = []
+
+        # Index of the first trace entry in each run, for random access
+        self.run_starts = []
+        self.count = 0
+
+        entry_size = TraceEntry.struct(bits).size
+        view = memoryview(mapping)
+        while offset < len(view):
+            # Optimistically assume that all remaining bytes are fixed-size
+            # trace entries, then look for the first special trace entry that
+            # disproves it.
+            end = offset + (len(view) - offset) // entry_size * entry_size
+            run = TraceEntryArray(view[offset:end], bits, big_endian)
+            index = run.find_special(TraceSpecial.LoadSharedObject)
+            if index is None:
+                assert end == len(view), (
+                    'Trace entries are truncated: {} trailing bytes'.format(
+                        len(view) - end
+                    )
+                )
+                self._add_run(run)
+                break
+
+            # Restrict this run up to the special trace entry, included, and
+            # decode the trace infos that follow it.
+            run.release()
+            end = offset + (index + 1) * entry_size
+            decoder = BufferDecoder(view, end)
+            infos = TraceInfoList.read(decoder)
+            self._add_run(TraceEntryArray(view[offset:end], bits, big_endian,
+                                          infos))
+            offset = decoder.offset
+        view.release()
+
+    def _add_run(self, run):
+        self.runs.append(run)
+        self.run_starts.append(self.count)
+        self.count += len(run)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('trace entry index out of range')
+        run_index = bisect.bisect_right(self.run_starts, index) - 1
+        return self.runs[run_index][index - self.run_starts[run_index]]
+
+    def __iter__(self):
+        for run in self.runs:
+            for entry in run:
+                yield entry
+
+    def close(self):
+        """
+        Release all views on the memory mapping, and then the mapping itself.
+        """
+        for run in self.runs:
+            run.release()
+        self.runs = []
+        self.run_starts = []
+        self.count = 0
+        self.mapping.close()
+
+
+class PrefixedStream(object):
+    """
+    File-like object to read the `prefix` bytes, and then what is left in
+    the `stream` file.
+    """
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.offset = 0
+        self.stream = stream
+
+    def read(self, size):
+        result = self.prefix[self.offset:self.offset + size]
+        self.offset += len(result)
+        if len(result) < size:
+            result += self.stream.read(size - len(result))
+        return result
+
+    def remaining_prefix(self):
+        """
+        Return the bytes from `prefix` that were not read yet.
+        """
+        return self.prefix[self.offset:]
+
+
+class TraceEntryStream(object):
+    """
+    Single-pass iterable of TraceEntry instances for the trace entries section
+    of a trace file.
+
+    Trace entries are read from the file in chunks of fixed size and decoded
+    with TraceEntryArray, so that memory usage does not depend on the size
+    of the trace file.
+    """
+
+    CHUNK_ENTRIES = 4096
+    """
+    Default number of trace entries to read at once.
+    """
+
+    def __init__(self, fp, bits, big_endian=False, chunk_entries=None):
+        """
+        :param file fp: File from which to read trace entries. Its current
+            position must be the first trace entry.
+        :param int bits: Number of bits in the target PC.
+        :param bool big_endian: Whether trace entries are big-endian.
+        :param int|None chunk_entries: Number of trace entries to read at
+            once. Use CHUNK_ENTRIES if None.
+        """
+        self.fp = fp
+        self.bits = bits
+        self.big_endian = big_endian
+        self.chunk_entries = chunk_entries or self.CHUNK_ENTRIES
+
+    def __iter__(self):
+        entry_size = TraceEntry.struct(self.bits).size
+        chunk_size = self.chunk_entries * entry_size
+
+        # Bytes that were read from `fp` but not decoded yet
+        pending = b''
+
+        while True:
+            chunk = self.fp.read(chunk_size)
+            buf = pending + chunk if pending else chunk
+            usable = len(buf) // entry_size * entry_size
+            if not chunk:
+                assert usable == len(buf), (
+                    'Trace entries are truncated: {} trailing bytes'.format(
+                        len(buf) - usable
+                    )
+                )
+                if not buf:
+                    return
+
+            run = TraceEntryArray(memoryview(buf)[:usable], self.bits,
+                                  self.big_endian)
+            index = run.find_special(TraceSpecial.LoadSharedObject)
+            if index is None:
+                for entry in run:
+                    yield entry
+                run.release()
+                pending = buf[usable:]
+                continue
+
+            # Trace infos follow the "load shared object" special trace entry:
+            # decode them from the rest of the buffer, and then from `fp` if
+            # needed. What is left in the buffer afterwards are trace entries.
+            for entry in islice(run, index):
+                yield entry
+            entry = run[index]
+            run.release()
+
+            stream = PrefixedStream(buf[(index + 1) * entry_size:], self.fp)
+            entry.infos = TraceInfoList.read(ByteStreamDecoder(stream))
+            yield entry
+            pending = stream.remaining_prefix()
+
+
+class SharedObject(object):
+    """
+    Shared object loaded in the traced program, as described by a "load
+    shared object" special trace entry.
+    """
+
+    def __init__(self, first, last, infos):
+        """
+        :param int first: Address of the first byte of the shared object
+            executable code in the traced program address space.
+        :param int last: Address of the last byte of this code.
+        :param TraceInfoList infos: Trace infos associated to the special
+            trace entry.
+        """
+        self.first = first
+        self.last = last
+        self.infos = infos
+
+    @classmethod
+    def from_entry(cls, entry):
+        """
+        Create a SharedObject instance from the given "load shared object"
+        special trace entry.
+        """
+        code_size = int(entry.infos.infos[InfoKind.ExecCodeSize].data)
+        return cls(entry.pc, entry.pc + code_size - 1, entry.infos)
+
+    @property
+    def filename(self):
+        """
+        Name of the shared object file.
+        """
+        return self.infos.infos[InfoKind.ExecFileName].data
+
+    def __repr__(self):
+        return 'SharedObject({}, {:#x}-{:#x})'.format(
+            self.filename, self.first, self.last
+        )
+
+
+class SharedObjectTable(object):
+    """
+    Table of shared objects loaded in the traced program at some point during
+    its execution, to relocate trace entries.
+    """
+
+    def __init__(self):
+        # Sorted list of first addresses for loaded shared objects, and
+        # corresponding SharedObject instances.
+        self.firsts = []
+        self.shared_objects = []
+
+    def load(self, shared_object):
+        """
+        Add `shared_object` to the set of loaded shared objects.
+        """
+        index = bisect.bisect_left(self.firsts, shared_object.first)
+        for neighbor in self.shared_objects[max(0, index - 1):index + 1]:
+            assert (neighbor.last < shared_object.first
+                    or neighbor.first > shared_object.last), (
+                '{} overlaps with {}'.format(shared_object, neighbor)
+            )
+        self.firsts.insert(index, shared_object.first)
+        self.shared_objects.insert(index, shared_object)
+
+    def unload(self, pc):
+        """
+        Remove the shared object loaded at `pc` from the set of loaded shared
+        objects.
+        """
+        index = bisect.bisect_left(self.firsts, pc)
+        assert index < len(self.firsts) and self.firsts[index] == pc, (
+            'No shared object loaded at {:#x}'.format(pc)
+        )
+        self.firsts.pop(index)
+        self.shared_objects.pop(index)
+
+    def lookup(self, pc):
+        """
+        Return the loaded shared object that contains `pc`, or None if there
+        is none.
+        """
+        index = bisect.bisect_right(self.firsts, pc) - 1
+        if index >= 0 and pc <= self.shared_objects[index].last:
+            return self.shared_objects[index]
+        return None
+
+
+def relocate_entries(entries, infos):
+    """
+    Interpret special trace entries in `entries` and yield (shared_object,
+    trace_entry) couples for all other trace entries. See
+    TraceFile.iter_module_entries.
+
+    This mimics what gnatcov does in Traces_Files.Read_Trace_File_Gen: if the
+    trace file has a kernel, discard all trace entries until the loadaddr one
+    and then all trace entries below the load address.
+
+    :param entries: Iterable of TraceEntry instances for a trace file.
+    :param TraceInfoList infos: Trace infos for the same trace file.
+    """
+    entries = iter(entries)
+    offset = 0
+
+    # If there is a kernel, skip all trace entries until we get a loadaddr
+    # special one.
+    if InfoKind.Kernel_File_Name in infos.infos:
+        for e in entries:
+            if e.is_special:
+                assert e.size == TraceSpecial.Loadaddr, (
+                    'loadaddr special trace entry expected but got instead a'
+                    ' {:#x} special entry'.format(e.size)
+                )
+                assert e.pc != 0, 'Invalid loadaddr special trace entry'
+                offset = e.pc
+                break
+        else:
+            assert False, 'No loadaddr special trace entry'
+
+    shared_objects = SharedObjectTable()
+
+    # Now go through the remaining list of trace entries
+    for e in entries:
+        if e.is_special:
+            if e.size == TraceSpecial.LoadSharedObject:
+                shared_objects.load(SharedObject.from_entry(e))
+            elif e.size == TraceSpecial.UnloadSharedObject:
+                shared_objects.unload(e.pc)
+            else:
+                assert False, 'Unexpected special trace entry: {:#x}'.format(
+                    e.size
+                )
+            continue
+
+        # Discard trace entries for code below the module of interest
+        if e.pc < offset:
+            continue
+
+        shared_object = shared_objects.lookup(e.pc)
+        base = offset if shared_object is None else shared_object.first
+        yield (shared_object,
+               TraceEntry(e.bits, e.pc - base, e.size, e.op))
+
+
 def create_exec_infos(filename, code_size=None):
     """
     Create a TraceInfoList object to describe the given executable.
@@ -539,15 +1126,461 @@ def create_exec_infos(filename, code_size=None):
     return TraceInfoList({info.kind: info for info in infos})
 
 
-parser = argparse.ArgumentParser('Decode a binary trace file')
-parser.add_argument('--debug', '-d', action='store_true',
-                    help='Enable debug traces')
-parser.add_argument('trace-file', help='Binary trace file to decode')
+def add_entry_columns(tf, pcs, sizes, ops):
+    """
+    Append the pc, size and op fields for the trace entries of the `tf`
+    mapped trace file (see TraceFile.read_mapped) to the `pcs`, `sizes` and
+    `ops` arrays (of "Q", "H" and "B" items, see new_entry_columns).
+
+    Trace files that contain special trace entries are relocated first (see
+    TraceFile.iter_entries), so only their trace entries for the main module
+    are considered. Otherwise, columns are copied directly from
+    TraceEntryArray columns, so no TraceEntry instance is created.
+
+    Return whether trace entries were relocated.
+    """
+    if not tf.second_header:
+        return False
+
+    runs = tf.entries.runs
+    if (
+        InfoKind.Kernel_File_Name in tf.infos.infos
+        or len(runs) > 1
+        or any(run.find_special() is not None for run in runs)
+    ):
+        for e in tf.iter_entries():
+            pcs.append(e.pc)
+            sizes.append(e.size)
+            ops.append(e.op)
+        return True
+
+    for run in runs:
+        if run.bits == 64:
+            pcs.frombytes(run.pc.tobytes())
+        else:
+            pcs.extend(run.pc)
+        sizes.frombytes(run.size.tobytes())
+        ops.frombytes(run.op.tobytes())
+    return False
+
+
+def new_entry_columns():
+    """
+    Return empty (pcs, sizes, ops) arrays to hold the fields of trace entries.
+    """
+    return array('Q'), array('H'), array('B')
+
+
+def coalesce_entry_columns(pcs, sizes, ops):
+    """
+    Sort the trace entries described by the `pcs`, `sizes` and `ops` columns
+    by address and return new columns for them (see new_entry_columns),
+    coalescing the ones for the same address range into a single trace entry
+    whose op is the union of theirs.
+    """
+    # Pack each trace entry into a single integer, so that removing
+    # duplicates and sorting only compare integers. Ops are the low-order
+    # bits, so that trace entries for the same address range are contiguous
+    # once sorted.
+    keys = sorted({(pc << 24) | (size << 8) | op
+                   for pc, size, op in zip(pcs, sizes, ops)})
+
+    result_pcs, result_sizes, result_ops = new_entry_columns()
+    last_range = None
+    for key in keys:
+        address_range = key >> 8
+        if address_range == last_range:
+            result_ops[-1] |= key & 0xff
+            continue
+        result_pcs.append(key >> 24)
+        result_sizes.append(address_range & 0xffff)
+        result_ops.append(key & 0xff)
+        last_range = address_range
+    return result_pcs, result_sizes, result_ops
+
+
+def entry_array_from_columns(bits, pcs, sizes, ops):
+    """
+    Return a TraceEntryArray for little-endian trace entries with the given
+    `pcs`, `sizes` and `ops` columns, without creating TraceEntry instances.
+    """
+    pc_format, size_offset, op_offset = TRACE_ENTRY_LAYOUTS[bits]
+    entry_size = TraceEntry.struct(bits).size
+    if pc_format != pcs.typecode:
+        pcs = array(pc_format, pcs)
+    if sys.byteorder == 'big':
+        pcs = byteswapped(memoryview(pcs))
+        sizes = byteswapped(memoryview(sizes))
+
+    buf = memoryview(bytearray(entry_size * len(ops)))
+    pc_view = buf.cast(pc_format)
+    size_view = buf.cast('H')
+    pc_view[::entry_size // pc_view.itemsize] = pcs
+    size_view[size_offset // 2::entry_size // 2] = sizes
+    buf[op_offset::entry_size] = ops
+    pc_view.release()
+    size_view.release()
+    return TraceEntryArray(buf, bits)
+
+
+def merge_traces(filenames):
+    """
+    Merge the trace entries of the `filenames` trace files into a single flat
+    trace file. Return the corresponding TraceFile instance.
+
+    Trace entries for the same address range are coalesced into a single one
+    whose op is the union of theirs, and trace entries are sorted by address
+    (see coalesce_entry_columns). Trace infos come from the first trace file.
+    If some trace entries had to be relocated (see add_entry_columns), the
+    result has no kernel.
+
+    :param list[str] filenames: Trace files to merge. All of them must come
+        from the same executable.
+    """
+    first_trace = None
+    relocated = False
+
+    # Fields of all trace entries, duplicates included
+    pcs, sizes, ops = new_entry_columns()
+
+    for filename in filenames:
+        with TraceFile.read_mapped(filename) as tf:
+            if first_trace is None:
+                first_trace = tf
+            else:
+                check_mergeable(first_trace, tf, filename)
+            if add_entry_columns(tf, pcs, sizes, ops):
+                relocated = True
+
+    if first_trace is None:
+        raise ValueError('At least one trace file is required')
+
+    bits = first_trace.bits
+    entries = entry_array_from_columns(
+        bits, *coalesce_entry_columns(pcs, sizes, ops)
+    )
+
+    infos = dict(first_trace.infos.infos)
+    if relocated:
+        infos.pop(InfoKind.Kernel_File_Name, None)
+
+    header = first_trace.first_header
+    machine = (header[5] << 8) | header[6]
+    return TraceFile(
+        create_trace_header(TraceKind.Info, bits // 8, False, machine),
+        TraceInfoList(infos),
+        create_trace_header(TraceKind.Flat, bits // 8, False, machine),
+        entries
+    )
+
+
+def check_mergeable(reference, tf, filename):
+    """
+    Raise a ValueError if the `tf` trace file (read from `filename`) cannot
+    be merged with the `reference` trace file.
+    """
+    if tf.first_header[3:7] != reference.first_header[3:7]:
+        raise ValueError('{}: target mismatch'.format(filename))
+
+    ref_crc = reference.infos.infos.get(InfoKind.ExecFileCRC32)
+    crc = tf.infos.infos.get(InfoKind.ExecFileCRC32)
+    if ref_crc and crc and ref_crc.data != crc.data:
+        raise ValueError('{}: executable checksum mismatch'.format(filename))
+
+
+TRACE_INDEX_MAGIC = b'#QEMU-TraceIndex'
+"""
+Expected value of the magic header field in trace index files.
+"""
+
+TraceIndexHeaderStruct = Struct(
+    'trace index header',
+
+    ('magic', '16s'),
+    ('version', 'I'),
+
+    # Checksum and size of the indexed trace file
+    ('trace_crc32', 'I'),
+    ('trace_size', 'Q'),
+
+    # Number of indexed trace entries
+    ('count', 'Q'),
+)
+
+
+def file_checksum(filename):
+    """
+    Return a couple for the size and the CRC32 checksum of the `filename`
+    file.
+    """
+    size = 0
+    crc32 = 0
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            size += len(chunk)
+            crc32 = binascii.crc32(chunk, crc32)
+    return (size, crc32 & 0xffffffff)
+
+
+class TraceIndex(object):
+    """
+    Sidecar index for a trace file, to quickly answer address queries.
+
+    An index file contains the coalesced trace entries for the main module of
+    a trace file (see add_entry_columns and coalesce_entry_columns) as sorted
+    arrays, so that queries are binary searches in the memory-mapped index
+    file: nothing is decoded upfront. It also contains the size and the CRC32
+    checksum of the trace file, to detect when the index is stale.
+
+    An index file starts with a TraceIndexHeaderStruct header, followed by
+    four arrays of "count" little-endian items: start addresses (64-bit,
+    sorted), stop addresses (64-bit, excluded), running maximum of stop
+    addresses (64-bit) and ops (8-bit).
+    """
+
+    VERSION = 1
+
+    SUFFIX = '.idx'
+    """
+    Suffix to get the default index file name from a trace file name.
+    """
+
+    def __init__(self, mapping):
+        """
+        :param mmap.mmap mapping: Memory mapping for the index file. This
+            instance takes ownership of it.
+        """
+        self.mapping = mapping
+        if len(mapping) < TraceIndexHeaderStruct.size:
+            mapping.close()
+            raise ValueError('Truncated trace index file')
+        magic, version, self.trace_crc32, self.trace_size, count = (
+            TraceIndexHeaderStruct.read_values(BufferDecoder(mapping))
+        )
+        if magic != TRACE_INDEX_MAGIC or version != self.VERSION:
+            mapping.close()
+            raise ValueError('Invalid trace index file')
+        if len(mapping) != TraceIndexHeaderStruct.size + 25 * count:
+            mapping.close()
+            raise ValueError('Truncated trace index file')
+
+        view = memoryview(mapping)
+        offset = TraceIndexHeaderStruct.size
+        columns = []
+        for _ in range(3):
+            column = view[offset:offset + 8 * count].cast('Q')
+            if sys.byteorder == 'big':
+                swapped = byteswapped(column)
+                column.release()
+                column = swapped
+            columns.append(column)
+            offset += 8 * count
+        self.starts, self.stops, self.max_stops = columns
+        self.ops = view[offset:offset + count]
+        view.release()
+
+    @classmethod
+    def default_filename(cls, trace_filename):
+        return trace_filename + cls.SUFFIX
+
+    @classmethod
+    def load(cls, index_filename):
+        """
+        Memory-map the `index_filename` index file and return the
+        corresponding TraceIndex instance. Raise a ValueError if it is not a
+        valid index file.
+        """
+        with open(index_filename, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapping)
+
+    @classmethod
+    def write(cls, trace_filename, index_filename=None, checksum=None,
+              select=None):
+        """
+        Create the index file for the `trace_filename` trace file.
+
+        :param str|None index_filename: Name of the index file to write. If
+            None, use the default one (see default_filename).
+        :param (int, int)|None checksum: Result of file_checksum for
+            `trace_filename`, if already computed.
+        :param select: If not None, predicate that takes a trace entry op
+            and returns whether to index this trace entry. Trace entries are
+            selected before being coalesced.
+        """
+        index_filename = index_filename or cls.default_filename(
+            trace_filename
+        )
+        trace_size, trace_crc32 = checksum or file_checksum(trace_filename)
+
+        columns = new_entry_columns()
+        with TraceFile.read_mapped(trace_filename) as tf:
+            add_entry_columns(tf, *columns)
+        if select is not None:
+            selected = new_entry_columns()
+            for pc, size, op in zip(*columns):
+                if select(op):
+                    selected[0].append(pc)
+                    selected[1].append(size)
+                    selected[2].append(op)
+            columns = selected
+
+        starts, sizes, ops = coalesce_entry_columns(*columns)
+        stops = array('Q', map(operator.add, starts, sizes))
+        max_stops = array('Q', accumulate(stops, max))
+        if sys.byteorder == 'big':
+            for column in (starts, stops, max_stops):
+                column.byteswap()
+
+        # Write to a temporary file first, so that concurrent readers never
+        # see a partial index file.
+        tmp_filename = index_filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            TraceIndexHeaderStruct.write(f, (
+                TRACE_INDEX_MAGIC, cls.VERSION, trace_crc32, trace_size,
+                len(ops)
+            ))
+            for column in (starts, stops, max_stops, ops):
+                f.write(column.tobytes())
+        os.replace(tmp_filename, index_filename)
+
+    @classmethod
+    def open(cls, trace_filename, index_filename=None, update=True,
+             select=None):
+        """
+        Return a TraceIndex instance for the `trace_filename` trace file,
+        reusing its index file if it is up-to-date.
+
+        :param str|None index_filename: Name of the index file to use. If
+            None, use the default one (see default_filename).
+        :param bool update: If the index file is missing or stale, whether to
+            create it. If false, return None in this case.
+        :param select: See write. Index files do not record which trace
+            entries were selected: use a dedicated `index_filename` for each
+            predicate.
+        """
+        index_filename = index_filename or cls.default_filename(
+            trace_filename
+        )
+        checksum = file_checksum(trace_filename)
+
+        try:
+            index = cls.load(index_filename)
+        except (IOError, OSError, ValueError):
+            index = None
+        if index is not None:
+            if (index.trace_size, index.trace_crc32) == checksum:
+                return index
+            index.close()
+
+        if not update:
+            return None
+        cls.write(trace_filename, index_filename, checksum, select)
+        return cls.load(index_filename)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def is_executed(self, pc):
+        """
+        Return whether some indexed trace entry covers the `pc` address.
+        """
+        # All trace entries up to "index" start before or at pc: one of them
+        # covers pc iff the maximum of their stop addresses is past pc.
+        index = bisect.bisect_right(self.starts, pc)
+        return index > 0 and self.max_stops[index - 1] > pc
+
+    __contains__ = is_executed
+
+    def blocks_in(self, low, high):
+        """
+        Yield (start, stop, op) triplets for all indexed trace entries whose
+        address range [start, stop) intersects [low, high).
+        """
+        # Trace entries before "first" all stop before or at low, and trace
+        # entries starting from "last" all start after or at high.
+        first = bisect.bisect_right(self.max_stops, low)
+        last = bisect.bisect_left(self.starts, high)
+        for i in range(first, last):
+            start, stop = self.starts[i], self.stops[i]
+            if stop > max(low, start):
+                yield (start, stop, self.ops[i])
+
+    def close(self):
+        """
+        Release the memory mapping for the index file.
+        """
+        for column in (self.starts, self.stops, self.max_stops, self.ops):
+            if isinstance(column, memoryview):
+                column.release()
+        self.mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+parser = argparse.ArgumentParser('Process binary trace files')
+subparsers = parser.add_subparsers(dest='command')
+subparsers.required = True
+
+decode_parser = subparsers.add_parser(
+    'decode', help='Decode a binary trace file'
+)
+decode_parser.add_argument('--debug', '-d', action='store_true',
+                           help='Enable debug traces')
+decode_parser.add_argument('trace-file', help='Binary trace file to decode')
+
+merge_parser = subparsers.add_parser(
+    'merge', help='Merge binary trace files into a single flat trace file'
+)
+merge_parser.add_argument('--output', '-o', required=True,
+                          help='Trace file to write')
+merge_parser.add_argument('trace-files', nargs='+',
+                          help='Binary trace files to merge')
+
+index_parser = subparsers.add_parser(
+    'index', help='Create or update the sidecar index for a binary trace file'
+)
+index_parser.add_argument('--output', '-o',
+                          help='Index file to write (default: trace file name'
+                               ' plus "{}")'.format(TraceIndex.SUFFIX))
+index_parser.add_argument('trace-file', help='Binary trace file to index')
+
+
+def parse_args(argv=None):
+    """
+    Parse command-line arguments (`sys.argv` if `argv` is None). For
+    backward compatibility, a trace file given without command means the
+    "decode" command.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    positionals = [arg for arg in argv if not arg.startswith('-')]
+    if positionals and positionals[0] not in subparsers.choices:
+        argv = ['decode'] + argv
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
-    args = parser.parse_args()
-    with open(getattr(args, 'trace-file'), 'rb') as f:
-        tf = TraceFile.read(ByteStreamDecoder(f, args.debug, 4))
+    args = parse_args()
+
+    if args.command == 'decode':
+        with open(getattr(args, 'trace-file'), 'rb') as f:
+            tf = TraceFile.read(ByteStreamDecoder(f, args.debug, 4))
+
+        # TODO: add trace-file dump capabilities
+
+    elif args.command == 'merge':
+        tf = merge_traces(getattr(args, 'trace-files'))
+        with open(args.output, 'wb') as f:
+            tf.write(f)
 
-    # TODO: add trace-file dump capabilities
+    elif args.command == 'index':
+        with TraceIndex.open(getattr(args, 'trace-file'), args.output) as idx:
+            print('{} trace entries indexed'.format(len(idx)))
@@ -19,7 +19,7 @@ from e3.os.process import Run
 
 # Expose a few other items as a test util-facilities as well
 
-from SUITE import control
+from SUITE import buildcache, control
 from SUITE.control import (BUILDER, KNOWN_LANGUAGES, env, language_info,
                            xcov_pgm)
 from SUITE.context import ROOT_DIR, thistest
@@ -41,6 +41,9 @@ VALGRIND = 'valgrind' + env.host.os.exeext
 MEMCHECK_LOG = 'memcheck.log'
 CALLGRIND_LOG = 'callgrind-{}.log'
 
+BUILD_CACHE = (buildcache.BuildCache(thistest.options.build_cache)
+               if thistest.options.build_cache else None)
+
 run_processes = []
 """
 List of processes run through run_and_log. Useful for debugging.
@@ -157,6 +160,23 @@ def gprbuild_cargs_with(thiscargs, scovcargs=True, suitecargs=True):
     return lang_cargs + other_cargs
 
 
+def build_cache_tools(tools):
+    """
+    Identity of the TOOLS programs and of the testsuite support files, for
+    BUILD_CACHE keys.
+    """
+    return buildcache.tools_identity(tools, thistest.support_dir())
+
+
+def compiler_tools():
+    """
+    Names of the compiler drivers that gprbuild may use for test programs.
+    """
+    prefix = '%s-' % env.target.triplet if env.is_cross else ''
+    return [prefix + 'gcc' + env.host.os.exeext,
+            prefix + 'g++' + env.host.os.exeext]
+
+
 def gprbuild_largs_with(thislargs):
     """
     Compute and return all the largs gprbuild arguments to pass.  Account for
@@ -192,6 +212,9 @@ def gprbuild(project,
     the testsuite toplevel command line.
 
     OUT is the name of the file to contain gprbuild's output.
+
+    If a build cache is in use and PROJECT was generated by gprfor, reuse the
+    artifacts of an identical build if there is one.
     """
 
     # Fetch options, from what is requested specifically here
@@ -207,9 +230,22 @@ def gprbuild(project,
 
     args = (to_list(BUILDER.BASE_COMMAND) +
             ['-P%s' % project] + all_gargs + all_cargs + all_largs)
-    p = run_and_log(args, output=out, timeout=thistest.options.timeout)
-    thistest.stop_if(p.status != 0,
-                     FatalError("gprbuild exit in error", out))
+
+    def build():
+        p = run_and_log(args, output=out, timeout=thistest.options.timeout)
+        thistest.stop_if(p.status != 0,
+                         FatalError("gprbuild exit in error", out))
+        return True
+
+    projects = BUILD_CACHE and buildcache.project_closure(project)
+    if projects:
+        BUILD_CACHE.run(
+            'gprbuild', args, projects,
+            build_cache_tools(to_list(BUILDER.BASE_COMMAND)[:1] +
+                              compiler_tools()),
+            out, build)
+    else:
+        build()
 
 
 def gprinstall(project, prefix=None):
@@ -254,7 +290,8 @@ def gprfor(mains, prjid="gen", srcdirs="src", objdir=None, exedir=".",
     the end of the Compiler package contents. Add EXTRA, if any, at the end of
     the project file contents. Return the gpr file name.
     """
-    deps = '\n'.join('with "%s";' % dep for dep in deps)
+    deps = list(deps)
+    withs = '\n'.join('with "%s";' % dep for dep in deps)
 
     mains = to_list(mains)
     srcdirs = to_list(srcdirs)
@@ -275,8 +312,9 @@ def gprfor(mains, prjid="gen", srcdirs="src", objdir=None, exedir=".",
     # of tentative dirs while preventing complaints from gprbuild about
     # inexistent ones. Remove a lone trailing comma, which happens when none
     # of the provided dirs exists and would produce an invalid gpr file.
-    srcdirs = ', '.join('"%s"' % d for d in srcdirs if os.path.exists(d))
-    srcdirs = srcdirs.rstrip(', ')
+    srcdirs = [d for d in srcdirs if os.path.exists(d)]
+    gprsrcdirs = ', '.join('"%s"' % d for d in srcdirs)
+    gprsrcdirs = gprsrcdirs.rstrip(', ')
 
     # Determine the language(s) from the mains.
     languages_l = langs or set(language_info(main).name for main in mains)
@@ -307,18 +345,32 @@ def gprfor(mains, prjid="gen", srcdirs="src", objdir=None, exedir=".",
     gprtext = template % {
         'prjname': prjid,
         'extends': ('extends "%s"' % basegpr) if basegpr else "",
-        'srcdirs': srcdirs,
+        'srcdirs': gprsrcdirs,
         'exedir': exedir,
         'objdir': objdir or (exedir + "/obj"),
         'compswitches': compswitches,
         'languages': languages,
         'gprmains': gprmains,
-        'deps': deps,
+        'deps': withs,
         'compiler_extra': compiler_extra,
         'pkg_emulator': gpr_emulator_package(),
         'extra': extra}
 
-    return text_to_file(text=gprtext, filename=prjid + ".gpr")
+    thistest.use_files(os.path.join(ROOT_DIR, "template.gpr"), *srcdirs)
+    if basegpr:
+        thistest.use_files(thistest.support_dir())
+
+    gprfile = text_to_file(text=gprtext, filename=prjid + ".gpr")
+    if basegpr:
+        buildcache.register_support_project(basegpr)
+    buildcache.register_project(
+        gprfile, gprtext,
+        srcdirs=srcdirs,
+        objdir=objdir or (exedir + "/obj"),
+        exedir=exedir,
+        deps=deps,
+        extends=basegpr)
+    return gprfile
 
 
 # The following functions abstract away the possible presence of extensions at
@@ -7,6 +7,7 @@ Run the GNATcoverage testsuite
 See ./testsuite.py -h for more help
 """
 
+import logging
 import time
 import os
 import re
@@ -38,6 +39,12 @@ from SUITE.qdata import QLANGUAGES, QROOTDIR
 from SUITE.qdata import QSTRBOX_DIR, CTXDATA_FILE
 from SUITE.qdata import SUITE_context, TC_status, TOOL_info, OPT_info_from
 
+from SUITE import buildcache
+from SUITE.durations import DurationsDB
+from SUITE.impact import ImpactDB, changed_files_since
+from SUITE.iopool import IOPool
+from SUITE.testworker import TestPyWorkerPool
+
 import SUITE.control as control
 
 from SUITE.control import BUILDER
@@ -338,6 +345,12 @@ class TestPyRunner:
         # Load all relevant *.opt files to control the execution of this test
         self.test_control_creator = self.parse_opt()
 
+        # Pending post-run cleanup removals: list of (path, future)
+        self.cleanup_jobs = []
+
+        # Whether run_test went through, leaving the result to analyze_test
+        self.test_ran = False
+
     # Shortcuts to build paths, similar to
     # TestDriver.test_dir/TestDriver.working_dir.
 
@@ -453,6 +466,7 @@ class TestPyRunner:
             opt_files.append(test_opt)
 
         opt_files.extend(self.lookup_extra_opt())
+        self.opt_files = opt_files
 
         opt_lines = sum((lines_of(f) for f in opt_files), [])
 
@@ -551,6 +565,16 @@ class TestPyRunner:
         if mopt.pretty_print:
             testcase_cmd.append('--pretty-print')
 
+        if self.env.impact_db is not None:
+            testcase_cmd.append(
+                '--impact-file=%s' % self.working_dir('impact.json'))
+
+        # Qualification testcases must always build from scratch
+
+        if mopt.build_cache and not mopt.qualif_level:
+            testcase_cmd.append(
+                '--build-cache=%s' % os.path.abspath(mopt.build_cache))
+
         # --gnatcov_<cmd> family
 
         for pgm, cmd in control.ALTRUN_GNATCOV_PAIRS:
@@ -594,15 +618,31 @@ class TestPyRunner:
                         edir=self.test_dir())
 
         # Run the "test.py" script in the testsuite root directory (as
-        # expected: the script will change its own CWD later).
+        # expected: the script will change its own CWD later), either in a
+        # fresh interpreter or in a persistent worker.
         start_time = time.time()
-        self.test_py_process = Run(
-            self.testcase_cmd,
-            cwd=self.env.root_dir,
-            timeout=self.testcase_timeout)
+        if self.env.test_py_workers is not None:
+            self.test_py_process = self.env.test_py_workers.run(
+                self.testcase_cmd,
+                cwd=self.env.root_dir,
+                output=self.working_dir('test.py.output'),
+                timeout=self.testcase_timeout)
+        else:
+            self.test_py_process = Run(
+                self.testcase_cmd,
+                cwd=self.env.root_dir,
+                timeout=self.testcase_timeout)
         end_time = time.time()
 
         self.result.time = end_time - start_time
+        if self.env.durations_db is not None:
+            self.env.durations_db.record(self.result.test_name,
+                                         self.result.time)
+        if self.env.impact_db is not None:
+            self.env.impact_db.record(self.result.test_name,
+                                      self.driver.test_name,
+                                      self.opt_files,
+                                      self.working_dir('impact.json'))
 
         # To ease debugging, copy the consolidated standard outputs (stdout +
         # stderr) to the "test.py.err" file.
@@ -634,7 +674,7 @@ class TestPyRunner:
 
         # Perform post-run cleanups if requested so. Note that this may
         # alter the test execution status to make sure that unexpected cleanup
-        # failures get visibility:
+        # failures get visibility (see analyze):
 
         if (
             self.result.status != TestStatus.FAIL
@@ -646,16 +686,24 @@ class TestPyRunner:
             self.latch_status()
 
     def analyze(self):
+        # Turn post-run cleanup failures into test failures, so that they get
+        # visibility.
+        cleanups_ok = self.wait_post_run_cleanups()
+
         if self.test_py_failed:
             self.push_failure("test.py exitted with status code {}"
                               .format(self.test_py_process.status))
+        elif not cleanups_ok:
+            self.push_failure("Post-run cleanup failed (see {})"
+                              .format(self.errf()))
         elif cutils.match("==== PASSED ==================", self.outf()):
             self.push_success()
         else:
             self.push_failure("Missing PASSED tag in output file")
 
     def run_test(self, previous_values,  slot):
-        """Run the testcase, analyze its result and push the result."""
+        """Run the testcase. Its result is analyzed and pushed by
+        analyze_test."""
         try:
             self.test_control = self.test_control_creator.create(self.driver)
         except ValueError as exc:
@@ -670,10 +718,34 @@ class TestPyRunner:
             self.set_up()
             self.run()
             self.tear_down()
-            self.analyze()
         except TestAbortWithError as exc:
             self.push_error(str(exc))
             return
+        self.test_ran = True
+
+    def analyze_test(self, previous_values, slot):
+        """Analyze the result of the testcase run by run_test and push it.
+
+        This is a separate fragment so that the worker that ran the testcase
+        does not wait for its post-run cleanups: the removals proceed on the
+        I/O pool while other fragments run, and their outcome is checked
+        here."""
+        if not self.test_ran:
+            return
+
+        try:
+            self.analyze()
+        except TestAbortWithError as exc:
+            self.push_error(str(exc))
+
+    def add_fragments(self, dag, suffix=''):
+        """Add the fragments to run and analyze this testcase to DAG, on
+        behalf of the driver. SUFFIX makes fragment names unique when the
+        driver runs several testcases."""
+        run = 'run' + suffix
+        self.driver.add_fragment(dag, run, self.run_test)
+        self.driver.add_fragment(dag, 'analyze' + suffix, self.analyze_test,
+                                 after=[run])
 
     def push_success(self):
         """Set status to consider that the test passed."""
@@ -755,12 +827,11 @@ class TestPyRunner:
 
         return Run([handle_path, '/AcceptEULA', '-a', '-u', path]).out
 
-    def do_post_run_cleanups(self, ts_options):
-        """Cleanup temporary artifacts from the testcase directory.
-        Append removal failure info to the test error log. TS_OPTIONS
-        are the testsuite command line options."""
-
-        comments = []
+    def post_run_cleanup_paths(self, ts_options):
+        """Return the list of paths to filesystem entities we will want to
+        remove from the testcase directory, which may hold file or directory
+        names (to be removed entirely). TS_OPTIONS are the testsuite command
+        line options."""
 
         # In principle, most of this is the spawned test.py responsibilty,
         # because _it_ knows what it creates etc.  We have artifacts of our
@@ -772,85 +843,87 @@ class TestPyRunner:
         # runs. In particular, test execution logs and coverage reports which
         # might reside in temporary directories.
 
-        # List of paths to filesystem entities we will want to remove, which
-        # may hold file or directory names (to be removed entirely):
+        # Nothing in "obj" dirs ever needs to be preserved. For regular runs,
+        # we can also remove the scov test temp dirs as a whole. We can't
+        # remove these dirs in qualification runs because they hold
+        # subcommand execution logs and coverage reports which need to be
+        # preserved in qualification packages.
+        dir_prefixes = ('tmp', 'obj')
+        if not ts_options.qualif_level:
+            dir_prefixes += ('st_', 'dc_', 'mc_', 'uc_')
+
         cleanup_q = []
 
-        def cleanup_on_match(subdirs, prefixes, parent):
-            """
-            Helper for the filesystem walking code below, to facilitate the
-            processing of subdirectories. Queue for removal the subdirectories
-            of ``parent`` in ``subdirs`` which have a name starting with one
-            of the provided ``prefixes``, removing them from ``subdirs``.
-            """
-            to_clear = []
-            for sd in subdirs:
-                for prefix in prefixes:
-                    if sd.startswith(prefix):
-                        to_clear.append(sd)
-                        break
-            for sd in to_clear:
-                cleanup_q.append(os.path.join(parent, sd))
-                subdirs.remove(sd)
-
-        # Perform a filesystem walk to craft the list of items we
-        # can/should remove. Make it topdown so we can arrange not to
-        # recurse within subirectories we cleanup as a whole.
-        for dirpath, dirnames, filenames in (
-                os.walk(self.test_dir(), topdown=True)):
-
-            # Nothing in "obj" dirs ever needs to be preserved
-            cleanup_on_match(
-                subdirs=dirnames, prefixes=['tmp', 'obj'],
-                parent=dirpath)
-
-            # We can also always get rid of all the pure binary artifacts,
-            # wherever they are produced. Files without extension, most often
-            # executables, are considered never of interest.
-            for fn in filenames:
-                if (
-                    fn.endswith('.trace')
-                    or fn.endswith('.obj')
-                    or fn.endswith('.o')
-                    or fn.endswith('.exe')
-                    or '.' not in fn
-                ):
-                    cleanup_q.append(os.path.join(dirpath, fn))
-
-            # Then for regular runs, we can remove test execution logs and the
-            # scov test temp dirs as a whole. We can't remove these dirs in
-            # qualification runs because they hold subcommand execution logs
-            # and coverage reports which need to be preserved in qualification
-            # packages.
-            if not ts_options.qualif_level:
-                for fn in filenames:
-                    if (fn == 'test.py.log'):
-                        cleanup_q.append(os.path.join(dirpath, fn))
-
-                cleanup_on_match(
-                    subdirs=dirnames,
-                    prefixes=['st_', 'dc_', 'mc_', 'uc_'],
-                    parent=dirpath)
+        def is_cleanup_file(fn):
+            # We can always get rid of all the pure binary artifacts, wherever
+            # they are produced. Files without extension, most often
+            # executables, are considered never of interest. Then for regular
+            # runs, we can remove test execution logs.
+            return (
+                fn.endswith('.trace')
+                or fn.endswith('.obj')
+                or fn.endswith('.o')
+                or fn.endswith('.exe')
+                or '.' not in fn
+                or (not ts_options.qualif_level and fn == 'test.py.log')
+            )
+
+        # Scan the filesystem to craft the list of items we can/should
+        # remove, arranging not to recurse within subdirectories we cleanup
+        # as a whole (nor in symbolic links to directories, like os.walk).
+        def scan(dirpath):
+            subdirs = []
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if entry.name.startswith(dir_prefixes):
+                            cleanup_q.append(entry.path)
+                        elif not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif is_cleanup_file(entry.name):
+                        cleanup_q.append(entry.path)
+            for subdir in subdirs:
+                scan(subdir)
+
+        scan(self.test_dir())
+        return cleanup_q
+
+    def do_post_run_cleanups(self, ts_options):
+        """Queue the removal of temporary artifacts from the testcase
+        directory on the testsuite I/O pool, so that removals proceed in
+        parallel. See wait_post_run_cleanups for the outcome. TS_OPTIONS
+        are the testsuite command line options."""
+
+        # Issue separate rm requests for distinct filesystem entries, to be
+        # able to report removal failures precisely.
+        self.cleanup_jobs = [
+            (path, self.env.io_pool.submit(rm, path, recursive=True))
+            for path in sorted(set(self.post_run_cleanup_paths(ts_options)))
+        ]
+
+    def wait_post_run_cleanups(self):
+        """Wait for the removals queued by do_post_run_cleanups. Append
+        removal failure info to the test error log. Return whether all
+        removals succeeded."""
+
+        comments = []
 
         # Deal with occasional removal failures presumably caused by stray
-        # handles. Expand glob patterns locally, issue separate rm requests
-        # for distinct filesystem entries and turn exceptions from rm into
-        # test failures.
-        for path in set(cleanup_q):
-            try:
-                rm(path, recursive=True)
-            except Exception:
+        # handles.
+        for path, job in self.cleanup_jobs:
+            if job.exception() is not None:
                 handle_comment = self._handle_info_for(path)
-                self.passed = False
-                self.status = 'RMFAILED'
 
                 comments.append(
                     "Removal of %s failed\nHandle info follows:" % path)
                 comments.append(handle_comment)
+        self.cleanup_jobs = []
 
         with open(self.errf(), 'a') as f:
             f.write('\n'.join(comments))
 
+        return not comments
+
     # -------------------------
     # -- Testcase properties --
     # -------------------------
@@ -872,7 +945,7 @@ class TestPyDriver(TestDriver):
         self.runner = TestPyRunner(
             self, self.result, self.test_dir(), self.working_dir()
         )
-        self.add_fragment(dag, 'run', self.runner.run_test)
+        self.runner.add_fragments(dag)
 
 
 class GroupPyDriver(TestDriver):
@@ -915,7 +988,7 @@ class GroupPyDriver(TestDriver):
 
         result = TestResult(test_name, test_env)
         runner = TestPyRunner(self, result, test_dir, working_dir)
-        self.add_fragment(dag, "run_{}".format(index), runner.run_test)
+        runner.add_fragments(dag, "_{}".format(index))
 
 
 class GNATcovTestFinder(TestFinder):
@@ -1204,7 +1277,98 @@ class TestSuite(e3.testsuite.Testsuite):
         self.env.main_options = args
         self.env.discr_file = self._discriminants_log()
 
+        # Start persistent workers to run testcases only if requested, and
+        # never in qualification mode: each qualification testcase must run
+        # in its own fresh interpreter.
+        self.env.test_py_workers = (
+            TestPyWorkerPool(self.root_dir)
+            if args.persistent_workers and not args.qualif_level
+            else None)
+
+        # Thread pool for post-run cleanups, shared by all testcases
+        self.env.io_pool = IOPool() if args.do_post_run_cleanups else None
+
+        # Durations from previous runs, to schedule the longest testcases
+        # first and estimate the time left (see get_test_list). The database
+        # lives outside of the "new" and "old" output subdirectories, so that
+        # it is kept from one run to the other.
+        if args.durations_db is None:
+            args.durations_db = os.path.join(
+                os.path.abspath(args.output_dir), 'durations.json')
+        self.env.durations_db = (
+            DurationsDB(args.durations_db, self.env.suite_discriminants)
+            if args.durations_db
+            else None)
+
+        # Likewise for the files each testcase depends on, used to run only
+        # the testcases affected by a change (see get_test_list). Never record
+        # them in qualification mode: testcases must run exactly as specified
+        # there, without extra instrumentation, and all of them must run.
+        exit_if(args.impact_since and args.qualif_level,
+                '--impact-since is not supported in qualification mode')
+        if args.impact_db is None:
+            args.impact_db = os.path.join(
+                os.path.abspath(args.output_dir), 'impact.json')
+        self.env.impact_db = (
+            ImpactDB(args.impact_db, self.root_dir)
+            if args.impact_db and not args.qualif_level
+            else None)
+        exit_if(args.impact_since and self.env.impact_db is None,
+                '--impact-since requires an impact database (--impact-db)')
+
+    def get_test_list(self, sublist):
+        result = super(TestSuite, self).get_test_list(sublist)
+
+        if self.main.args.impact_since:
+            result = self._select_impacted(result)
+
+        # Dispatch testcases in longest-processing-time-first order, so that
+        # long testcases do not end up running alone at the end of the run.
+        if self.env.durations_db is not None:
+            result = self.env.durations_db.schedule(result)
+            self.env.durations_db.start_run(result, self.main.args.jobs)
+        return result
+
+    def _select_impacted(self, parsed_tests):
+        """
+        Return the subset of PARSED_TESTS that may be affected by changes
+        since the --impact-since commit, and write a report that explains
+        each selection to the "impact" output file.
+        """
+        changed_files = changed_files_since(self.main.args.impact_since,
+                                            self.root_dir)
+        selected, reasons = self.env.impact_db.select(parsed_tests,
+                                                      changed_files)
+
+        with open(os.path.join(self.output_dir, 'impact'), 'w') as f:
+            f.write('Changed files since {}:\n'
+                    .format(self.main.args.impact_since))
+            for filename in changed_files:
+                f.write('  {}\n'.format(filename))
+            f.write('\n{} out of {} tests selected:\n'
+                    .format(len(selected), len(parsed_tests)))
+            for t in selected:
+                f.write('{}\n'.format(t.test_name))
+                for reason in reasons[t.test_name]:
+                    f.write('  - {}\n'.format(reason))
+
+        logging.info('Test-impact selection: {} out of {} tests (see {})'
+                     .format(len(selected), len(parsed_tests),
+                             os.path.join(self.output_dir, 'impact')))
+        return selected
+
     def tear_down(self):
+        if getattr(self.env, 'test_py_workers', None) is not None:
+            self.env.test_py_workers.shutdown()
+        if getattr(self.env, 'durations_db', None) is not None:
+            self.env.durations_db.save()
+        if getattr(self.env, 'impact_db', None) is not None:
+            self.env.impact_db.save()
+        if getattr(self.env, 'io_pool', None) is not None:
+            self.env.io_pool.shutdown()
+        if self.main.args.build_cache:
+            buildcache.BuildCache(self.main.args.build_cache).evict(
+                self.main.args.build_cache_size)
         self.maybe_exec(bin=self.main.args.post_testsuite, edir="...")
 
     # -----------------------------------
@@ -1360,6 +1524,42 @@ class TestSuite(e3.testsuite.Testsuite):
             action='store_true',
             help='Request post-run cleanup of temporary artifacts.')
 
+        parser.add_argument(
+            '--persistent-workers', dest='persistent_workers',
+            action='store_true',
+            help='Run testcases in persistent worker processes, which keep'
+                 ' the SUITE/SCOV packages loaded, instead of starting a'
+                 ' fresh interpreter for each testcase. Ignored in'
+                 ' qualification mode.')
+
+        parser.add_argument(
+            '--build-cache-size', dest='build_cache_size', type=int,
+            default=buildcache.DEFAULT_MAX_SIZE, metavar='MIB',
+            help='Maximum size of the --build-cache directory, in MiB. The'
+                 ' least recently used entries are removed at the end of the'
+                 ' run. Defaults to %(default)s.')
+
+        parser.add_argument(
+            '--durations-db', dest='durations_db', metavar='FILE',
+            help='JSON file in which to record testcase durations, used to'
+                 ' run the longest testcases first and to estimate the time'
+                 ' left. Defaults to "durations.json" in the output'
+                 ' directory. Pass an empty string to disable.')
+
+        parser.add_argument(
+            '--impact-db', dest='impact_db', metavar='FILE',
+            help='JSON file in which to record the files each testcase'
+                 ' depends on, for --impact-since. Defaults to "impact.json"'
+                 ' in the output directory. Pass an empty string to'
+                 ' disable. Never used in qualification mode.')
+
+        parser.add_argument(
+            '--impact-since', dest='impact_since', metavar='GIT_REF',
+            help='Run only the tests that may be affected by changes in the'
+                 ' Git working tree since GIT_REF, according to the impact'
+                 ' database, and explain the selection in the "impact"'
+                 ' output file.')
+
         parser.add_argument(
             '--qualif-level', choices=list(QLEVEL_INFO),
             metavar='QUALIF_LEVEL',
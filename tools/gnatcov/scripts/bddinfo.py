@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
 import collections
+import concurrent.futures
+import os
+import os.path
 import re
+import struct
 import subprocess
 
+import metacache
+
 
 # These pattern expect no error from gnatcov output. They make a lot of
 # assumptions over its format.
@@ -39,6 +45,17 @@ EdgeInfo = collections.namedtuple('EdgeInfo',
     ' dest_kind'
 )
 
+class ShardScoNo(collections.namedtuple('ShardScoNo', 'shard sco_no')):
+    """SCO number that is local to a SCOs file, when BDD info is extracted
+    separately for each SCOs file in a list (see get_bdd_info). `shard` is the
+    1-based index of the SCOs file in the list.
+    """
+
+    __slots__ = ()
+
+    def __str__(self):
+        return '{}_{}'.format(self.shard, self.sco_no)
+
 BranchInfo = collections.namedtuple('BranchInfo',
     # SCO number and sloc for the corresponding condition
     'cond_sco_no'
@@ -49,6 +66,21 @@ BranchInfo = collections.namedtuple('BranchInfo',
 )
 
 
+# Layout of branch info in the metadata cache: condition SCO number, index of
+# the condition sloc range in the strings table, and then for both the
+# fallthrough and the branch edges: condition evaluation, destination kind
+# and destination payload (see EDGE_KINDS and BOOLEAN_CODES).
+BRANCH_RECORD = struct.Struct('=II' + 'BBi' * 2)
+EDGE_KINDS = [None, DestCondition, DestOutcome, DestRaiseException,
+              DestUnknown]
+BOOLEAN_CODES = [None, False, True]
+
+# Prefix for the names of BDD info files in the metadata cache (the digest of
+# the SCOs file comes next). Bump the version whenever the way BDD info is
+# extracted or stored changes, so that stale entries are not reused.
+BDD_CACHE_PREFIX = 'bddinfo-1'
+
+
 def parse_edge_info(raw_cond_eval, raw_dest_kind):
     """Parse edge info for given fields. Return an EdgeInfo field."""
 
@@ -84,26 +116,143 @@ def parse_edge_info(raw_cond_eval, raw_dest_kind):
     return EdgeInfo(cond_eval, dest_kind)
 
 
-def get_bdd_info(exe_filename, scos):
+def get_scos_shards(scos):
+    """Return the list of `--scos` arguments for which to run gnatcov
+    separately to get BDD info for `scos` one SCOs file at a time.
+
+    `scos` is either a single SCOs file, or a file that lists SCOs files
+    (prefixed with @): in the latter case, each SCOs file makes its own shard.
+    If there is no such file or if it is empty, `scos` is kept as is, for
+    gnatcov to handle it.
+    """
+    if not scos.startswith('@') or not os.path.isfile(scos[1:]):
+        return [scos]
+    with open(scos[1:]) as f:
+        scos_files = [line.strip() for line in f if line.strip()]
+    return scos_files or [scos]
+
+
+def get_bdd_info(exe_filename, scos, jobs=None):
     """Parse BDD info in `exe_filename` using its `scos`. Return a map from
     branch addresses to conditions SCO numbers and edges information.
+
+    If `jobs` is not None and `scos` lists several SCOs files, gnatcov is run
+    separately for each of them, in up to `jobs` processes in parallel (the
+    number of CPUs if 0), and the results are merged. Note that each run
+    still analyzes the whole executable, and that SCO numbers are then local
+    to each SCOs file: they are turned into ShardScoNo instances so that
+    conditions from different SCOs files do not clash.
+
+    The result for each SCOs file is cached on disk (see the metacache
+    module), for each content of the SCOs file, so that only the SCOs files
+    that changed are processed again.
+    """
+    shards = [scos] if jobs is None else get_scos_shards(scos)
+    shard_infos = [None] * len(shards)
+
+    # Caching is best effort (see MetadataCache.fetch): give up on it if the
+    # cache entry cannot be created.
+    cache = metacache.MetadataCache.from_environment()
+    cache_files = [None] * len(shards)
+    if cache is not None:
+        try:
+            entry_dir = cache.entry(exe_filename)
+        except (IOError, OSError):
+            cache = None
+    if cache is not None:
+        for i, shard in enumerate(shards):
+            # Only shards that are actual SCOs files can be digested: others
+            # (such as an empty @list) are not cached.
+            if not os.path.isfile(shard):
+                continue
+            try:
+                digest = cache.digest(shard)
+            except (IOError, OSError):
+                continue
+            cache_files[i] = os.path.join(
+                entry_dir, '{}-{}'.format(BDD_CACHE_PREFIX, digest)
+            )
+            try:
+                shard_infos[i] = load_bdd_info(cache_files[i])
+            except (IOError, OSError, ValueError):
+                pass
+
+    missing = [i for i, info in enumerate(shard_infos) if info is None]
+    if len(missing) == 1:
+        shard_infos[missing[0]] = compute_bdd_info(
+            exe_filename, shards[missing[0]]
+        )
+    elif missing:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs or os.cpu_count()
+        ) as executor:
+            futures = {
+                i: executor.submit(compute_bdd_info, exe_filename, shards[i])
+                for i in missing
+            }
+            for i, future in futures.items():
+                shard_infos[i] = future.result()
+
+    if cache is not None:
+        for i in missing:
+            if cache_files[i] is None:
+                continue
+            try:
+                metacache.atomic_write(
+                    cache_files[i],
+                    lambda f: dump_bdd_info(shard_infos[i], f)
+                )
+            except (IOError, OSError):
+                pass
+
+    if len(shard_infos) == 1:
+        return shard_infos[0]
+    result = {}
+    for shard, info in enumerate(shard_infos, 1):
+        result.update(shard_bdd_info(info, shard))
+    return result
+
+
+def shard_bdd_info(bdd_info, shard):
+    """Return a copy of `bdd_info` in which SCO numbers are turned into
+    ShardScoNo instances for the `shard` SCOs file.
     """
 
-    # Let gnatcov build the BDD for us.
+    def shard_edge(edge_info):
+        if edge_info is None or not isinstance(edge_info.dest_kind,
+                                               DestCondition):
+            return edge_info
+        return edge_info._replace(dest_kind=DestCondition(
+            ShardScoNo(shard, edge_info.dest_kind.sco_no)
+        ))
+
+    return {
+        pc: branch_info._replace(
+            cond_sco_no=ShardScoNo(shard, branch_info.cond_sco_no),
+            edge_fallthrough=shard_edge(branch_info.edge_fallthrough),
+            edge_branch=shard_edge(branch_info.edge_branch),
+        )
+        for pc, branch_info in bdd_info.items()
+    }
+
+
+def compute_bdd_info(exe_filename, scos):
+    """Uncached version of get_bdd_info, for a single gnatcov run."""
+
+    # Let gnatcov build the BDD for us, and parse its output as it is
+    # produced.
     proc = subprocess.Popen(
         [
             'gnatcov', 'map-routines', '-v',
             '--scos={}'.format(scos), exe_filename,
         ], stdout=subprocess.PIPE,
     )
-    outs, errs = proc.communicate()
-    if proc.returncode != 0:
-        raise RuntimeError('gnatcov map-routines returned an error')
 
     # Parse its output and collect information.
     cond_sco_nos = {}
     edge_infos = {}
-    for line in outs.split(b'\n'):
+    for line in proc.stdout:
+        line = line.rstrip(b'\n')
 
         m = COND_LINE.match(line)
         if m:
@@ -120,17 +269,21 @@ def get_bdd_info(exe_filename, scos):
             edge_infos[pc] = (
                 # Fallthrough edge
                 parse_edge_info(
-                    m.group('fallthrough_cond_eval'),
-                    m.group('fallthrough_dest_kind')
+                    m.group('fallthrough_cond_eval').decode('ascii'),
+                    m.group('fallthrough_dest_kind').decode('ascii')
                 ),
                 # Branch edge
                 parse_edge_info(
-                    m.group('branch_cond_eval'),
-                    m.group('branch_dest_kind'),
+                    m.group('branch_cond_eval').decode('ascii'),
+                    m.group('branch_dest_kind').decode('ascii'),
                 )
             )
             continue
 
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise RuntimeError('gnatcov map-routines returned an error')
+
     def get_edge_info(pc):
         try:
             return edge_infos[pc]
@@ -144,6 +297,64 @@ def get_bdd_info(exe_filename, scos):
         for pc, (cond_sco_no, cond_sloc_range) in cond_sco_nos.items()
     }
 
+
+def dump_bdd_info(bdd_info, fp):
+    """Write `bdd_info` to the `fp` cache file."""
+
+    def encode_edge(edge_info):
+        if edge_info is None:
+            return (0, 0, 0)
+        dest_kind = edge_info.dest_kind
+        if isinstance(dest_kind, DestCondition):
+            payload = dest_kind.sco_no
+        elif isinstance(dest_kind, DestOutcome):
+            payload = BOOLEAN_CODES.index(dest_kind.value)
+        else:
+            payload = 0
+        return (BOOLEAN_CODES.index(edge_info.cond_eval),
+                EDGE_KINDS.index(type(dest_kind)),
+                payload)
+
+    pcs = sorted(bdd_info)
+    strings = metacache.StringTable()
+    rows = []
+    for pc in pcs:
+        branch_info = bdd_info[pc]
+        rows.append(
+            (branch_info.cond_sco_no,
+             strings.index(branch_info.cond_sloc_range))
+            + encode_edge(branch_info.edge_fallthrough)
+            + encode_edge(branch_info.edge_branch)
+        )
+    metacache.write_table(fp, [pcs], BRANCH_RECORD, rows, strings)
+
+
+def load_bdd_info(filename):
+    """Load BDD info from the `filename` cache file."""
+
+    def decode_edge(cond_eval, kind, payload):
+        dest_kind = EDGE_KINDS[kind]
+        if dest_kind is None:
+            return None
+        elif dest_kind is DestCondition:
+            dest = DestCondition(payload)
+        elif dest_kind is DestOutcome:
+            dest = DestOutcome(BOOLEAN_CODES[payload])
+        else:
+            dest = dest_kind()
+        return EdgeInfo(BOOLEAN_CODES[cond_eval], dest)
+
+    def decode(index, fields):
+        return BranchInfo(
+            fields[0], strings[fields[1]],
+            decode_edge(*fields[2:5]), decode_edge(*fields[5:8])
+        )
+
+    (pcs, ), branch_infos, strings = metacache.map_table(
+        filename, 1, BRANCH_RECORD, decode
+    )
+    return dict(zip(pcs, branch_infos))
+
 if __name__ == '__main__':
     import sys
     for pc, br_info in get_bdd_info(sys.argv[1], sys.argv[2]).items():
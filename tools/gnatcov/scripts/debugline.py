@@ -0,0 +1,542 @@
+# -*- coding: utf-8 -*-
+
+"""Pure Python reader for line tables in ELF executables.
+
+This decodes the DWARF line number programs from the .debug_line section
+(DWARF versions 2 to 5) into sorted arrays of address ranges, lines, columns
+and discriminators. Compilation units are located eagerly (this just needs to
+read their length), but they are decoded only on demand.
+"""
+
+import array
+import collections
+import mmap
+import os.path
+import struct
+import zlib
+
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32, ELFCLASS64 = 1, 2
+ELFDATA2LSB, ELFDATA2MSB = 1, 2
+ET_REL = 1
+SHF_EXECINSTR = 0x4
+SHF_COMPRESSED = 0x800
+ELFCOMPRESS_ZLIB = 1
+
+# Standard opcodes
+DW_LNS_copy = 1
+DW_LNS_advance_pc = 2
+DW_LNS_advance_line = 3
+DW_LNS_set_file = 4
+DW_LNS_set_column = 5
+DW_LNS_negate_stmt = 6
+DW_LNS_set_basic_block = 7
+DW_LNS_const_add_pc = 8
+DW_LNS_fixed_advance_pc = 9
+DW_LNS_set_prologue_end = 10
+DW_LNS_set_epilogue_begin = 11
+DW_LNS_set_isa = 12
+
+# Extended opcodes
+DW_LNE_end_sequence = 1
+DW_LNE_set_address = 2
+DW_LNE_define_file = 3
+DW_LNE_set_discriminator = 4
+
+# Line number header entry formats (DWARF 5)
+DW_LNCT_path = 1
+DW_LNCT_directory_index = 2
+
+DW_FORM_block = 0x09
+DW_FORM_data1 = 0x0b
+DW_FORM_data2 = 0x05
+DW_FORM_data4 = 0x06
+DW_FORM_data8 = 0x07
+DW_FORM_data16 = 0x1e
+DW_FORM_line_strp = 0x1f
+DW_FORM_string = 0x08
+DW_FORM_strp = 0x0e
+DW_FORM_udata = 0x0f
+
+FIXED_SIZE_FORMS = {
+    DW_FORM_data1: 1,
+    DW_FORM_data2: 2,
+    DW_FORM_data4: 4,
+    DW_FORM_data8: 8,
+    DW_FORM_data16: 16,
+}
+
+Section = collections.namedtuple('Section', 'name flags addr offset size')
+
+
+class ELFFile(object):
+    """Minimal ELF reader: just enough to get section contents."""
+
+    def __init__(self, filename):
+        """
+        :param str filename: Name of the ELF file to read. It is mapped in
+            memory: call `close` to release it.
+        """
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        ident = self.mapping[:16]
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            raise ValueError('{}: not an ELF file'.format(filename))
+        elf_class, elf_data = ident[4], ident[5]
+        if elf_class not in (ELFCLASS32, ELFCLASS64):
+            raise ValueError('{}: invalid ELF class'.format(filename))
+        if elf_data not in (ELFDATA2LSB, ELFDATA2MSB):
+            raise ValueError('{}: invalid ELF data encoding'.format(filename))
+
+        self.bits = 32 if elf_class == ELFCLASS32 else 64
+        self.endian = '<' if elf_data == ELFDATA2LSB else '>'
+
+        if self.bits == 32:
+            header = struct.unpack_from(self.endian + 'HHIIIIIHHHHHH',
+                                        self.mapping, 16)
+            shdr_format = 'IIIIIIIIII'
+        else:
+            header = struct.unpack_from(self.endian + 'HHIQQQIHHHHHH',
+                                        self.mapping, 16)
+            shdr_format = 'IIQQQQIIQQ'
+        self.type = header[0]
+        shoff, shentsize, shnum, shstrndx = (
+            header[5], header[10], header[11], header[12]
+        )
+
+        raw_sections = [
+            struct.unpack_from(self.endian + shdr_format, self.mapping,
+                               shoff + i * shentsize)
+            for i in range(shnum)
+        ]
+        names_offset = raw_sections[shstrndx][4] if raw_sections else 0
+
+        self.sections = collections.OrderedDict()
+        for name_offset, _, flags, addr, offset, size in (
+            shdr[:6] for shdr in raw_sections
+        ):
+            name_start = names_offset + name_offset
+            name = self.mapping[
+                name_start:self.mapping.find(b'\0', name_start)
+            ].decode('ascii')
+            self.sections[name] = Section(name, flags, addr, offset, size)
+
+    def section_data(self, name):
+        """Return the content of the `name` section, or None if there is no
+        such section. Compressed sections are uncompressed.
+        """
+        try:
+            section = self.sections[name]
+        except KeyError:
+            return None
+        data = memoryview(self.mapping)[
+            section.offset:section.offset + section.size
+        ]
+        if section.flags & SHF_COMPRESSED:
+            # The compression header is followed by the compressed data
+            if self.bits == 32:
+                chdr_format, chdr_size = 'III', 12
+            else:
+                chdr_format, chdr_size = 'IIQQ', 24
+            ch_type = struct.unpack_from(self.endian + chdr_format, data)[0]
+            if ch_type != ELFCOMPRESS_ZLIB:
+                raise ValueError('{}: unsupported compression for {}'
+                                 .format(self.filename, name))
+            data = memoryview(zlib.decompress(data[chdr_size:]))
+        return data
+
+    def is_code_address(self, address):
+        """Return whether `address` is in an executable section."""
+        return any(
+            section.flags & SHF_EXECINSTR
+            and section.addr <= address < section.addr + section.size
+            for section in self.sections.values()
+        )
+
+    def close(self):
+        self.mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DataReader(object):
+    """Cursor to decode DWARF data from a buffer."""
+
+    def __init__(self, buf, endian, offset=0):
+        self.buf = buf
+        self.endian = endian
+        self.offset = offset
+        self.structs = {}
+
+    def unpack(self, fmt):
+        try:
+            structure = self.structs[fmt]
+        except KeyError:
+            structure = struct.Struct(self.endian + fmt)
+            self.structs[fmt] = structure
+        values = structure.unpack_from(self.buf, self.offset)
+        self.offset += structure.size
+        return values[0] if len(values) == 1 else values
+
+    def u8(self):
+        result = self.buf[self.offset]
+        self.offset += 1
+        return result
+
+    def uleb128(self):
+        result = shift = 0
+        while True:
+            byte = self.buf[self.offset]
+            self.offset += 1
+            result |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return result
+
+    def sleb128(self):
+        result = shift = 0
+        while True:
+            byte = self.buf[self.offset]
+            self.offset += 1
+            result |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                if byte & 0x40:
+                    result -= 1 << shift
+                return result
+
+    def unsigned(self, size):
+        return self.unpack({1: 'B', 2: 'H', 4: 'I', 8: 'Q'}[size])
+
+    def cstring(self):
+        end = self.offset
+        while self.buf[end] != 0:
+            end += 1
+        result = bytes(self.buf[self.offset:end])
+        self.offset = end + 1
+        return result
+
+
+def string_at(buf, offset):
+    """Return the null-terminated string at `offset` in `buf`."""
+    return DataReader(buf, '<', offset).cstring()
+
+
+LineTable = collections.namedtuple(
+    'LineTable', 'starts stops files lines columns discriminators'
+)
+"""Decoded line table for a compilation unit.
+
+All fields are parallel arrays, sorted by start address: rows cover the
+[start;stop[ address range. Files are indexes in the unit's `filenames`
+list. Columns and discriminators are 0 when they are not specified.
+"""
+
+
+class LineProgram(object):
+    """Line number program for a single compilation unit.
+
+    The program header and the program itself are decoded on first access.
+    """
+
+    def __init__(self, reader, offset, end, offset_size):
+        self.reader = reader
+        self.offset = offset
+        self.end = end
+        self.offset_size = offset_size
+        self._filenames = None
+        self._table = None
+
+    def _read_header(self, r):
+        """Read the program header from `r` (positionned just after the unit
+        length). Leave `r` at the start of the program.
+        """
+        self.version = r.unpack('H')
+        if not 2 <= self.version <= 5:
+            raise ValueError('unsupported line table version: {}'
+                             .format(self.version))
+        if self.version >= 5:
+            self.address_size = r.u8()
+            r.u8()  # segment_selector_size
+        else:
+            self.address_size = None
+
+        header_length = r.unsigned(self.offset_size)
+        program_start = r.offset + header_length
+
+        self.min_insn_length = r.u8()
+        self.max_ops_per_insn = r.u8() if self.version >= 4 else 1
+        self.default_is_stmt = r.u8()
+        self.line_base = r.unpack('b')
+        self.line_range = r.u8()
+        self.opcode_base = r.u8()
+        self.opcode_lengths = [0] + [
+            r.u8() for _ in range(self.opcode_base - 1)
+        ]
+
+        if self.version >= 5:
+            directories = [
+                self._entry_path(entry, directories=None)
+                for entry in self._read_entries(r)
+            ]
+            self._filenames = [
+                self._entry_path(entry, directories)
+                for entry in self._read_entries(r)
+            ]
+        else:
+            # Index 0 refers to the compilation directory, which is not part
+            # of the line table: use an empty prefix for it.
+            directories = [b'']
+            while True:
+                directory = r.cstring()
+                if not directory:
+                    break
+                directories.append(directory)
+
+            # File indexes start at 1
+            self._filenames = [b'']
+            while True:
+                filename = self._read_file_entry(r, directories)
+                if filename is None:
+                    break
+                self._filenames.append(filename)
+        self.directories = directories
+
+        r.offset = program_start
+
+    def _read_file_entry(self, r, directories):
+        """Read a file entry (DWARF 2-4 format) and return the corresponding
+        filename, or None if this is the end of the file names list.
+        """
+        filename = r.cstring()
+        if not filename:
+            return None
+        dir_index = r.uleb128()
+        r.uleb128()  # Modification time
+        r.uleb128()  # File length
+        return self._join(directories[dir_index], filename)
+
+    def _read_entries(self, r):
+        """Read a DWARF 5 list of directory or file entries. Return a list of
+        {content type: value} dicts.
+        """
+        formats = [(r.uleb128(), r.uleb128()) for _ in range(r.u8())]
+        return [
+            {content_type: self._read_form(r, form)
+             for content_type, form in formats}
+            for _ in range(r.uleb128())
+        ]
+
+    def _read_form(self, r, form):
+        if form == DW_FORM_string:
+            return r.cstring()
+        elif form == DW_FORM_line_strp:
+            return string_at(self.reader.line_str,
+                             r.unsigned(self.offset_size))
+        elif form == DW_FORM_strp:
+            return string_at(self.reader.str, r.unsigned(self.offset_size))
+        elif form == DW_FORM_udata:
+            return r.uleb128()
+        elif form == DW_FORM_block:
+            size = r.uleb128()
+            r.offset += size
+            return None
+        elif form in FIXED_SIZE_FORMS:
+            size = FIXED_SIZE_FORMS[form]
+            if size > 8:
+                r.offset += size
+                return None
+            return r.unsigned(size)
+        else:
+            raise ValueError('unsupported form in line table header: {:#x}'
+                             .format(form))
+
+    def _entry_path(self, entry, directories):
+        path = entry.get(DW_LNCT_path, b'')
+        if directories is None:
+            return path
+        return self._join(directories[entry.get(DW_LNCT_directory_index, 0)],
+                          path)
+
+    @staticmethod
+    def _join(directory, filename):
+        if not directory or os.path.isabs(filename):
+            return filename
+        return directory + b'/' + filename
+
+    @property
+    def filenames(self):
+        """List of filenames for this unit, indexed by file number."""
+        if self._filenames is None:
+            self.decode()
+        return self._filenames
+
+    def decode(self):
+        """Decode this line program and return the corresponding LineTable.
+        """
+        if self._table is not None:
+            return self._table
+
+        reader = self.reader
+        r = DataReader(reader.debug_line, reader.endian,
+                       self.offset + (12 if self.offset_size == 8 else 4))
+        self._read_header(r)
+
+        # In executables, sequences at address 0 come from code that was
+        # garbage collected by the linker: discard them, unless there is
+        # actual code at address 0 (as on some bare-metal targets).
+        discard_null_sequences = reader.discard_null_sequences
+
+        # Rows for the current sequence, and then for the whole unit
+        sequence = []
+        rows = []
+
+        def flush_sequence(end_address):
+            if sequence and not (discard_null_sequences
+                                 and base_address == 0):
+                # Each row ends where the next row at a different address
+                # starts: rows that share the same address get the same
+                # range.
+                stop = end_address
+                next_address = end_address
+                for row in reversed(sequence):
+                    if row[0] != next_address:
+                        stop = next_address
+                        next_address = row[0]
+                    rows.append((row[0], stop) + row[1:])
+            del sequence[:]
+
+        def reset():
+            return 0, 1, 1, 0, 0
+
+        address, file, line, column, discriminator = reset()
+        base_address = 0
+        opcode_base = self.opcode_base
+        line_base = self.line_base
+        line_range = self.line_range
+        min_insn_length = self.min_insn_length
+
+        buf = reader.debug_line
+        while r.offset < self.end:
+            opcode = buf[r.offset]
+            r.offset += 1
+
+            if opcode >= opcode_base:
+                adjusted = opcode - opcode_base
+                address += (adjusted // line_range) * min_insn_length
+                line += line_base + adjusted % line_range
+                sequence.append((address, file, line, column, discriminator))
+                discriminator = 0
+
+            elif opcode == 0:
+                length = r.uleb128()
+                next_offset = r.offset + length
+                ext_opcode = r.u8()
+                if ext_opcode == DW_LNE_end_sequence:
+                    flush_sequence(address)
+                    address, file, line, column, discriminator = reset()
+                    base_address = 0
+                elif ext_opcode == DW_LNE_set_address:
+                    address = base_address = r.unsigned(length - 1)
+                elif ext_opcode == DW_LNE_define_file:
+                    self._filenames.append(
+                        self._read_file_entry(r, self.directories)
+                    )
+                elif ext_opcode == DW_LNE_set_discriminator:
+                    discriminator = r.uleb128()
+                r.offset = next_offset
+
+            elif opcode == DW_LNS_copy:
+                sequence.append((address, file, line, column, discriminator))
+                discriminator = 0
+            elif opcode == DW_LNS_advance_pc:
+                address += r.uleb128() * min_insn_length
+            elif opcode == DW_LNS_advance_line:
+                line += r.sleb128()
+            elif opcode == DW_LNS_set_file:
+                file = r.uleb128()
+            elif opcode == DW_LNS_set_column:
+                column = r.uleb128()
+            elif opcode == DW_LNS_const_add_pc:
+                address += ((255 - opcode_base) // line_range
+                            * min_insn_length)
+            elif opcode == DW_LNS_fixed_advance_pc:
+                address += r.unpack('H')
+            elif opcode in (DW_LNS_negate_stmt, DW_LNS_set_basic_block,
+                            DW_LNS_set_prologue_end,
+                            DW_LNS_set_epilogue_begin):
+                pass
+            else:
+                # DW_LNS_set_isa and unknown standard opcodes: skip arguments
+                for _ in range(self.opcode_lengths[opcode]):
+                    r.uleb128()
+
+        rows.sort(key=lambda row: row[0])
+        self._table = LineTable(*(
+            array.array(typecode, column)
+            for typecode, column in zip(
+                ('Q', 'Q', 'I', 'I', 'I', 'I'),
+                zip(*rows) if rows else [()] * 6
+            )
+        ))
+        return self._table
+
+
+class DebugLineReader(object):
+    """Reader for the .debug_line section of an ELF file."""
+
+    def __init__(self, filename):
+        """
+        :param str filename: Name of the ELF file to read.
+        """
+        self.elf = ELFFile(filename)
+        self.elf_type = self.elf.type
+        self.discard_null_sequences = (
+            self.elf_type != ET_REL and not self.elf.is_code_address(0)
+        )
+        self.endian = self.elf.endian
+        self.debug_line = self.elf.section_data('.debug_line')
+        self.line_str = self.elf.section_data('.debug_line_str')
+        self.str = self.elf.section_data('.debug_str')
+        self._units = None
+
+    @property
+    def units(self):
+        """List of LineProgram for all compilation units."""
+        if self._units is None:
+            self._units = []
+            if self.debug_line is None:
+                return self._units
+
+            r = DataReader(self.debug_line, self.endian)
+            while r.offset < len(self.debug_line):
+                offset = r.offset
+                length = r.unpack('I')
+                if length == 0xffffffff:
+                    length = r.unpack('Q')
+                    offset_size = 8
+                else:
+                    offset_size = 4
+                end = r.offset + length
+                if end > len(self.debug_line):
+                    raise ValueError('truncated .debug_line section')
+                self._units.append(LineProgram(self, offset, end, offset_size))
+                r.offset = end
+        return self._units
+
+    def close(self):
+        self.debug_line = self.line_str = self.str = None
+        self.elf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -2,11 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import array
+import bisect
 import collections
+import concurrent.futures
+import json
 import os
+import os.path
 import re
 import struct
 import subprocess
+import sys
 
 import bddinfo
 import intervalmap
@@ -39,6 +45,11 @@ SlocRange = collections.namedtuple('SlocRange',
     ' start_line start_column'
     ' end_line end_column'
 )
+# SCOs lines that start a new unit, decision lines and conditions in them.
+SCOS_UNIT_LINE = re.compile('^C (?P<dep>\d+) (?P<filename>\S+)$')
+SCOS_DECISION_LINE = re.compile('^C[EGIPWXA]')
+SCOS_CONDITION = re.compile('(?:^|[ !&|])[cft](\d+):(\d+)-(\d+):(\d+)')
+
 AddressRange = collections.namedtuple('AddressRange', 'low high')
 AroundAddress = collections.namedtuple('AroundAddress', 'pc')
 Program = collections.namedtuple('Program', 'filename arch')
@@ -59,6 +70,11 @@ OBJDUMP_INSN = re.compile(
     '[ ]?(?:[ ]+(?P<operands>.+))?\n$'
 )
 
+# When disassembling only address windows, also disassemble this many bytes
+# past the end of each window, so that the instruction which follows the
+# window is known, just like when disassembling the whole program.
+WINDOW_LOOKAHEAD = 32
+
 OBJDUMP_DEST = re.compile('^(?P<pc>[0-9a-f]+) <(?P<symbol>[^>]+)>$')
 
 def does_raise_exception(symbol):
@@ -85,15 +101,76 @@ class Toolchain(object):
             program
         )
 
+InsnClass = collections.namedtuple('InsnClass',
+    'kind dest_operand dest_address'
+)
+# Classification of an instruction, which depends only on its mnemonic and
+# on the shape of its operands (see Arch.classify). `kind` is one of the
+# Arch.* kinds, or None for instructions that do not alter the control flow.
+# `dest_operand` is the index of the operand that holds the destination, or
+# None if the destination is not known statically. If `dest_address` is false,
+# only the destination symbol is relevant.
+
+NO_INSN_CLASS = InsnClass(None, None, False)
+NO_INSN_PROPERTIES = (None, None, None)
+
 class Arch(object):
+    """Base class for instruction classifiers.
+
+    Supporting a new architecture (ARM, AArch64, RISC-V, ...) requires a
+    subclass that implements `classify` (and `operand_shape` or
+    `split_operands` if the defaults do not fit), registered for its ELF
+    e_machine value with `register_arch`.
+
+    Classifications are cached per (architecture, mnemonic, operand shape), as
+    generated code tends to repeat the same instructions over and over.
+    Destination operands are not cached: they embed destination addresses,
+    so they seldom repeat.
+    """
+
     CALL = 'call'
     RET = 'ret'
     COND_RET = 'cond-ret'
     JUMP = 'jump'
     BRANCH = 'branch'
 
+    # Mapping: (arch, mnemonic, operand shape) -> InsnClass
+    insn_classes = {}
+
+    @classmethod
+    def operand_shape(cls, operands):
+        """Return a hashable summary of the `operands` string that, together
+        with the mnemonic, is enough to classify an instruction. By default,
+        the mnemonic alone is enough.
+        """
+        return None
+
+    @classmethod
+    def split_operands(cls, operands):
+        """Return the list of operands in the `operands` string."""
+        return operands.split(',')
+
+    @classmethod
+    def classify(cls, mnemonic, shape):
+        """Return the InsnClass for instructions with this `mnemonic` and
+        operands with this `shape` (see `operand_shape`).
+        """
+        raise NotImplementedError()
+
     @staticmethod
-    def get_insn_properties(insn):
+    def get_insn_dest(operand):
+        """Return the (address, symbol) destination in the `operand` string,
+        or (None, None) if it is not a static destination.
+        """
+        m = OBJDUMP_DEST.match(operand)
+        return (
+            (int(m.group('pc'), 16), m.group('symbol'))
+            if m else
+            (None, None)
+        )
+
+    @classmethod
+    def get_insn_properties(cls, insn):
         """Return:
             - (Arch.CALL, <subroutine addr>, <subroutine symbol>) for call
               instructions
@@ -106,7 +183,27 @@ class Arch(object):
             - (None, None, None) for all other instructions.
         When the destination address in unknown, None can be returned instead.
         """
-        raise NotImplementedError()
+        operands = insn.operands or ''
+        key = (cls, insn.mnemonic, cls.operand_shape(operands))
+        try:
+            insn_class = Arch.insn_classes[key]
+        except KeyError:
+            insn_class = cls.classify(insn.mnemonic, key[2])
+            Arch.insn_classes[key] = insn_class
+
+        if insn_class.kind is None:
+            return NO_INSN_PROPERTIES
+        elif insn_class.dest_operand is None:
+            return (insn_class.kind, None, None)
+
+        pc, symbol = Arch.get_insn_dest(
+            cls.split_operands(operands)[insn_class.dest_operand]
+        )
+        return (
+            insn_class.kind,
+            pc if insn_class.dest_address else None,
+            symbol
+        )
 
 class ArchX86(Arch):
     CALLS = set('call callq'.split())
@@ -117,137 +214,104 @@ class ArchX86(Arch):
         ' jne jng jnge jnl jnle jno jnp jns jnz jo jp jpe jpo js jz'.split()
     )
 
-    @staticmethod
-    def get_insn_dest(insn):
-        if insn.operands.startswith('*'):
-            # TODO: handle rip-relative jumps
-            return (None, None)
-        else:
-            m = OBJDUMP_DEST.match(insn.operands)
-            if m:
-                return (
-                    int(m.group('pc'), 16),
-                    m.group('symbol')
-                )
-            else:
-                return (None, None)
-
-    @staticmethod
-    def get_insn_properties(insn):
-        if insn.mnemonic in ArchX86.RETS:
-            return (Arch.RET, None, None)
-        elif insn.mnemonic in ArchX86.JUMPS:
-            return (Arch.JUMP, ) + ArchX86.get_insn_dest(insn)
-        elif insn.mnemonic in ArchX86.BRANCHES:
-            return (Arch.BRANCH, ) + ArchX86.get_insn_dest(insn)
-        elif insn.mnemonic in ArchX86.CALLS:
-            _, symbol = ArchX86.get_insn_dest(insn)
-            return (Arch.CALL, None, symbol)
+    @classmethod
+    def operand_shape(cls, operands):
+        # Indirect jumps and calls have a "*" prefix.
+        # TODO: handle rip-relative jumps
+        return operands.startswith('*')
+
+    @classmethod
+    def split_operands(cls, operands):
+        return [operands]
+
+    @classmethod
+    def classify(cls, mnemonic, indirect):
+        dest_operand = None if indirect else 0
+        if mnemonic in ArchX86.RETS:
+            return InsnClass(Arch.RET, None, False)
+        elif mnemonic in ArchX86.JUMPS:
+            return InsnClass(Arch.JUMP, dest_operand, True)
+        elif mnemonic in ArchX86.BRANCHES:
+            return InsnClass(Arch.BRANCH, dest_operand, True)
+        elif mnemonic in ArchX86.CALLS:
+            return InsnClass(Arch.CALL, dest_operand, False)
         else:
-            return (None, None, None)
+            return NO_INSN_CLASS
 
 class ArchPPC32(Arch):
-    @staticmethod
-    def get_insn_dest(operand):
-        m = OBJDUMP_DEST.match(operand)
-        if m:
-            return (
-                int(m.group('pc'), 16),
-                m.group('symbol')
-            )
-        else:
-            return (None, None)
+    @classmethod
+    def operand_shape(cls, operands):
+        # Conditional branches have the condition register first, unless it
+        # is cr0.
+        return ' ' in operands.partition(',')[0]
 
-    @staticmethod
-    def get_insn_properties(insn):
-        if not insn.mnemonic.startswith('b'):
-            return (None, None, None)
+    @classmethod
+    def classify(cls, mnemonic, dest_first):
+        if not mnemonic.startswith('b'):
+            return NO_INSN_CLASS
 
         # Strip prediction any hint.
-        mnemonic = insn.mnemonic.rstrip('+-')
+        mnemonic = mnemonic.rstrip('+-')
 
         # Branch can go to an absolute address, to the link register or to the
         # control register.
-        dest_in_reg = False
-        return_from_subroutine = False
         if mnemonic.endswith('l') or mnemonic.endswith('la'):
             # Branch and Link (call)
             if 'ctr' in mnemonic:
                 # To ConTrol Register (destination known at runtime)
-                symbol = None
+                return InsnClass(Arch.CALL, None, False)
             elif mnemonic.startswith('blr'):
                 # To Link Register (anyway this is a call, *not* a return)
-                symbol = None
+                return InsnClass(Arch.CALL, None, False)
             else:
-                _, symbol = ArchPPC32.get_insn_dest(insn.operands.split(',')[0])
-            return (Arch.CALL, None, symbol)
+                return InsnClass(Arch.CALL, 0, False)
         elif mnemonic.endswith('lr'):
             # To Link Register (return)
             if mnemonic != 'blr':
-                return (Arch.COND_RET, None, None)
+                return InsnClass(Arch.COND_RET, None, False)
             else:
-                return (Arch.RET, None, None)
+                return InsnClass(Arch.RET, None, False)
         elif mnemonic.endswith('ctr'):
             # To ConTrol Register (destination known at runtime)
-            return (Arch.BRANCH, None, None)
+            return InsnClass(Arch.BRANCH, None, False)
         elif mnemonic.endswith('a'):
             mnemonic = mnemonic[:-1]
 
-        operands = insn.operands.split(',')
-        if ' ' in operands[0]:
-            pc, symbol = ArchPPC32.get_insn_dest(operands[0])
-        else:
-            pc, symbol = ArchPPC32.get_insn_dest(operands[1])
-
-        return (
+        return InsnClass(
             Arch.BRANCH if mnemonic != 'b' else Arch.JUMP,
-            pc, symbol
+            0 if dest_first else 1, True
         )
 
 class ArchSPARC32(Arch):
-    @staticmethod
-    def get_insn_dest(operand):
-        m = OBJDUMP_DEST.match(operand)
-        if m:
-            return (
-                int(m.group('pc'), 16),
-                m.group('symbol')
-            )
+    @classmethod
+    def classify(cls, mnemonic, shape):
+        if mnemonic.startswith('b') and mnemonic != 'b':
+            return InsnClass(Arch.BRANCH, 0, True)
+        elif mnemonic in ('jmp', 'b'):
+            return InsnClass(Arch.JUMP, 0, True)
+        elif mnemonic == 'call':
+            return InsnClass(Arch.CALL, 0, True)
+        elif mnemonic == 'ret':
+            return InsnClass(Arch.RET, None, False)
         else:
-            return (None, None)
+            return NO_INSN_CLASS
 
-    @staticmethod
-    def get_insn_properties(insn):
-        if insn.mnemonic.startswith('b') and insn.mnemonic != 'b':
-            addr, symbol = ArchSPARC32.get_insn_dest(
-                insn.operands.split(',')[0]
-            )
-            return (Arch.BRANCH, addr, symbol)
-        elif insn.mnemonic in ('jmp', 'b'):
-            addr, symbol = ArchSPARC32.get_insn_dest(
-                insn.operands.split(',')[0]
-            )
-            return (Arch.JUMP, addr, symbol)
-        elif insn.mnemonic == 'call':
-            addr, symbol = ArchSPARC32.get_insn_dest(
-                insn.operands.split(',')[0]
-            )
-            return (Arch.CALL, addr, symbol)
-        elif insn.mnemonic == 'ret':
-            return (Arch.RET, None, None)
-        else:
-            return (None, None, None)
-
-ARCHITECTURES = {
-    # SPARC 32bit
-    2:  ArchSPARC32,
-    # x86
-    3:  ArchX86,
-    # PowerPC 32bit
-    20: ArchPPC32,
-    # x86_64
-    62: ArchX86,
-}
+ARCHITECTURES = {}
+
+def register_arch(machine, arch):
+    """Use the `arch` Arch subclass for programs whose e_machine ELF header
+    field is `machine`.
+    """
+    ARCHITECTURES[machine] = arch
+
+# SPARC 32bit
+register_arch(2, ArchSPARC32)
+# x86
+register_arch(3, ArchX86)
+# PowerPC 32bit
+register_arch(20, ArchPPC32)
+# x86_64
+register_arch(62, ArchX86)
 
 def which(program):
     """Return whether `program` is in the PATH."""
@@ -373,6 +437,86 @@ def slocs_match_range(slocs, sloc_range):
     # decision.
     return False
 
+def merge_windows(windows):
+    """Return the sorted list of address windows that covers all `windows`,
+    merging the ones that are too close to be disassembled separately (see
+    WINDOW_LOOKAHEAD).
+    """
+    result = []
+    for low, high in sorted(windows):
+        if result and low < result[-1][1] + WINDOW_LOOKAHEAD:
+            result[-1] = (result[-1][0], max(result[-1][1], high))
+        else:
+            result.append((low, high))
+    return result
+
+def get_symbol_windows(symbols, ranges):
+    """Return the sorted list of address windows to disassemble to get the
+    instructions in the `(low, high)` address `ranges`, given the `symbols`
+    interval tree (see syminfo.get_sym_info).
+
+    Windows are extended to cover the symbols they overlap, and the clones
+    that GCC makes of these symbols (`<name>.cold`, `<name>.part.0`, ...), so
+    that jumps and branches that come from the same subprograms are part of
+    the windows, too. Windows also start at the symbol that precedes them, so
+    that instructions which fall through into them are known.
+    """
+    # Address ranges for the symbols of each subprogram, clones included
+    clones = collections.defaultdict(list)
+    for low_high, symbol in symbols.items():
+        clones[symbol.name.partition('.')[0]].append(low_high)
+    # Symbols sorted by end address, to find the one that precedes an address
+    by_high = sorted((high, low) for (low, high), _ in symbols.items())
+    highs = [high for high, _ in by_high]
+
+    def symbol_windows(low, high):
+        for (sym_low, sym_high), symbol in symbols.overlapping(low, high):
+            low = min(low, sym_low)
+            high = max(high, sym_high)
+            yield from clones[symbol.name.partition('.')[0]]
+        yield (low, high)
+
+    windows = []
+    for low, high in ranges:
+        for low, high in symbol_windows(low, high):
+            index = bisect.bisect_right(highs, low) - 1
+            if index >= 0:
+                low = by_high[index][1]
+            windows.append((low, high))
+
+    return merge_windows(windows)
+
+def parse_scos_decisions(filename):
+    """Return the sloc ranges of all decisions in the `filename` SCOs file
+    (i.e. an ALI file), as a list of SlocRange.
+
+    The sloc range of a decision goes from the start of its first condition to
+    the end of its last one.
+    """
+    result = []
+    unit_filename = None
+    with open(filename, encoding='latin-1') as f:
+        for line in f:
+            m = SCOS_UNIT_LINE.match(line)
+            if m:
+                unit_filename = m.group('filename')
+                continue
+
+            if unit_filename is None or not SCOS_DECISION_LINE.match(line):
+                continue
+            conditions = [
+                tuple(int(bound) for bound in condition)
+                for condition in SCOS_CONDITION.findall(line)
+            ]
+            if conditions:
+                start = min(condition[:2] for condition in conditions)
+                end = max(condition[2:] for condition in conditions)
+                result.append(SlocRange(
+                    unit_filename.encode('latin-1'),
+                    start[0], start[1], end[0], end[1]
+                ))
+    return result
+
 class Locations(object):
     """Gather information about code matching criterias."""
 
@@ -384,35 +528,65 @@ class Locations(object):
     ):
         self.symbols = symbols
         self.matched_symbols = set(matched_symbols)
-        self.matched_addresses = intervalmap.IntervalMap()
+        self.matched_addresses = intervalmap.IntervalTree()
         for low, high in matched_addr_ranges:
             self.matched_addresses[low:high] = True
-        # TODO: matching slocs may be more efficient using an interval map. The
-        # only thing to do is to flatten the given list... (interval maps do
-        # not handle overlapping elements)
-        self.matched_sloc_ranges = matched_sloc_ranges
+        # Index sloc ranges by line so that only the ones that cover a given
+        # line are checked.
+        self.matched_sloc_ranges = intervalmap.IntervalTree()
+        for sloc_range in matched_sloc_ranges:
+            self.matched_sloc_ranges[
+                sloc_range.start_line:sloc_range.end_line + 1
+            ] = sloc_range
 
     def match(self, slocs, address):
         """Return if any sloc or the symbol corresponding to the
         given address is matched by criterias.
         """
-        try:
-            symbol = self.symbols[address].name
-        except KeyError:
-            symbol = None
-        if symbol in self.matched_symbols:
-            return True
+        for symbol in self.symbols.at(address):
+            if symbol.name in self.matched_symbols:
+                return True
         if address in self.matched_addresses:
             return True
-        for sloc_range in self.matched_sloc_ranges:
-            if slocs_match_range(slocs, sloc_range):
-                return True
+        return self.match_slocs(slocs)
+
+    def match_slocs(self, slocs):
+        """Return if any sloc is matched by criterias."""
+        for sloc in slocs:
+            for sloc_range in self.matched_sloc_ranges.at(sloc.line):
+                if slocs_match_range([sloc], sloc_range):
+                    return True
         return False
 
+    def get_address_windows(self, sloc_info):
+        """Return the sorted list of `(low, high)` address windows that
+        contain all matched instructions.
 
-class Insn:
+        Windows are extended to cover related symbols: see
+        get_symbol_windows.
+        """
+        ranges = [
+            (low, high)
+            for (low, high), symbol in self.symbols.items()
+            if symbol.name in self.matched_symbols
+        ]
+        ranges.extend(low_high
+                      for low_high, _ in self.matched_addresses.items())
+        if len(self.matched_sloc_ranges):
+            ranges.extend(low_high
+                          for low_high, sloc in sloc_info.items()
+                          if self.match_slocs([sloc]))
+
+        return get_symbol_windows(self.symbols, ranges)
+
+
+class Insn(object):
     """A single instruction. It knows if it ends a basic block and which are
     its execution successors."""
+
+    __slots__ = ('pc', 'next_pc', 'mnemonic', 'operands', 'slocs',
+                 'successors', 'ends_basic_block')
+
     def __init__(self, pc, mnemonic, operands, slocs=None):
         self.pc = pc
         self.next_pc = None
@@ -438,6 +612,201 @@ class Insn:
             self.pc, self.mnemonic, self.operands
         )
 
+class InsnTable(object):
+    """Compact storage for instructions: one row per instruction, stored in
+    parallel arrays. Basic block ends are stored as a bitmap.
+
+    Instructions are built as Insn objects and added with `append` once they
+    are complete. `insn` then gives access to rows through InsnRow views,
+    which have the same interface as Insn objects.
+    """
+
+    # Stands for None in address arrays
+    NO_PC = (1 << 64) - 1
+
+    def __init__(self):
+        self.pcs = array.array('Q')
+        self.next_pcs = array.array('Q')
+        # Mnemonics and slocs are shared among instructions: rows contain
+        # indexes in the `mnemonics` and `slocs` lists.
+        self.mnemonic_indexes = array.array('I')
+        self.mnemonics = []
+        self.mnemonic_to_index = {}
+        self.sloc_indexes = array.array('I')
+        self.slocs = []
+        self.slocs_to_index = {}
+        self.operands = []
+        # Instructions have at most two successors: the fallthrough one and
+        # the jump/branch destination.
+        self.successor_counts = bytearray()
+        self.successors = array.array('Q')
+        self.basic_block_ends = bytearray()
+        # Mapping: row index -> InsnRow, for the rows accessed so far
+        self.views = {}
+
+    def __len__(self):
+        return len(self.pcs)
+
+    @staticmethod
+    def _intern(value, key, values, value_to_index):
+        try:
+            return value_to_index[key]
+        except KeyError:
+            result = len(values)
+            values.append(value)
+            value_to_index[key] = result
+            return result
+
+    def _encode_pc(self, pc):
+        return self.NO_PC if pc is None else pc
+
+    def _decode_pc(self, pc):
+        return None if pc == self.NO_PC else pc
+
+    def append(self, insn):
+        """Add a row for `insn` and return its index."""
+        index = len(self.pcs)
+        self.pcs.append(insn.pc)
+        self.next_pcs.append(self._encode_pc(insn.next_pc))
+        self.mnemonic_indexes.append(self._intern(
+            insn.mnemonic, insn.mnemonic,
+            self.mnemonics, self.mnemonic_to_index
+        ))
+        self.sloc_indexes.append(self._intern(
+            insn.slocs, tuple(insn.slocs or ()),
+            self.slocs, self.slocs_to_index
+        ))
+        self.operands.append(insn.operands)
+
+        assert len(insn.successors) <= 2
+        self.successor_counts.append(len(insn.successors))
+        for i in range(2):
+            self.successors.append(self._encode_pc(
+                insn.successors[i] if i < len(insn.successors) else None
+            ))
+
+        if index % 8 == 0:
+            self.basic_block_ends.append(0)
+        if insn.ends_basic_block:
+            self.end_basic_block(index)
+        return index
+
+    def get_successors(self, index):
+        return [
+            self._decode_pc(self.successors[2 * index + i])
+            for i in range(self.successor_counts[index])
+        ]
+
+    def add_successor(self, index, pc, first=False):
+        successors = self.get_successors(index)
+        if first:
+            successors.insert(0, pc)
+        else:
+            successors.append(pc)
+        assert len(successors) <= 2
+        self.successor_counts[index] = len(successors)
+        for i, successor in enumerate(successors):
+            self.successors[2 * index + i] = self._encode_pc(successor)
+
+    def ends_basic_block(self, index):
+        return bool(self.basic_block_ends[index // 8] & (1 << (index % 8)))
+
+    def end_basic_block(self, index):
+        self.basic_block_ends[index // 8] |= 1 << (index % 8)
+
+    def insn(self, index):
+        """Return the InsnRow view for the `index` row."""
+        try:
+            return self.views[index]
+        except KeyError:
+            result = self.views[index] = InsnRow(self, index)
+            return result
+
+class InsnRow(object):
+    """View over a row of an InsnTable, with the same interface as Insn.
+    Changes made through it are stored in the table.
+    """
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def pc(self):
+        return self.table.pcs[self.index]
+
+    @property
+    def next_pc(self):
+        return self.table._decode_pc(self.table.next_pcs[self.index])
+
+    @property
+    def mnemonic(self):
+        return self.table.mnemonics[self.table.mnemonic_indexes[self.index]]
+
+    @property
+    def operands(self):
+        return self.table.operands[self.index]
+
+    @property
+    def slocs(self):
+        return self.table.slocs[self.table.sloc_indexes[self.index]]
+
+    @property
+    def successors(self):
+        return tuple(self.table.get_successors(self.index))
+
+    @property
+    def ends_basic_block(self):
+        return self.table.ends_basic_block(self.index)
+
+    def add_successor(self, pc, end_basic_block=False, first=False):
+        self.table.add_successor(self.index, pc, first)
+        if end_basic_block:
+            self.end_basic_block()
+
+    def end_basic_block(self):
+        self.table.end_basic_block(self.index)
+
+    def __repr__(self):
+        return 'InsnRow({:x} {} {})'.format(
+            self.pc, self.mnemonic, self.operands
+        )
+
+class BasicBlock(object):
+    """Sequence of instructions (InsnRow views) for a basic block of an
+    InsnTable.
+    """
+
+    __slots__ = ('table', 'rows', 'start', 'stop')
+
+    def __init__(self, table, rows, start, stop):
+        """
+        :param InsnTable table: Table that contains the instructions.
+        :param array.array rows: Array of row indexes in `table`.
+        :param int start: Index in `rows` of the first instruction.
+        :param int stop: Index in `rows` past the last instruction.
+        """
+        self.table = table
+        self.rows = rows
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('instruction index out of range')
+        return self.table.insn(self.rows[self.start + index])
+
+    def __iter__(self):
+        for i in range(self.start, self.stop):
+            yield self.table.insn(self.rows[i])
+
 class EdgesSet:
 
     def __init__(self):
@@ -460,21 +829,220 @@ class EdgesSet:
             return False
 
 
-def get_decision_cfg(program, toolchain, sloc_info, locations):
-    get_insn_properties = program.arch.get_insn_properties
-
-    # Let objdump disassemble the program for us...
-    args = [toolchain.objdump, '-d', program.filename]
-    print('Disassembling: {}'.format(args))
+def disassemble_window(toolchain, filename, window):
+    """Disassemble the `filename` program in the given `(low, high)` address
+    window and return objdump's output. Also disassemble WINDOW_LOOKAHEAD
+    more bytes.
+    """
+    low, high = window
     proc = subprocess.Popen(
-        args,
+        [
+            toolchain.objdump, '-d',
+            '--start-address={:#x}'.format(low),
+            '--stop-address={:#x}'.format(high + WINDOW_LOOKAHEAD),
+            filename,
+        ],
         stdin=open(os.devnull, 'rb'), stdout=subprocess.PIPE
     )
+    outs, _ = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError('objdump returned an error')
+    return outs
+
+
+def disassemble(program, toolchain, windows=None):
+    """Disassemble `program` and yield `(pc, mnemonic, operands)` tuples
+    for its instructions, in address order.
+
+    If `windows` is None, disassemble the whole program. Otherwise, it must be
+    a sorted list of disjoint `(low, high)` address windows to disassemble
+    (see Locations.get_address_windows). Windows are disassembled in parallel
+    and, for each window, yield the instructions it contains plus the one that
+    follows it, if any. Yield None before each window, as instructions may be
+    missing between windows.
+    """
+    if windows is None:
+        # Let objdump disassemble the program for us...
+        args = [toolchain.objdump, '-d', program.filename]
+        sys.stderr.write('Disassembling: {}\n'.format(args))
+        proc = subprocess.Popen(
+            args,
+            stdin=open(os.devnull, 'rb'), stdout=subprocess.PIPE
+        )
+        while True:
+            # Read as many lines as possible from objdump
+            line = proc.stdout.readline().decode('ascii')
+            if not line:
+                break
+
+            # Process instructions only
+            m = OBJDUMP_INSN.match(line)
+            if m:
+                yield (
+                    int(m.group('pc'), 16),
+                    m.group('mnemonic'), m.group('operands')
+                )
+        return
+
+    sys.stderr.write('Disassembling {} address window(s) with {}\n'.format(
+        len(windows), toolchain.objdump
+    ))
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=os.cpu_count()
+    ) as executor:
+        outputs = executor.map(
+            lambda window: disassemble_window(toolchain, program.filename,
+                                              window),
+            windows
+        )
+        for (_, high), outs in zip(windows, outputs):
+            yield None
+            for line in outs.decode('ascii').splitlines(True):
+                m = OBJDUMP_INSN.match(line)
+                if not m:
+                    continue
+                pc = int(m.group('pc'), 16)
+                yield (pc, m.group('mnemonic'), m.group('operands'))
+                # Stop after the first instruction past the window
+                if pc >= high:
+                    break
+
+
+class Disassembly(object):
+    """Disassembled address windows, to build the CFG of several decisions
+    while running objdump only once.
+    """
+
+    def __init__(self, program, toolchain, windows=None):
+        """Disassemble the given `windows` of `program` (see `disassemble`).
+
+        If `windows` is None, disassemble the whole program and consider it as
+        a single window.
+        """
+        whole_program = windows is None
+        self.windows = [(0, 1 << 64)] if whole_program else windows
+        self.window_starts = [low for low, _ in self.windows]
+        # For each window, columns for its instructions: addresses, and
+        # indexes in the `mnemonics` and `operands` lists, which are shared
+        # by all instructions.
+        self.pcs = []
+        self.mnemonic_indexes = []
+        self.operand_indexes = []
+        self.mnemonics = []
+        self.mnemonic_to_index = {}
+        self.operands = []
+        self.operands_to_index = {}
+        if whole_program:
+            self._add_window()
+        for insn in disassemble(program, toolchain, windows):
+            if insn is None:
+                self._add_window()
+                continue
+            pc, mnemonic, operands = insn
+            self.pcs[-1].append(pc)
+            self.mnemonic_indexes[-1].append(InsnTable._intern(
+                mnemonic, mnemonic, self.mnemonics, self.mnemonic_to_index
+            ))
+            self.operand_indexes[-1].append(InsnTable._intern(
+                operands, operands, self.operands, self.operands_to_index
+            ))
+
+    def _add_window(self):
+        self.pcs.append(array.array('Q'))
+        self.mnemonic_indexes.append(array.array('I'))
+        self.operand_indexes.append(array.array('I'))
+
+    def partition(self, arch, ranges):
+        """Return the instructions to take into account for each item of
+        `ranges`, a list of lists of `(low, high)` address ranges.
+
+        For each item, this is the sorted list of `(window, row)` positions
+        (see `instructions`) for: the instructions in the address ranges,
+        the ones just before and after them, and the jumps/branches to the
+        address ranges with the instructions that follow them. These are the
+        only instructions that get_decision_cfg looks at to build the CFG of
+        the code in these address ranges.
+
+        All instructions are visited only once, whatever the number of items
+        in `ranges`.
+        """
+        tree = intervalmap.IntervalTree()
+        for index, item_ranges in enumerate(ranges):
+            for low, high in item_ranges:
+                tree[low:high] = index
+
+        result = [set() for _ in ranges]
+        for window, pcs in enumerate(self.pcs):
+            mnemonic_indexes = self.mnemonic_indexes[window]
+            operand_indexes = self.operand_indexes[window]
+            count = len(pcs)
+            for row, pc in enumerate(pcs):
+                for index in tree.at(pc):
+                    result[index].update(
+                        (window, around)
+                        for around in range(max(row - 1, 0),
+                                            min(row + 2, count))
+                    )
+
+                insn_type, dest, _ = arch.get_insn_properties(Insn(
+                    pc,
+                    self.mnemonics[mnemonic_indexes[row]],
+                    self.operands[operand_indexes[row]],
+                ))
+                if (
+                    dest is None or
+                    insn_type not in (Arch.JUMP, Arch.BRANCH, Arch.COND_RET)
+                ):
+                    continue
+                for index in tree.at(dest):
+                    result[index].update(
+                        (window, after)
+                        for after in range(row, min(row + 2, count))
+                    )
+
+        return [sorted(positions) for positions in result]
+
+    def instructions(self, positions):
+        """Yield the instructions at the given sorted `(window, row)`
+        positions (see `partition`), like `disassemble` does: None comes
+        before each run of consecutive instructions.
+        """
+        last_position = None
+        for window, row in positions:
+            if last_position != (window, row - 1):
+                yield None
+            last_position = (window, row)
+            yield (
+                self.pcs[window][row],
+                self.mnemonics[self.mnemonic_indexes[window][row]],
+                self.operands[self.operand_indexes[window][row]],
+            )
+
+
+def get_decision_cfg(program, toolchain, sloc_info, locations, windows=None,
+                     instructions=None):
+    """Build the CFG for instructions matched by `locations`.
 
-    # ... and filter instructions in the given sloc range.
-    # This list will contain the list of instructions we are interested in.
-    instructions = []
-    outside_instructions = {}
+    If `windows` is not None, disassemble only these address windows (see
+    `disassemble`). Note that in this case, jumps to the decision from
+    instructions outside the windows are not taken into account, so the CFG
+    can differ from the one built from the whole program, for instance when
+    another subprogram tail-calls the decision's one. If `instructions` is not
+    None, take instructions from this iterable (see Disassembly.instructions)
+    instead of running objdump.
+    """
+    get_insn_properties = program.arch.get_insn_properties
+
+    # Filter instructions in the given sloc range.
+    # Instructions we are interested in are stored in this table once they
+    # are complete, i.e. once the next instruction has been processed.
+    table = InsnTable()
+    # Rows in `table` for instructions that belong to the decision.
+    rows = array.array('I')
+    # Addresses of instructions outside of the decision that we are interested
+    # in anyway, and the corresponding rows in `table`.
+    outside_pcs = set()
+    outside_rows = {}
     uncoverable_edges = EdgesSet()
     # And this will contain addresses of instructions that must start a basic
     # block.
@@ -488,22 +1056,32 @@ def get_decision_cfg(program, toolchain, sloc_info, locations):
     last_instruction_in_decision = False
     last_instruction = None
 
-    while True:
-        # Read as many lines as possible from objdump
-        line = proc.stdout.readline().decode('ascii')
-        if not line:
-            break
-
-        # Process instructions only
-        m = OBJDUMP_INSN.match(line)
-        if not m:
+    def store_last_instruction():
+        """Store the last instruction in `table` if we are interested in it."""
+        if last_instruction is None:
+            return
+        elif last_instruction_in_decision:
+            rows.append(table.append(last_instruction))
+        elif last_instruction.pc in outside_pcs:
+            outside_rows[last_instruction.pc] = table.append(last_instruction)
+
+    for fields in (
+        disassemble(program, toolchain, windows)
+        if instructions is None else
+        instructions
+    ):
+        if fields is None:
+            # Instructions are missing here: the next one cannot be the
+            # successor of the last one.
+            store_last_instruction()
+            last_instruction_can_fallthrough = False
+            last_instruction_raises_exception = False
+            last_instruction_in_decision = False
+            last_instruction = None
             continue
 
-        pc = int(m.group('pc'), 16)
-        insn = Insn(
-            pc, m.group('mnemonic'), m.group('operands'),
-            sloc_info.get(pc, [])
-        )
+        pc, mnemonic, operands = fields
+        insn = Insn(pc, mnemonic, operands, sloc_info.get(pc, []))
         if last_instruction:
             last_instruction.next_pc = pc
         sloc_in_decision = locations.match(insn.slocs, pc)
@@ -514,14 +1092,15 @@ def get_decision_cfg(program, toolchain, sloc_info, locations):
             if sloc_in_decision and not last_instruction_in_decision:
                 # Here, the previous instruction was not in the decision, but
                 # we are interested in it anyway.
-                outside_instructions[last_instruction.pc] = last_instruction
+                outside_pcs.add(last_instruction.pc)
 
-        # Add this instruction if it belongs to the decision.
-        if sloc_in_decision:
-            instructions.append(insn)
-        elif last_instruction_can_fallthrough and last_instruction_in_decision:
-            # Out of the decision: end the previous basic block if needed.
-            instructions[-1].end_basic_block()
+        # Out of the decision: end the previous basic block if needed.
+        if (
+            not sloc_in_decision and
+            last_instruction_can_fallthrough and
+            last_instruction_in_decision
+        ):
+            last_instruction.end_basic_block()
 
         if (
             last_instruction_raises_exception and
@@ -546,10 +1125,13 @@ def get_decision_cfg(program, toolchain, sloc_info, locations):
                     # If the current instruction is outside, remember it
                     # anyway.
                     if not sloc_in_decision:
-                        outside_instructions[insn.pc] = insn
+                        outside_pcs.add(insn.pc)
         elif insn_type == Arch.RET or raises_exception:
             insn.end_basic_block()
 
+        # The last instruction is now complete.
+        store_last_instruction()
+
         # Update "last_*" information for the next iteration.
         last_instruction_can_fallthrough = (
             insn_type not in (Arch.RET, Arch.JUMP)
@@ -557,170 +1139,36 @@ def get_decision_cfg(program, toolchain, sloc_info, locations):
         last_instruction_raises_exception = raises_exception
         last_instruction_in_decision = sloc_in_decision
         last_instruction = insn
+    store_last_instruction()
 
     # Break basic blocks for instructions that must start one.
-    for insn in instructions:
+    for row in rows:
         if any(
             successor in basic_block_starters
-            for successor in insn.successors
+            for successor in table.get_successors(row)
         ):
-            insn.end_basic_block()
+            table.end_basic_block(row)
 
     # Convert the instructions list to a graph data structure.
     cfg = {}
-    current_bb_pc = None
-    current_bb = []
-    for insn in instructions:
-        if not current_bb:
-            current_bb_pc = insn.pc
-        current_bb.append(insn)
-        if insn.ends_basic_block:
-            cfg[current_bb_pc] = current_bb
-            current_bb = []
-    if current_bb:
-        cfg[current_bb_pc] = current_bb
-    # Now, dangling edges are jumps/branches destinations that are out of the
-    # decision.
-    return cfg, uncoverable_edges, outside_instructions
-
-
-if __name__ == '__main__':
-    import sys
-
-    parser = argparse.ArgumentParser(
-        description='Build the CFG for some decision in a program'
-    )
-    parser.add_argument(
-        '-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
-        dest='output',
-        help='File to output the dot graph to (default: stdout)'
-    )
-    parser.add_argument(
-        '--target', dest='toolchain', type=parse_target, default=None,
-        help=(
-            'Prefix used to reach the toolchain'
-            ' (example: powerpc-elf for powerpc-elf-objdump)'
-        )
-    )
-    parser.add_argument(
-        '-T', '--format', default=None,
-        help='If given, call dot to produce the actual output passing it'
-        ' this argument'
-    )
-    parser.add_argument(
-        '-b', '--basename', action='store_true',
-        help='Only print basename in source locations'
-    )
-    parser.add_argument(
-        '-B', '--bdd', dest='scos',
-        help='Use SCOS to display the binary decision diagram (BDD)'
-    )
-    parser.add_argument(
-        '-k', '--keep-uncoverable-edges', dest='keep_uncoverable_edges',
-        action='store_true',
-        help='Do not strip edges that are supposed to be uncoverable due to'
-        ' exceptions'
-    )
-    parser.add_argument(
-        '-t', '--traces', dest='traces',
-        help='Use a set of traces to hilight executed instructions'
-    )
-    parser.add_argument(
-        'program', type=parse_program,
-        help='The program to analyse'
-    )
-    parser.add_argument(
-        'location', type=parse_location, nargs='+',
-        help=(
-            'Location of the decision to analyse.'
-            ' Can be a sloc range (example: 10:5-11:21),'
-            ' a symbol name (example: ada__text_io__put_line__2),'
-            ' an address range (example: 0x200..0x300)'
-            ' or the symbol around some address (example: @0x0808f31a)'
-        )
-    )
-
-    args = parser.parse_args()
-
-    # Create the default toolchain only when needed, since it may raise an
-    # exception when some tool is not available.
-    if args.toolchain is None:
-        args.toolchain = parse_target(None)
-
-    # If asked to, start dot to format the output.
-    if args.format:
-        with open(os.devnull, 'wb') as devnull:
-            dot_process = subprocess.Popen(
-                ['dot', '-T{}'.format(args.format), '-o', args.output.name],
-                stdin=subprocess.PIPE, stdout=devnull
+    current_bb_start = 0
+    for i, row in enumerate(rows):
+        if table.ends_basic_block(row) or i + 1 == len(rows):
+            cfg[table.pcs[rows[current_bb_start]]] = BasicBlock(
+                table, rows, current_bb_start, i + 1
             )
-        args.output.close()
-        f = dot_process.stdin
-    else:
-        f = args.output
-
-    sym_info, overlap_syms = syminfo.get_sym_info(args.program.filename)
-
-    if overlap_syms:
-        sys.stderr.write('warning: some symbols overlap with others:\n')
-        for sym in overlap_syms:
-            sys.stderr.write('  - {}\n'.format(syminfo.format_symbol(sym)))
-
-    # Build accepted locations
-    accepted_symbols = []
-    accepted_slocs = []
-    accepted_addr_ranges = []
-    for loc in args.location:
-        if isinstance(loc, syminfo.Symbol):
-            accepted_symbols.append(loc.name)
-        elif isinstance(loc, AddressRange):
-            accepted_addr_ranges.append(loc)
-        elif isinstance(loc, SlocRange):
-            accepted_slocs.append(loc)
-        elif isinstance(loc, AroundAddress):
-            try:
-                symbol = sym_info[loc.pc]
-            except KeyError:
-                sys.stderr.write('No symbol around: {:#08x}\n'.format(loc.pc))
-                sys.exit(1)
-            accepted_symbols.append(symbol.name)
-        else:
-            # We are not supposed to end up here since args.location items come
-            # from arguments parsing.
-            assert False
-
-    locations = Locations(
-        sym_info,
-        accepted_symbols,
-        accepted_addr_ranges,
-        accepted_slocs
-    )
-
-    sloc_info = slocinfo.get_sloc_info(args.program.filename)
-    decision_cfg, uncoverable_edges, outside_insns = get_decision_cfg(
-        args.program, args.toolchain,
-        sloc_info, locations
-    )
+            current_bb_start = i + 1
+    outside_instructions = {
+        pc: table.insn(row) for pc, row in outside_rows.items()
+    }
+    return cfg, uncoverable_edges, outside_instructions
 
-    # Load the BDD if asked to. Reminder: this is a map:
-    #   branch instruction adresss -> branch info (associated condition and
-    #   edges info).
-    bdd_info = (
-        bddinfo.get_bdd_info(args.program.filename, args.scos)
-        if args.scos is not None else
-        {}
-    )
 
-    # Load traces if asked to.
-    executed_insns, leave_flags = (
-        traceinfo.get_trace_info(args.traces)
-        if args.traces is not None else
-        (None, None)
-    )
-    trace_info = executed_insns is not None
-
-    # Use the BDD, and especially its EXCEPTION edges info to tag as
-    # uncoverable the successors of basic blocks that raise an exception.
+def tag_exception_edges(decision_cfg, uncoverable_edges, bdd_info):
+    """Use the BDD, and especially its EXCEPTION edges info to tag as
+    uncoverable (i.e. add to `uncoverable_edges`) the successors of basic
+    blocks that raise an exception.
+    """
     for pc, basic_block in decision_cfg.items():
         last_insn = basic_block[-1]
         try:
@@ -747,6 +1195,88 @@ if __name__ == '__main__':
         check_edge(branch_info.edge_fallthrough, last_insn.successors[0])
         check_edge(branch_info.edge_branch, last_insn.successors[1])
 
+
+def get_bb_condition(decision_cfg, bdd_info, basic_block):
+    """Return the condition the basic block belongs to or None if there is no
+    such condition. Return also the branch info corresponding to the ending
+    branch instruction, if any.
+    """
+    visited_pc = {basic_block[0].pc}
+
+    def helper(basic_block):
+        last_insn = basic_block[-1]
+        try:
+            branch_info = bdd_info[last_insn.pc]
+        except KeyError:
+            # Return the condition of the next basic block, if there is only
+            # one successor.
+            if len(last_insn.successors) == 1:
+                # But do not recurse endlessly.
+                next_pc = last_insn.successors[0]
+                if next_pc not in visited_pc:
+                    visited_pc.add(next_pc)
+                    try:
+                        next_basic_block = decision_cfg[next_pc]
+                    except KeyError:
+                        pass
+                    else:
+                        return helper(next_basic_block)[0], None
+            # By default, return that we got nothing.
+            return None, None
+        else:
+            return (branch_info.cond_sco_no, branch_info)
+
+    return helper(basic_block)
+
+
+def get_successor_edges(insn):
+    """Return the list of (kind, destination) couples for the edges that leave
+    `insn`.
+    """
+    successors = insn.successors
+    if len(successors) == 1:
+        # This is an unconditionnal jump (or a mere fallthrough).
+        return [(JUMP, successors[0])]
+    elif len(successors) == 2:
+        # This is a branch: the first one is the fallthrough, the second one
+        # is the branch destination.
+        return [(FALLTHROUGH, successors[0]), (BRANCH, successors[1])]
+    else:
+        return []
+
+
+def is_edge_covered(branch_insn, kind, executed_insns, leave_flags):
+    """Return whether the `kind` edge that leaves `branch_insn` was executed
+    according to traces (see traceinfo.get_trace_info).
+    """
+    if kind == JUMP:
+        return branch_insn.pc in executed_insns
+    try:
+        flags = leave_flags[branch_insn.next_pc]
+    except KeyError:
+        return False
+    return (
+        (kind == FALLTHROUGH and flags.fallthrough)
+        or (kind == BRANCH and flags.branch)
+    )
+
+
+def write_cfg_dot(
+    f, decision_cfg, uncoverable_edges, outside_insns,
+    sloc_info, bdd_info, executed_insns, leave_flags,
+    basename=False, keep_uncoverable_edges=False
+):
+    """Write to `f` the dot graph for a decision CFG (see get_decision_cfg),
+    and then close `f`.
+
+    `bdd_info` is a BDD info map (see bddinfo.get_bdd_info), possibly empty.
+    `executed_insns` and `leave_flags` come from traceinfo.get_trace_info, or
+    are None if there are no traces.
+    """
+    trace_info = executed_insns is not None
+
+    tag_exception_edges(decision_cfg, uncoverable_edges, bdd_info)
+
     # Mapping: condition SCO number -> list of dot nodes. Used to sort basic
     # blocks per decision. Basic blocks that are not associated to any
     # condition are filed under the None list. When the BDD is not loaded,
@@ -768,38 +1298,6 @@ if __name__ == '__main__':
         else:
             return 'bb_{:x}'.format(pc)
 
-    def get_bb_condition(basic_block):
-        """Return the condition the basic block belongs to or None if there is
-        no such condition. Return also the branch info corresponding to the
-        ending branch instruction, if any.
-        """
-        visited_pc = {basic_block[0].pc}
-
-        def helper(basic_block):
-            last_insn = basic_block[-1]
-            try:
-                branch_info = bdd_info[last_insn.pc]
-            except KeyError:
-                # Return the condition of the next basic block, if there is
-                # only one successor.
-                if len(last_insn.successors) == 1:
-                    # But do not recurse endlessly.
-                    next_pc = last_insn.successors[0]
-                    if next_pc not in visited_pc:
-                        visited_pc.add(next_pc)
-                        try:
-                            next_basic_block = decision_cfg[next_pc]
-                        except KeyError:
-                            pass
-                        else:
-                            return helper(next_basic_block)[0], None
-                # By default, return that we got nothing.
-                return None, None
-            else:
-                return (branch_info.cond_sco_no, branch_info)
-
-        return helper(basic_block)
-
     def format_edge_info(edge_info, condition):
         if edge_info is None:
             return ['???']
@@ -824,21 +1322,9 @@ if __name__ == '__main__':
         return result or None
 
     def format_edge_color(branch_insn, kind, uncoverable):
-        if trace_info:
-            if kind == JUMP:
-                covered = branch_insn.pc in executed_insns
-            else:
-                try:
-                    flags = leave_flags[branch_insn.next_pc]
-                except KeyError:
-                    covered = False
-                else:
-                    covered = (
-                        (kind == FALLTHROUGH and flags.fallthrough)
-                        or (kind == BRANCH and flags.branch)
-                    )
-        else:
-            covered = False
+        covered = trace_info and is_edge_covered(
+            branch_insn, kind, executed_insns, leave_flags
+        )
         return (
             (COLOR_WARNING if uncoverable else COLOR_COVERED)
             if covered else
@@ -900,22 +1386,16 @@ if __name__ == '__main__':
     def process_successor_edges(from_pc, insn, labels):
         def process_edge(kind, to_pc, label):
             uncoverable = (insn.pc, to_pc) in uncoverable_edges
-            if args.keep_uncoverable_edges or not uncoverable:
+            if keep_uncoverable_edges or not uncoverable:
                 add_edge(
                     from_pc, to_pc, label,
                     format_edge_color(insn, kind, uncoverable),
                     STYLES[kind]
                 )
 
-        successors = insn.successors
-        if len(successors) == 1:
-            # This is an unconditionnal jump (or a mere fallthrough).
-            process_edge(JUMP, successors[0], None)
-        elif len(successors) == 2:
-            # This is a branch: the first one is the fallthrough, the second
-            # one is the branch destination.
-            process_edge(FALLTHROUGH, successors[0], labels[0])
-            process_edge(BRANCH, successors[1], labels[1])
+        edge_labels = {JUMP: None, FALLTHROUGH: labels[0], BRANCH: labels[1]}
+        for kind, to_pc in get_successor_edges(insn):
+            process_edge(kind, to_pc, edge_labels[kind])
 
     for pc, basic_block in decision_cfg.items():
         # Draw the box for the basic block.
@@ -924,7 +1404,7 @@ if __name__ == '__main__':
         for insn in basic_block:
             if insn.slocs != last_slocs:
                 for sloc in insn.slocs:
-                    label.append(slocinfo.format_sloc(sloc, args.basename))
+                    label.append(slocinfo.format_sloc(sloc, basename))
                 last_slocs = insn.slocs
             if trace_info:
                 color = (
@@ -940,7 +1420,9 @@ if __name__ == '__main__':
             ), color))
 
         # Add the box to the correct condition cluster subgraph.
-        condition, branch_info = get_bb_condition(basic_block)
+        condition, branch_info = get_bb_condition(
+            decision_cfg, bdd_info, basic_block
+        )
         if branch_info is None:
             label_fallthrough = label_branch = None
         else:
@@ -962,7 +1444,7 @@ if __name__ == '__main__':
     for insn in outside_insns.values():
         label = []
         for sloc in insn.slocs:
-            label.append(slocinfo.format_sloc(sloc, args.basename))
+            label.append(slocinfo.format_sloc(sloc, basename))
         label.append('  {:#0x}'.format(insn.pc))
         add_node(insn.pc, None, format_text_label(label), shape='ellipse')
         process_successor_edges(insn.pc, insn, (None, None))
@@ -970,7 +1452,7 @@ if __name__ == '__main__':
     for out_dest in (destinations - nodes):
         label = []
         for sloc in sloc_info.get(out_dest, []):
-            label.append(slocinfo.format_sloc(sloc, args.basename))
+            label.append(slocinfo.format_sloc(sloc, basename))
         label.append('  {:#0x}'.format(out_dest))
         add_node(out_dest, None, format_text_label(label), 'ellipse')
 
@@ -996,3 +1478,458 @@ if __name__ == '__main__':
 
     f.write('}\n')
     f.close()
+
+
+EDGE_KIND_NAMES = {
+    JUMP:        'jump',
+    FALLTHROUGH: 'fallthrough',
+    BRANCH:      'branch',
+}
+
+def edge_info_to_json(edge_info):
+    """Return a JSON-friendly representation for a bddinfo.EdgeInfo."""
+    if edge_info is None:
+        return None
+
+    dest_kind = edge_info.dest_kind
+    if isinstance(dest_kind, bddinfo.DestCondition):
+        dest = {'kind': 'condition', 'sco_no': dest_kind.sco_no}
+    elif isinstance(dest_kind, bddinfo.DestOutcome):
+        dest = {'kind': 'outcome', 'value': dest_kind.value}
+    elif isinstance(dest_kind, bddinfo.DestRaiseException):
+        dest = {'kind': 'exception'}
+    else:
+        dest = {'kind': 'unknown'}
+    return {'cond_eval': edge_info.cond_eval, 'dest': dest}
+
+
+def get_cfg_stats(
+    decision_cfg, uncoverable_edges, outside_insns,
+    sloc_info, bdd_info, executed_insns, leave_flags,
+    decision=None, basename=False
+):
+    """Return statistics about a decision CFG (see get_decision_cfg) as a
+    JSON-friendly dict: its basic blocks, its edges with their coverage
+    status, its conditions with their edges info from the BDD and the
+    executed instructions ratio.
+
+    `decision` is a SlocRange for the decision, or None if unknown. Other
+    arguments are like for write_cfg_dot.
+
+    Edges have a `status` field: "uncoverable" for uncoverable edges that
+    were not executed, "covered" for executed edges, "uncovered" for the
+    others, or None when there are no traces and the edge is coverable.
+    """
+    trace_info = executed_insns is not None
+
+    tag_exception_edges(decision_cfg, uncoverable_edges, bdd_info)
+
+    basic_blocks = []
+    edges = []
+    conditions = {}
+    insns_count = 0
+    executed_count = 0
+
+    def add_edges(insn, branch_info):
+        edge_infos = {
+            FALLTHROUGH: branch_info and branch_info.edge_fallthrough,
+            BRANCH: branch_info and branch_info.edge_branch,
+        }
+        for kind, to_pc in get_successor_edges(insn):
+            uncoverable = (insn.pc, to_pc) in uncoverable_edges
+            covered = (
+                is_edge_covered(insn, kind, executed_insns, leave_flags)
+                if trace_info else
+                None
+            )
+            if covered:
+                status = 'covered'
+            elif uncoverable:
+                status = 'uncoverable'
+            elif trace_info:
+                status = 'uncovered'
+            else:
+                status = None
+            edges.append({
+                'from': insn.pc,
+                'to': to_pc,
+                'kind': EDGE_KIND_NAMES[kind],
+                'status': status,
+                'uncoverable': uncoverable,
+                'edge_info': edge_info_to_json(edge_infos.get(kind)),
+            })
+
+    for pc in sorted(decision_cfg):
+        basic_block = decision_cfg[pc]
+        condition, branch_info = get_bb_condition(
+            decision_cfg, bdd_info, basic_block
+        )
+        if branch_info is not None:
+            conditions[condition] = {
+                'sco_no': condition,
+                'sloc_range': branch_info.cond_sloc_range.decode('latin-1'),
+                'branch_pc': basic_block[-1].pc,
+                'edge_fallthrough': edge_info_to_json(
+                    branch_info.edge_fallthrough
+                ),
+                'edge_branch': edge_info_to_json(branch_info.edge_branch),
+            }
+
+        slocs = []
+        bb_executed = 0
+        for insn in basic_block:
+            for sloc in insn.slocs:
+                formatted = slocinfo.format_sloc(sloc, basename)
+                if formatted not in slocs:
+                    slocs.append(formatted)
+            if trace_info and insn.pc in executed_insns:
+                bb_executed += 1
+        insns_count += len(basic_block)
+        executed_count += bb_executed
+
+        basic_blocks.append({
+            'pc': pc,
+            'last_pc': basic_block[-1].pc,
+            'insns': len(basic_block),
+            'executed_insns': bb_executed if trace_info else None,
+            'condition': condition,
+            'slocs': slocs,
+        })
+        add_edges(basic_block[-1], branch_info)
+
+    for pc in sorted(outside_insns):
+        add_edges(outside_insns[pc], None)
+
+    return {
+        'decision': (
+            None
+            if decision is None else
+            '{}:{}:{}-{}:{}'.format(
+                decision.filename.decode('latin-1'),
+                decision.start_line, decision.start_column,
+                decision.end_line, decision.end_column
+            )
+        ),
+        'basic_blocks': basic_blocks,
+        'edges': edges,
+        'conditions': [conditions[sco_no] for sco_no in sorted(conditions)],
+        'insns': insns_count,
+        'executed_insns': executed_count if trace_info else None,
+        'executed_ratio': (
+            executed_count / insns_count
+            if trace_info and insns_count else
+            None
+        ),
+    }
+
+
+def write_cfg_json(f, stats):
+    """Write `stats` (see get_cfg_stats) to `f` as a single JSON line, so that
+    statistics for several decisions make a NDJSON stream.
+    """
+    f.write(json.dumps(stats, sort_keys=True))
+    f.write('\n')
+    f.flush()
+
+
+def write_batch_cfgs(
+    program, toolchain, scos, output_dir, format=None, bdd_scos=None,
+    traces=None, basename=False, keep_uncoverable_edges=False,
+    windowed_disassembly=False, json_output=None, bdd_jobs=None
+):
+    """Write one dot graph per decision in the `scos` SCOs file.
+
+    Metadata (symbols, slocs, BDD and traces) is loaded only once and the
+    program is disassembled only once, too. Graphs are written to
+    `output_dir`, in files named after the decision sloc. If `format` is not
+    None, format them with dot.
+
+    If `json_output` is not None, write statistics for each decision to this
+    file as a NDJSON stream (see write_cfg_json) instead of writing graphs.
+
+    BDD info comes from `bdd_scos`, or from `scos` if it is None. Other
+    arguments are like the corresponding command-line arguments.
+    """
+    sym_info = syminfo.get_sym_info(program.filename)
+    sloc_info = slocinfo.get_sloc_info(program.filename)
+    bdd_info = bddinfo.get_bdd_info(program.filename, bdd_scos or scos,
+                                    bdd_jobs)
+    executed_insns, leave_flags = (
+        traceinfo.get_trace_info(traces)
+        if traces is not None else
+        (None, None)
+    )
+
+    # Sweep slocs once to get the address ranges for each decision. Index
+    # decisions by line so that only the ones that cover a given line are
+    # checked.
+    decisions = parse_scos_decisions(scos)
+    decisions_by_line = intervalmap.IntervalTree()
+    for index, sloc_range in enumerate(decisions):
+        decisions_by_line[
+            sloc_range.start_line:sloc_range.end_line + 1
+        ] = index
+    decision_ranges = [[] for _ in decisions]
+    for low_high, sloc in sloc_info.items():
+        for index in decisions_by_line.at(sloc.line):
+            if slocs_match_range([sloc], decisions[index]):
+                decision_ranges[index].append(low_high)
+    if not any(decision_ranges):
+        sys.stderr.write('No code for decisions in {}\n'.format(scos))
+        return
+
+    # Then disassemble the code for all decisions at once, and sweep
+    # instructions once to dispatch them among decisions.
+    disassembly = Disassembly(
+        program, toolchain,
+        get_symbol_windows(sym_info, [
+            low_high
+            for ranges in decision_ranges
+            for low_high in ranges
+        ])
+        if windowed_disassembly else
+        None
+    )
+    decision_positions = disassembly.partition(program.arch, decision_ranges)
+
+    if json_output is None and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    for sloc_range, ranges, positions in zip(
+        decisions, decision_ranges, decision_positions
+    ):
+        if not ranges:
+            continue
+        decision_cfg, uncoverable_edges, outside_insns = get_decision_cfg(
+            program, toolchain, sloc_info,
+            Locations(sym_info, [], [], [sloc_range]),
+            instructions=disassembly.instructions(positions)
+        )
+        if not decision_cfg:
+            continue
+
+        if json_output is not None:
+            write_cfg_json(json_output, get_cfg_stats(
+                decision_cfg, uncoverable_edges, outside_insns,
+                sloc_info, bdd_info, executed_insns, leave_flags,
+                sloc_range, basename
+            ))
+            continue
+
+        filename = os.path.join(output_dir, '{}-{}_{}.{}'.format(
+            os.path.basename(sloc_range.filename.decode('latin-1')),
+            sloc_range.start_line, sloc_range.start_column,
+            format or 'dot'
+        ))
+        print('Writing {}'.format(filename))
+        if format:
+            with open(os.devnull, 'wb') as devnull:
+                dot_process = subprocess.Popen(
+                    ['dot', '-T{}'.format(format), '-o', filename],
+                    stdin=subprocess.PIPE, stdout=devnull,
+                    universal_newlines=True
+                )
+            f = dot_process.stdin
+        else:
+            dot_process = None
+            f = open(filename, 'w')
+
+        write_cfg_dot(
+            f, decision_cfg, uncoverable_edges, outside_insns,
+            sloc_info, bdd_info, executed_insns, leave_flags,
+            basename, keep_uncoverable_edges
+        )
+        if dot_process is not None and dot_process.wait() != 0:
+            raise RuntimeError('dot returned an error')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the CFG for some decision in a program'
+    )
+    parser.add_argument(
+        '-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
+        dest='output',
+        help='File to output the dot graph to (default: stdout)'
+    )
+    parser.add_argument(
+        '--json', action='store_true',
+        help='Output statistics about the decision (basic blocks, edges and'
+        ' their coverage, conditions and executed instructions) as a line of'
+        ' JSON instead of the dot graph. In batch mode, output one line per'
+        ' decision to the output file instead of writing graphs'
+    )
+    parser.add_argument(
+        '--target', dest='toolchain', type=parse_target, default=None,
+        help=(
+            'Prefix used to reach the toolchain'
+            ' (example: powerpc-elf for powerpc-elf-objdump)'
+        )
+    )
+    parser.add_argument(
+        '-T', '--format', default=None,
+        help='If given, call dot to produce the actual output passing it'
+        ' this argument'
+    )
+    parser.add_argument(
+        '-b', '--basename', action='store_true',
+        help='Only print basename in source locations'
+    )
+    parser.add_argument(
+        '-B', '--bdd', dest='scos',
+        help='Use SCOS to display the binary decision diagram (BDD)'
+    )
+    parser.add_argument(
+        '--bdd-jobs', dest='bdd_jobs', type=int, default=None, metavar='N',
+        help='When the BDD SCOS is a list of SCOs files (@FILE), extract the'
+        ' BDD separately for each SCOs file, in up to N processes in parallel'
+        ' (0 for the number of CPUs). Condition SCO numbers are then local to'
+        ' each SCOs file and are prefixed with its index in the list'
+    )
+    parser.add_argument(
+        '-k', '--keep-uncoverable-edges', dest='keep_uncoverable_edges',
+        action='store_true',
+        help='Do not strip edges that are supposed to be uncoverable due to'
+        ' exceptions'
+    )
+    parser.add_argument(
+        '--windowed-disassembly', dest='windowed_disassembly',
+        action='store_true',
+        help='Disassemble only the symbols that contain the decision (and'
+        ' their clones) instead of the whole program. Faster, but jumps to'
+        ' the decision from other symbols are missed'
+    )
+    parser.add_argument(
+        '--batch', dest='batch_scos', metavar='SCOS',
+        help='Write the graph of every decision in the SCOS file (an ALI'
+        ' file) instead of the graph of the given locations. Uses the SCOS'
+        ' for the BDD unless --bdd is passed'
+    )
+    parser.add_argument(
+        '--output-dir', dest='output_dir', default='.',
+        help='In batch mode, directory in which to write graphs'
+        ' (default: current directory)'
+    )
+    parser.add_argument(
+        '-t', '--traces', dest='traces', action='append',
+        help='Use a set of traces to hilight executed instructions. Can be'
+        ' passed several times to merge several trace files'
+    )
+    parser.add_argument(
+        'program', type=parse_program,
+        help='The program to analyse'
+    )
+    parser.add_argument(
+        'location', type=parse_location, nargs='*',
+        help=(
+            'Location of the decision to analyse (required unless --batch is'
+            ' passed).'
+            ' Can be a sloc range (example: 10:5-11:21),'
+            ' a symbol name (example: ada__text_io__put_line__2),'
+            ' an address range (example: 0x200..0x300)'
+            ' or the symbol around some address (example: @0x0808f31a)'
+        )
+    )
+
+    args = parser.parse_args()
+
+    # Create the default toolchain only when needed, since it may raise an
+    # exception when some tool is not available.
+    if args.toolchain is None:
+        args.toolchain = parse_target(None)
+
+    if args.batch_scos:
+        write_batch_cfgs(
+            args.program, args.toolchain, args.batch_scos, args.output_dir,
+            args.format, args.scos, args.traces,
+            args.basename, args.keep_uncoverable_edges,
+            args.windowed_disassembly,
+            args.output if args.json else None,
+            args.bdd_jobs
+        )
+        sys.exit(0)
+    elif not args.location:
+        parser.error('at least one location is required')
+
+    # If asked to, start dot to format the output.
+    if args.format and not args.json:
+        with open(os.devnull, 'wb') as devnull:
+            dot_process = subprocess.Popen(
+                ['dot', '-T{}'.format(args.format), '-o', args.output.name],
+                stdin=subprocess.PIPE, stdout=devnull
+            )
+        args.output.close()
+        f = dot_process.stdin
+    else:
+        f = args.output
+
+    sym_info = syminfo.get_sym_info(args.program.filename)
+
+    # Build accepted locations
+    accepted_symbols = []
+    accepted_slocs = []
+    accepted_addr_ranges = []
+    for loc in args.location:
+        if isinstance(loc, syminfo.Symbol):
+            accepted_symbols.append(loc.name)
+        elif isinstance(loc, AddressRange):
+            accepted_addr_ranges.append(loc)
+        elif isinstance(loc, SlocRange):
+            accepted_slocs.append(loc)
+        elif isinstance(loc, AroundAddress):
+            symbols = sym_info.at(loc.pc)
+            if not symbols:
+                sys.stderr.write('No symbol around: {:#08x}\n'.format(loc.pc))
+                sys.exit(1)
+            accepted_symbols.extend(symbol.name for symbol in symbols)
+        else:
+            # We are not supposed to end up here since args.location items come
+            # from arguments parsing.
+            assert False
+
+    locations = Locations(
+        sym_info,
+        accepted_symbols,
+        accepted_addr_ranges,
+        accepted_slocs
+    )
+
+    sloc_info = slocinfo.get_sloc_info(args.program.filename)
+    decision_cfg, uncoverable_edges, outside_insns = get_decision_cfg(
+        args.program, args.toolchain,
+        sloc_info, locations,
+        locations.get_address_windows(sloc_info)
+        if args.windowed_disassembly else
+        None
+    )
+
+    # Load the BDD if asked to. Reminder: this is a map:
+    #   branch instruction adresss -> branch info (associated condition and
+    #   edges info).
+    bdd_info = (
+        bddinfo.get_bdd_info(args.program.filename, args.scos, args.bdd_jobs)
+        if args.scos is not None else
+        {}
+    )
+
+    # Load traces if asked to.
+    executed_insns, leave_flags = (
+        traceinfo.get_trace_info(args.traces)
+        if args.traces is not None else
+        (None, None)
+    )
+
+    if args.json:
+        write_cfg_json(f, get_cfg_stats(
+            decision_cfg, uncoverable_edges, outside_insns,
+            sloc_info, bdd_info, executed_insns, leave_flags,
+            args.location[0]
+            if args.location == accepted_slocs and len(accepted_slocs) == 1
+            else None,
+            args.basename
+        ))
+    else:
+        write_cfg_dot(
+            f, decision_cfg, uncoverable_edges, outside_insns,
+            sloc_info, bdd_info, executed_insns, leave_flags,
+            args.basename, args.keep_uncoverable_edges
+        )
@@ -2,48 +2,172 @@
 # -*- coding: utf-8 -*-
 # Usage: dwarfdump.py objdump -Dr <exe>
 # Annotates the output of objdump with sloc info from exe
+#
+# Usage: dwarfdump.py --server [--objdump OBJDUMP] <exe>
+# Loads sloc info from exe once, and then answers requests read on the
+# standard input, one per line:
+#
+#   symbol <name>         Annotated disassembly for the <name> symbol
+#   range <low> <high>    Annotated disassembly for the [<low>, <high>[
+#                         address range (hexadecimal addresses)
+#
+# Each answer ends with a SERVER_END_MARKER line.
 
+import argparse
 import re
 import subprocess
 import sys
 
 import slocinfo
+import syminfo
 
 
 OBJDUMP_ADDR = re.compile('^ *([0-9a-f]+):')
 
+SERVER_END_MARKER = '=== end'
+SERVER_ERROR_PREFIX = '=== error: '
 
-def do_dump(sloc_info, cmd):
-    # Start the subprocess to disassemble (most likely objdump -d)
-    print('Executing: {}'.format(cmd))
-    print('')
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    outs, _ = proc.communicate()
-    outs = outs.decode()
 
+def annotate(sloc_info, lines, out):
+    """Write to the `out` file the lines of objdump output in the `lines`
+    iterable, interleaved with slocs from `sloc_info` each time they change.
+    Lines are processed one at a time, as soon as they are available.
+    """
     last_slocs = []
-    for line in outs.split('\n'):
+    for line in lines:
+        line = line.rstrip('\n')
         m = OBJDUMP_ADDR.match(line)
         if m:
             addr = int(m.group(1), 16)
             slocs = sloc_info.get(addr, [])
             if slocs != last_slocs:
-                print('')
+                out.write('\n')
                 for sloc in slocs:
-                    print('>>> {}'.format(slocinfo.format_sloc(sloc)))
+                    out.write('>>> {}\n'.format(slocinfo.format_sloc(sloc)))
                 last_slocs = slocs
-        sys.stdout.flush()
-        print(line)
+        out.write(line)
+        out.write('\n')
+        out.flush()
+
+
+def run_annotated(sloc_info, cmd, out):
+    """Run `cmd` (most likely objdump -d) and annotate its output as it is
+    produced. Return its exit status.
+    """
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, universal_newlines=True
+    )
+    try:
+        annotate(sloc_info, proc.stdout, out)
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    return returncode
+
+
+def do_dump(sloc_info, cmd):
+    print('Executing: {}'.format(cmd))
+    print('')
+    sys.stdout.flush()
+    run_annotated(sloc_info, cmd, sys.stdout)
+
+
+class Server(object):
+    """Answer annotated disassembly requests for a single executable."""
+
+    def __init__(self, exe_filename, objdump='objdump'):
+        self.exe_filename = exe_filename
+        self.objdump = objdump
+        self.sloc_info = slocinfo.get_sloc_info(exe_filename)
+        self._symbols = None
+
+    @property
+    def symbols(self):
+        """Mapping: symbol name -> list of Symbol. Computed on first use."""
+        if self._symbols is None:
+            self._symbols = {}
+            sym_info = syminfo.get_sym_info(self.exe_filename)
+            for _, symbol in sym_info.items():
+                self._symbols.setdefault(symbol.name, []).append(symbol)
+        return self._symbols
+
+    def disassemble(self, low, high, out):
+        """Write the annotated disassembly of the [low, high[ address range to
+        the `out` file.
+        """
+        cmd = [
+            self.objdump, '-dr',
+            '--start-address=0x{:x}'.format(low),
+            '--stop-address=0x{:x}'.format(high),
+            self.exe_filename
+        ]
+        if run_annotated(self.sloc_info, cmd, out) != 0:
+            raise RuntimeError('{} returned an error'.format(self.objdump))
+
+    def handle(self, request, out):
+        """Answer the `request` line to the `out` file. Raise a ValueError if
+        the request is invalid.
+        """
+        words = request.split()
+        if len(words) == 2 and words[0] == 'symbol':
+            try:
+                symbols = self.symbols[words[1]]
+            except KeyError:
+                raise ValueError('unknown symbol: {}'.format(words[1]))
+            for symbol in symbols:
+                self.disassemble(symbol.pc, symbol.pc + symbol.size, out)
+        elif len(words) == 3 and words[0] == 'range':
+            try:
+                low, high = int(words[1], 16), int(words[2], 16)
+            except ValueError:
+                raise ValueError('invalid address range: {} {}'.format(
+                    words[1], words[2]
+                ))
+            self.disassemble(low, high, out)
+        else:
+            raise ValueError('invalid request: {}'.format(request))
+
+    def serve(self, requests, out):
+        """Answer each request line in the `requests` iterable."""
+        for request in requests:
+            request = request.strip()
+            if not request:
+                continue
+            try:
+                self.handle(request, out)
+            except (ValueError, RuntimeError, OSError) as e:
+                out.write('{}{}\n'.format(SERVER_ERROR_PREFIX, e))
+            out.write('{}\n'.format(SERVER_END_MARKER))
+            out.flush()
 
 
 if __name__ == '__main__':
     import errno
 
     try:
-        do_dump(
-            slocinfo.get_sloc_info(sys.argv[-1]),
-            sys.argv[1:]
-        )
+        if len(sys.argv) > 1 and sys.argv[1] == '--server':
+            parser = argparse.ArgumentParser(
+                description='Answer annotated disassembly requests read on'
+                ' the standard input'
+            )
+            parser.add_argument(
+                '--server', action='store_true', required=True,
+                help='Run in server mode'
+            )
+            parser.add_argument(
+                '--objdump', default='objdump',
+                help='objdump program to use (default: objdump)'
+            )
+            parser.add_argument(
+                'exe', help='Executable to disassemble'
+            )
+            args = parser.parse_args()
+            Server(args.exe, args.objdump).serve(sys.stdin, sys.stdout)
+        else:
+            do_dump(
+                slocinfo.get_sloc_info(sys.argv[-1]),
+                sys.argv[1:]
+            )
     except IOError as e:
         if e.errno != errno.EPIPE:
             raise
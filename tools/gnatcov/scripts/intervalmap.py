@@ -1,17 +1,98 @@
 # -*- coding: utf-8 -*-
 
+import array
 import bisect
 
 
 class IntervalMap(object):
-    """Map integer intervals to anything else."""
+    """Map integer intervals to anything else.
+
+    Intervals are kept sorted in chunks of at most `CHUNK_SIZE` intervals.
+    Each chunk stores the bounds of its intervals in parallel arrays of 64-bit
+    unsigned integers and the associated values in a list, so that both
+    insertions and lookups are binary searches followed, for insertions, by a
+    shift of at most one chunk.
+    """
+
+    CHUNK_SIZE = 512
 
     def __init__(self):
-        # Sorted list of inserted bounds.
-        self.bounds = []
-        # When an interval [x; y[ is associated with a `value`,
-        # `self.items[x]` is set to `value`.
-        self.values = {}
+        # For each chunk, sorted array of interval lower bounds, array of
+        # corresponding upper bounds and list of corresponding values.
+        self.chunk_starts = []
+        self.chunk_stops = []
+        self.chunk_values = []
+        # Lower bound of the first interval in each chunk.
+        self.firsts = []
+
+    @classmethod
+    def from_sorted(cls, items):
+        """Create an interval map from an iterable of
+        `((low_bound, high_bound), value)` items (like what `items` yields),
+        sorted by lower bound.
+
+        This runs in linear time. Empty intervals are ignored, and a
+        ValueError is raised if intervals overlap or are not sorted.
+        """
+        result = cls()
+        starts = array.array('Q')
+        stops = array.array('Q')
+        values = []
+        for (low, high), value in items:
+            if low >= high:
+                continue
+            if stops and low < stops[-1]:
+                raise ValueError(
+                    '[{};{}[ overlaps with or is before previous'
+                    ' interval [{};{}['.format(low, high,
+                                               starts[-1], stops[-1])
+                )
+            starts.append(low)
+            stops.append(high)
+            values.append(value)
+
+        for i in range(0, len(values), cls.CHUNK_SIZE):
+            result.chunk_starts.append(starts[i:i + cls.CHUNK_SIZE])
+            result.chunk_stops.append(stops[i:i + cls.CHUNK_SIZE])
+            result.chunk_values.append(values[i:i + cls.CHUNK_SIZE])
+            result.firsts.append(starts[i])
+        return result
+
+    def _locate(self, key):
+        """Return `(chunk_index, index)` for the last interval whose lower
+        bound is lower or equal to `key`, or None if there is no such
+        interval.
+        """
+        chunk_index = bisect.bisect_right(self.firsts, key) - 1
+        if chunk_index < 0:
+            return None
+        index = bisect.bisect_right(self.chunk_starts[chunk_index], key) - 1
+        return (chunk_index, index)
+
+    def _check_no_overlap(self, low, high, chunk_index, index):
+        """Raise a ValueError if [low;high[ overlaps the interval at `index`
+        in `chunk_index` (previous interval) or the next one.
+        """
+        starts = self.chunk_starts[chunk_index]
+        stops = self.chunk_stops[chunk_index]
+        if index >= 0 and stops[index] > low:
+            raise ValueError(
+                '[{};{}[ overlaps with previously added interval'
+                ' [{};{}['.format(low, high, starts[index], stops[index])
+            )
+
+        if index + 1 < len(starts):
+            next_start, next_stop = starts[index + 1], stops[index + 1]
+        elif chunk_index + 1 < len(self.firsts):
+            next_start = self.chunk_starts[chunk_index + 1][0]
+            next_stop = self.chunk_stops[chunk_index + 1][0]
+        else:
+            return
+        if next_start < high:
+            raise ValueError(
+                '[{};{}[ overlaps with previously added interval'
+                ' [{};{}['.format(low, high, next_start, next_stop)
+            )
 
     def __setitem__(self, interval, value):
         """Associate a `value` with the `interval`.
@@ -31,114 +112,56 @@ class IntervalMap(object):
             # Do nothing for the empty interval.
             return
 
+        low, high = interval.start, interval.stop
+
         # The first interval to add is a special case.
-        if not self.bounds:
-            self.bounds = [interval.start, interval.stop]
-            self.values[interval.start] = value
+        if not self.firsts:
+            self.chunk_starts.append(array.array('Q', [low]))
+            self.chunk_stops.append(array.array('Q', [high]))
+            self.chunk_values.append([value])
+            self.firsts.append(low)
             return
 
-        # Compute where to insert bounds.
-        start_insert_index = bisect.bisect_left(self.bounds, interval.start)
-        stop_insert_index = bisect.bisect_left(self.bounds, interval.stop)
-
-        # Insert bounds when needed and check `interval` do not overlap with
-        # previously inserted intervals.
-        if start_insert_index == stop_insert_index:
-            if start_insert_index == 0:
-                if self.bounds[0] != interval.stop:
-                    # Example: [1;2[ is added to bounds [2;4;5]
-                    self.bounds.insert(0, interval.stop)
-                else:
-                    # Example: [1;2[ is added to bounds [3;4;5]
-                    pass
-                self.bounds.insert(0, interval.start)
-
-            elif start_insert_index >= len(self.bounds):
-                # Example: [5;6[ is added to bounds [1;2;3]
-                self.bounds.append(interval.start)
-                self.bounds.append(interval.stop)
-
-            else:
-                # This interval should not be inside another previously added
-                # one, i.e.: the bound right before the one we are going to
-                # insert must not start an added interval.
-                if self.bounds[start_insert_index - 1] in self.values:
-                    # Example: [3;4[ is added to bounds [1;6]
-                    raise ValueError(
-                        '[{};{}[ is inside previously added'
-                        ' interval [{};{}['.format(
-                            interval.start, interval.stop,
-                            self.bounds[start_insert_index - 1],
-                            self.bounds[start_insert_index]
-                        )
-                    )
-
-                if self.bounds[stop_insert_index] != interval.stop:
-                    # Insert the end bound only when not already present:
-                    # Example: [3;4[ is added to bounds [1;2;4;5]
-                    self.bounds.insert(stop_insert_index, interval.stop)
-                else:
-                    # Example: [3;4[ is added to bounds [1;2;5;6]
-                    pass
-                self.bounds.insert(start_insert_index, interval.start)
-
-        elif stop_insert_index > start_insert_index + 1:
-            # Example: [2;4[ is added to bounds [1;3;5]
-            raise ValueError('[{};{}[ contains previous bound {}'.format(
-                interval.start, interval.stop,
-                self.bounds[start_insert_index + 1]
-            ))
-
-        else:
-            # Here, start_insert_index + 1 == stop_insert_index.
-            if self.bounds[start_insert_index] != interval.start:
-                # Example: [1;3[ is added to bounds [2;4]
-                raise ValueError('[{};{}[ contains previous bound {}'.format(
-                    interval.start, interval.stop,
-                    self.bounds[start_insert_index]
-                ))
-
-            # The starting bound is already inserted: just check it doesn't
-            # start any previously added interval.
-            elif interval.start in self.values:
-                # Example: [3; 4] is added to bounds [1;2;3;5]
-                raise ValueError(
-                    '[{};{}[ overlaps with previously added'
-                    ' interval [{};{}['.format(
-                        interval.start, interval.stop,
-                        interval.start, self.bounds[start_insert_index + 1]
-                    )
-                )
-
-            # The starting bound is already inserted: check for the ending one.
-            elif (
-                stop_insert_index >= len(self.bounds) or
-                self.bounds[stop_insert_index] != interval.stop
-            ):
-                # Example: [2; 4] is added to bounds [1;2;4;5]
-                self.bounds.insert(stop_insert_index, interval.stop)
-
-            else:
-                # Example: [2; 4] is added to bounds [1;2;5;6]
-                pass
-
-        # And finally, insert the value itself!
-        self.values[interval.start] = value
-
+        # Intervals that start before all the others go to the first chunk.
+        location = self._locate(low)
+        chunk_index, index = location if location else (0, -1)
+        self._check_no_overlap(low, high, chunk_index, index)
+
+        starts = self.chunk_starts[chunk_index]
+        stops = self.chunk_stops[chunk_index]
+        values = self.chunk_values[chunk_index]
+        starts.insert(index + 1, low)
+        stops.insert(index + 1, high)
+        values.insert(index + 1, value)
+        self.firsts[chunk_index] = starts[0]
+
+        # Split chunks that grew too big, to keep insertions cheap.
+        if len(starts) > 2 * self.CHUNK_SIZE:
+            half = len(starts) // 2
+            self.chunk_starts[chunk_index:chunk_index + 1] = [
+                starts[:half], starts[half:]
+            ]
+            self.chunk_stops[chunk_index:chunk_index + 1] = [
+                stops[:half], stops[half:]
+            ]
+            self.chunk_values[chunk_index:chunk_index + 1] = [
+                values[:half], values[half:]
+            ]
+            self.firsts[chunk_index:chunk_index + 1] = [
+                starts[0], starts[half]
+            ]
 
     def __getitem__(self, key):
         """Return the value associated to the interval that contains `key`.
 
         Raise a KeyError if there is no such interval.
         """
-
-        start_bound_index = bisect.bisect_right(self.bounds, key)
-        if start_bound_index < 1:
-            raise KeyError('No interval contains {}'.format(key))
-        else:
-            start_bound = self.bounds[start_bound_index - 1]
-
-        return self.values[start_bound]
+        location = self._locate(key)
+        if location is not None:
+            chunk_index, index = location
+            if self.chunk_stops[chunk_index][index] > key:
+                return self.chunk_values[chunk_index][index]
+        raise KeyError('No interval contains {}'.format(key))
 
     def __contains__(self, key):
         """Return if `key` belongs to some covered interval.
@@ -150,6 +173,10 @@ class IntervalMap(object):
         else:
             return True
 
+    def __len__(self):
+        """Return the number of intervals in this map."""
+        return sum(len(values) for values in self.chunk_values)
+
     def get(self, key, default=None):
         """Return the value associated to the interval that contains `key`, or
         `default` if there is no such interval.
@@ -165,15 +192,200 @@ class IntervalMap(object):
         Yielded items are like: `((low_bound, high_bound), value)`
         """
 
-        for i, bound in enumerate(self.bounds):
-            try:
-                value = self.values[bound]
-            except KeyError:
-                # If this happens, `bound` doesn't start an interval.
-                continue
-            interval = (bound, self.bounds[i + 1])
-            item = (interval, value)
-            yield item
+        for starts, stops, values in zip(
+            self.chunk_starts, self.chunk_stops, self.chunk_values
+        ):
+            for item in zip(zip(starts, stops), values):
+                yield item
+
+    def __repr__(self):
+        return '{{{}}}'.format(', '.join(
+            '[{}; {}[: {}'.format(low, high, repr(value))
+            for (low, high), value in self.items()
+        ))
+
+
+class IntervalTree(object):
+    """Map integer intervals to anything else, allowing intervals to overlap.
+
+    Unlike IntervalMap, looking up a key returns the values for all the
+    intervals that contain it. Intervals are kept sorted by lower bound and
+    are viewed as an implicit balanced binary search tree: the node for a
+    range of intervals is the one in the middle of the range, and each node
+    records the highest upper bound in its subtree. This makes it possible to
+    fetch the K intervals that contain a key, or that intersect another
+    interval, in O(log N + K) (for N intervals).
+
+    Insertions are cheap: the tree is (re)built on the first lookup that
+    follows them.
+    """
+
+    def __init__(self):
+        self.starts = array.array('Q')
+        self.stops = array.array('Q')
+        self.values = []
+
+        # For each interval, highest upper bound in the subtree of the
+        # corresponding node.
+        self.max_stops = array.array('Q')
+
+        # Whether intervals were added since the last tree build.
+        self.dirty = False
+
+    @classmethod
+    def from_columns(cls, starts, stops, max_stops, values):
+        """Create an interval tree from the columns of a built one (see
+        `columns`).
+
+        Columns can be any sequence, for instance memoryviews on a mapped
+        file: they are copied only if intervals are added to the result.
+        """
+        result = cls()
+        result.starts = starts
+        result.stops = stops
+        result.max_stops = max_stops
+        result.values = values
+        return result
+
+    def columns(self):
+        """Return the lower bounds, upper bounds, subtree highest upper bounds
+        and values of intervals, sorted by lower bound.
+        """
+        self._build()
+        return self.starts, self.stops, self.max_stops, self.values
+
+    def __setitem__(self, interval, value):
+        """Associate a `value` with the `interval`.
+
+        `interval` must be a slice object with integer bounds. It can overlap
+        with previously added intervals. Nothing is done when the interval is
+        empty ([x:y] when x >= y).
+        """
+
+        if not isinstance(interval, slice):
+            raise TypeError('Interval required')
+
+        elif interval.start is None or interval.stop is None:
+            raise ValueError('Interval must have integer bounds')
+
+        elif interval.start >= interval.stop:
+            # Do nothing for the empty interval.
+            return
+
+        # Columns may come from read-only buffers (see `from_columns`).
+        if not isinstance(self.values, list):
+            self.starts = array.array('Q', self.starts)
+            self.stops = array.array('Q', self.stops)
+            self.values = list(self.values)
+
+        self.starts.append(interval.start)
+        self.stops.append(interval.stop)
+        self.values.append(value)
+        self.dirty = True
+
+    def _build(self):
+        """Sort intervals and compute the highest upper bound of each subtree.
+        """
+        if not self.dirty:
+            return
+
+        # Python's sort is stable, so intervals with the same lower bound are
+        # kept in insertion order.
+        order = sorted(range(len(self.values)),
+                       key=self.starts.__getitem__)
+        self.starts = array.array('Q', (self.starts[i] for i in order))
+        self.stops = array.array('Q', (self.stops[i] for i in order))
+        self.values = [self.values[i] for i in order]
+
+        self.max_stops = array.array('Q', self.stops)
+        self._build_max_stops(0, len(self.values))
+        self.dirty = False
+
+    def _build_max_stops(self, low, high):
+        if low >= high:
+            return 0
+        mid = (low + high) // 2
+        self.max_stops[mid] = max(
+            self.stops[mid],
+            self._build_max_stops(low, mid),
+            self._build_max_stops(mid + 1, high),
+        )
+        return self.max_stops[mid]
+
+    def _search(self, low, high, index_low, index_high, result):
+        """Append to `result` the index of intervals in the
+        [index_low;index_high[ subtree that intersect [low;high[.
+
+        Indexes are appended in increasing order.
+        """
+        if index_low >= index_high:
+            return
+        mid = (index_low + index_high) // 2
+
+        # If no interval in this subtree ends after `low`, none can intersect.
+        if self.max_stops[mid] <= low:
+            return
+
+        self._search(low, high, index_low, mid, result)
+
+        # Intervals on the right side start after this one: there is no need
+        # to look at them if this one already starts too late.
+        if self.starts[mid] < high:
+            if self.stops[mid] > low:
+                result.append(mid)
+            self._search(low, high, mid + 1, index_high, result)
+
+    def overlapping(self, low, high):
+        """Return a list for the intervals that intersect [low;high[, sorted
+        by lower bound.
+
+        Items are like: `((low_bound, high_bound), value)`
+        """
+        self._build()
+        indexes = []
+        self._search(low, high, 0, len(self.values), indexes)
+        return [((self.starts[i], self.stops[i]), self.values[i])
+                for i in indexes]
+
+    def at(self, key):
+        """Return the list of values associated to intervals that contain
+        `key`, sorted by interval lower bound.
+        """
+        self._build()
+        indexes = []
+        self._search(key, key + 1, 0, len(self.values), indexes)
+        return [self.values[i] for i in indexes]
+
+    def __getitem__(self, key):
+        """Like `at`, but raise a KeyError if no interval contains `key`."""
+        result = self.at(key)
+        if not result:
+            raise KeyError('No interval contains {}'.format(key))
+        return result
+
+    def __contains__(self, key):
+        """Return if `key` belongs to some covered interval.
+        """
+        return bool(self.at(key))
+
+    def __len__(self):
+        """Return the number of intervals in this tree."""
+        return len(self.values)
+
+    def get(self, key, default=None):
+        """Return the list of values associated to intervals that contain
+        `key`, or `default` if there is no such interval.
+        """
+        return self.at(key) or default
+
+    def items(self):
+        """Return an iterator over added intervals and associated values,
+        sorted by lower bound.
+
+        Yielded items are like: `((low_bound, high_bound), value)`
+        """
+        self._build()
+        return zip(zip(self.starts, self.stops), self.values)
 
     def __repr__(self):
         return '{{{}}}'.format(', '.join(
@@ -190,22 +402,24 @@ if __name__ == '__main__':
     def sanity_check():
         """Check that the interval map is healthy (no buggy internal data)."""
 
-        # Bounds must be strictly increasing.
-        last_bound = None
-
-        # First bound must start an interval, and so does every bound that
-        # follow another bound that does not.
-        last_bound_starts_interval = False
-
-        for bound in m.bounds:
-            if last_bound is not None:
-                assert last_bound < bound
-
-            starts_interval = bound in m.values
-            assert last_bound_starts_interval or starts_interval
-
-            last_bound = bound
-            last_bound_starts_interval = starts_interval
+        assert len(m.chunk_starts) == len(m.chunk_stops)
+        assert len(m.chunk_starts) == len(m.chunk_values)
+        assert len(m.chunk_starts) == len(m.firsts)
+
+        # Chunks must not be empty and their first bounds must be up-to-date.
+        for starts, stops, values, first in zip(
+            m.chunk_starts, m.chunk_stops, m.chunk_values, m.firsts
+        ):
+            assert len(starts) == len(stops) == len(values) > 0
+            assert starts[0] == first
+
+        # Intervals must not be empty, and must be sorted without overlap.
+        last_high = None
+        for (low, high), _ in m.items():
+            assert low < high
+            if last_high is not None:
+                assert last_high <= low
+            last_high = high
 
     def add(low, high, value, exception_expected=None):
         print('Adding [{}; {}[: {}'.format(low, high, repr(value)))
@@ -223,7 +437,6 @@ if __name__ == '__main__':
                 )
             else:
                 print('  ', m)
-                print('  >>', m.bounds)
 
         sanity_check()
 
@@ -256,3 +469,16 @@ if __name__ == '__main__':
     add(5, 8, 'C')
     add(18, 20, 'E')
     add(25, 30, 'G')
+
+    print('Overlapping intervals')
+    t = IntervalTree()
+    for low, high, value in [(1, 4, 'A'), (2, 3, 'B'), (2, 8, 'C'),
+                             (5, 6, 'D'), (3, 0, 'Z'), (10, 12, 'E')]:
+        t[low:high] = value
+    print('  ', t)
+    assert [t.get(key, []) for key in range(13)] == [
+        [], ['A'], ['A', 'B', 'C'], ['A', 'C'], ['C'], ['C', 'D'], ['C'],
+        ['C'], [], [], ['E'], ['E'], []
+    ]
+    assert [value for _, value in t.overlapping(3, 11)] == ['A', 'C', 'D', 'E']
+    assert 9 not in t and 11 in t
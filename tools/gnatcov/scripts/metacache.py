@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent on-disk cache for metadata extracted from executables.
+
+Extracting symbols, slocs or BDDs from big executables takes a while, as it
+requires running external tools and parsing their textual output. This module
+caches the parsed results on disk, so that the next scripts run on the same
+executable just have to map the cached files.
+
+Cache entries are content-addressed: each executable gets one directory named
+after the SHA-1 digest of its content. The digest itself is computed only once
+per (path, modification time, size) triplet: it is saved in a "stamp" file.
+
+The cache directory is `$GNATCOV_SCRIPTS_CACHE`, or
+`~/.cache/gnatcov-scripts` if this environment variable is not defined. Set
+it to an empty string to disable caching. At most `$GNATCOV_SCRIPTS_CACHE_SIZE`
+executables (8 by default) are kept: the least recently used ones are evicted
+first. A size of 0 disables caching as well.
+
+Cached files are tables: a header, followed by columns of 64-bit unsigned
+integers, fixed-size records and a table of strings referenced by records.
+Everything uses the native byte order, as the cache is not supposed to be
+shared across hosts. TABLE_MAGIC identifies this generic layout: users of this
+module put a version in the names of their cached files, to be bumped when
+the metadata they extract or its encoding changes.
+"""
+
+import hashlib
+import mmap
+import os
+import os.path
+import shutil
+import struct
+import tempfile
+
+
+CACHE_DIR_ENV = 'GNATCOV_SCRIPTS_CACHE'
+CACHE_SIZE_ENV = 'GNATCOV_SCRIPTS_CACHE_SIZE'
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'gnatcov-scripts')
+DEFAULT_CACHE_SIZE = 8
+
+TABLE_MAGIC = b'GCVMETA1'
+TableHeader = struct.Struct('=8sQQQ')
+"""Table header: magic, number of rows, number of columns and number of
+strings.
+"""
+
+STAMPS_DIR = 'stamps'
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def atomic_write(filename, write):
+    """Call `write` on a temporary file and then move it to `filename`, so
+    that concurrent readers never see partial files.
+    """
+    directory = os.path.dirname(filename)
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+class StringTable(object):
+    """Build a table of unique strings, referenced by index."""
+
+    def __init__(self):
+        self.strings = []
+        self.indexes = {}
+
+    def index(self, string):
+        """Return the index of `string`, adding it to the table if needed."""
+        try:
+            return self.indexes[string]
+        except KeyError:
+            result = len(self.strings)
+            self.strings.append(string)
+            self.indexes[string] = result
+            return result
+
+
+class MappedStrings(object):
+    """Strings table decoded from a buffer.
+
+    Decoded strings are kept, so that each string is decoded only once (this
+    also reduces memory consumption).
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+        self.decoded = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        try:
+            return self.decoded[index]
+        except KeyError:
+            result = bytes(
+                self.blob[self.offsets[index]:self.offsets[index + 1]]
+            )
+            self.decoded[index] = result
+            return result
+
+
+class MappedRecords(object):
+    """Sequence of fixed-size records decoded on demand from a buffer."""
+
+    def __init__(self, buf, record, decode):
+        """
+        :param buf: Buffer that contains the records.
+        :param struct.Struct record: Layout of records.
+        :param decode: Callable that takes a row index and the tuple of record
+            fields and returns the corresponding value.
+        """
+        self.buf = buf
+        self.record = record
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.buf) // self.record.size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('record index out of range')
+        return self.decode(
+            index, self.record.unpack_from(self.buf, index * self.record.size)
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def write_table(fp, columns, record, rows, strings):
+    """Write a table to the `fp` file.
+
+    :param list[sequence[int]] columns: Integer columns to write. All must
+        have the same length as `rows`.
+    :param struct.Struct record: Layout of records.
+    :param list[tuple] rows: Record fields for each row.
+    :param StringTable strings: Strings referenced by records.
+    """
+    fp.write(TableHeader.pack(
+        TABLE_MAGIC, len(rows), len(columns), len(strings.strings)
+    ))
+    for column in columns:
+        assert len(column) == len(rows)
+        fp.write(struct.pack('={}Q'.format(len(column)), *column))
+    for row in rows:
+        fp.write(record.pack(*row))
+
+    offsets = [0]
+    for string in strings.strings:
+        offsets.append(offsets[-1] + len(string))
+    fp.write(struct.pack('={}Q'.format(len(offsets)), *offsets))
+    for string in strings.strings:
+        fp.write(string)
+
+
+def map_table(filename, column_count, record, decode):
+    """Map the table in `filename`.
+
+    Return the list of columns (as memoryviews), the records (as
+    MappedRecords) and the strings table (as MappedStrings). Raise a
+    ValueError if the table is corrupted or if it does not have the expected
+    layout.
+    """
+    with open(filename, 'rb') as f:
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            raise ValueError('empty table')
+    view = memoryview(mapping)
+
+    if len(view) < TableHeader.size:
+        raise ValueError('truncated table header')
+    magic, row_count, actual_column_count, string_count = (
+        TableHeader.unpack_from(view)
+    )
+    if magic != TABLE_MAGIC:
+        raise ValueError('invalid table magic')
+    if actual_column_count != column_count:
+        raise ValueError('unexpected number of columns')
+
+    offset = TableHeader.size
+    columns_size = 8 * row_count * column_count
+    records_size = record.size * row_count
+    offsets_size = 8 * (string_count + 1)
+    if len(view) < offset + columns_size + records_size + offsets_size:
+        raise ValueError('truncated table')
+
+    columns = []
+    for _ in range(column_count):
+        columns.append(view[offset:offset + 8 * row_count].cast('Q'))
+        offset += 8 * row_count
+
+    records = MappedRecords(view[offset:offset + records_size], record,
+                            decode)
+    offset += records_size
+
+    offsets = view[offset:offset + offsets_size].cast('Q')
+    offset += offsets_size
+    if len(view) != offset + offsets[-1]:
+        raise ValueError('invalid strings table')
+    strings = MappedStrings(offsets, view[offset:])
+
+    return columns, records, strings
+
+
+class MetadataCache(object):
+    """Cache for metadata extracted from executables."""
+
+    def __init__(self, directory, max_entries=DEFAULT_CACHE_SIZE):
+        """
+        :param str directory: Directory in which to store cached data. It is
+            created if needed.
+        :param int max_entries: Maximum number of executables for which
+            metadata is kept. If 0 or less, nothing is cached.
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+
+    @classmethod
+    def from_environment(cls):
+        """Return the cache described by environment variables, or None if
+        caching is disabled.
+        """
+        directory = os.environ.get(CACHE_DIR_ENV)
+        if directory is None:
+            directory = os.path.expanduser(DEFAULT_CACHE_DIR)
+        elif not directory:
+            return None
+        max_entries = int(
+            os.environ.get(CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE)
+        )
+        if max_entries <= 0:
+            return None
+        return cls(directory, max_entries)
+
+    def digest(self, filename):
+        """Return the hexadecimal SHA-1 digest of the content of `filename`.
+
+        The digest is computed only if `filename` was modified (or moved)
+        since the last call.
+        """
+        filename = os.path.realpath(filename)
+        st = os.stat(filename)
+        stamp = '{} {}'.format(st.st_mtime_ns, st.st_size)
+
+        stamps_dir = os.path.join(self.directory, STAMPS_DIR)
+        stamp_file = os.path.join(
+            stamps_dir,
+            hashlib.sha1(filename.encode('utf-8')).hexdigest()
+        )
+        try:
+            with open(stamp_file) as f:
+                saved_stamp, digest = f.read().rsplit(' ', 1)
+        except (IOError, OSError, ValueError):
+            pass
+        else:
+            if saved_stamp == stamp:
+                return digest
+
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+        digest = h.hexdigest()
+
+        if not os.path.isdir(stamps_dir):
+            os.makedirs(stamps_dir)
+        atomic_write(
+            stamp_file,
+            lambda f: f.write('{} {}'.format(stamp, digest).encode('ascii'))
+        )
+        return digest
+
+    def entry(self, exe_filename):
+        """Return the directory that contains cached data for `exe_filename`,
+        creating it if needed, and mark it as the most recently used one.
+        """
+        entry_dir = os.path.join(self.directory, self.digest(exe_filename))
+        if os.path.isdir(entry_dir):
+            os.utime(entry_dir, None)
+        else:
+            os.makedirs(entry_dir, exist_ok=True)
+            self.evict(keep=entry_dir)
+        return entry_dir
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries, keeping at most
+        `max_entries` ones. The `keep` entry directory, if provided, is never
+        removed and counts as one of them.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if (name != STAMPS_DIR and path != keep
+                    and os.path.isdir(path)):
+                entries.append((os.path.getmtime(path), path))
+        entries.sort()
+        max_entries = self.max_entries - (0 if keep is None else 1)
+        for _, path in entries[:max(0, len(entries) - max_entries)]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def fetch(self, exe_filename, name, compute, dump, load):
+        """Return the `name` metadata for `exe_filename`.
+
+        If it is in the cache, load it with `load`, which takes the name of the
+        cache file. Otherwise, compute it with `compute` (which takes no
+        argument), and save it to the cache with `dump`, which takes the
+        metadata and the file object to write.
+
+        Caching is best effort: if the cache entry cannot be created or
+        written (for instance because the cache directory is read-only or
+        because a concurrent process evicted the entry), just return the
+        computed metadata.
+        """
+        if self.max_entries <= 0:
+            return compute()
+
+        try:
+            filename = os.path.join(self.entry(exe_filename), name)
+        except (IOError, OSError):
+            return compute()
+        try:
+            return load(filename)
+        except (IOError, OSError, ValueError):
+            pass
+
+        result = compute()
+        try:
+            atomic_write(filename, lambda f: dump(result, f))
+        except (IOError, OSError):
+            pass
+        return result
+
+
+def fetch(exe_filename, name, compute, dump, load):
+    """Shortcut for MetadataCache.fetch on the cache described by environment
+    variables. Just return `compute()` if caching is disabled.
+    """
+    cache = MetadataCache.from_environment()
+    if cache is None:
+        return compute()
+    return cache.fetch(exe_filename, name, compute, dump, load)
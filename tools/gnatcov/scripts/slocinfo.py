@@ -2,19 +2,24 @@
 
 import collections
 import os.path
-import re
-import subprocess
+import struct
 
+import debugline
 import intervalmap
+import metacache
 
 
-SLOC_INFO_LINE = re.compile(
-    b'^(?P<pc_start>[0-9a-f]+)-(?P<pc_stop>[0-9a-f]+)'
-    b' line (?P<src_file>[^:]+):(?P<line>\d+)(?:[:](?P<column>\d+))?'
-    b'(?: discriminator (?P<discriminator>\d+))?$'
-)
 Sloc = collections.namedtuple('Sloc', 'filename line column discriminator')
 
+# Layout of slocs in the metadata cache: index of the filename in the strings
+# table, line, column and discriminator (-1 for None).
+SLOC_RECORD = struct.Struct('=Iiii')
+
+# Name of sloc info files in the metadata cache. Bump the version whenever the
+# way sloc info is extracted or stored changes, so that stale entries are not
+# reused.
+SLOC_CACHE_NAME = 'slocinfo-2'
+
 
 def format_sloc(sloc, basename=False):
     if sloc is None:
@@ -35,19 +40,33 @@ def format_sloc(sloc, basename=False):
 
 
 def get_sloc_info(exe_filename):
-    """Parse sloc info in `exe_filename` and return it as an interval map.
+    """Parse sloc info in `exe_filename` and return it as an interval tree.
 
-    The result maps from program counter to lists of `Sloc` objects.
+    The result maps from program counter to lists of `Sloc` objects. Address
+    ranges can overlap, so a single program counter can have multiple slocs.
+    It is cached on disk (see the metacache module).
     """
-    sloc_info = intervalmap.IntervalMap()
-
-    # Let gnatcov parse ELF and DWARF for us.
-    proc = subprocess.Popen(
-        ['gnatcov', 'dump-lines', exe_filename], stdout=subprocess.PIPE
+    return metacache.fetch(
+        exe_filename, SLOC_CACHE_NAME,
+        lambda: compute_sloc_info(exe_filename),
+        dump_sloc_info, load_sloc_info
     )
-    outs, errs = proc.communicate()
-    if proc.returncode != 0:
-        raise RuntimeError('gnatcov dump-lines returned an error')
+
+
+def compute_sloc_info(exe_filename):
+    """Uncached version of get_sloc_info."""
+    with debugline.DebugLineReader(exe_filename) as reader:
+        return get_units_sloc_info(reader.units)
+
+
+def get_units_sloc_info(units):
+    """Decode the given line programs (see debugline.DebugLineReader.units)
+    and return their sloc info as an interval tree, like get_sloc_info.
+    """
+    sloc_info = intervalmap.IntervalTree()
+
+    def zero_to_none(value):
+        return value or None
 
     # Used to store only one string per filename (reducing memory consumption).
     strings = {}
@@ -58,26 +77,55 @@ def get_sloc_info(exe_filename):
             strings[string] = string
             return string
 
-    def int_or_none(value):
-        if value is None:
-            return None
-        else:
-            return int(value)
-
-    for line in outs.split(b'\n'):
-        m = SLOC_INFO_LINE.match(line)
-        if m:
-            pc_start = int(m.group('pc_start'), 16)
-            pc_stop = int(m.group('pc_stop'), 16) + 1
-            sloc = Sloc(
-                uniq_string(m.group('src_file')),
-                int_or_none(m.group('line')),
-                int_or_none(m.group('column')),
-                int_or_none(m.group('discriminator')),
+    for unit in units:
+        table = unit.decode()
+        filenames = [uniq_string(filename) for filename in unit.filenames]
+        for pc_start, pc_stop, file, line, column, discriminator in zip(
+            *table
+        ):
+            sloc_info[pc_start:pc_stop] = Sloc(
+                filenames[file], line,
+                zero_to_none(column), zero_to_none(discriminator),
             )
-            try:
-                sloc_info[pc_start:pc_stop] = [sloc]
-            except ValueError:
-                sloc_info[pc_start].append(sloc)
 
     return sloc_info
+
+
+def dump_sloc_info(sloc_info, fp):
+    """Write `sloc_info` to the `fp` cache file."""
+
+    def none_to_int(value):
+        return -1 if value is None else value
+
+    starts, stops, max_stops, slocs = sloc_info.columns()
+    strings = metacache.StringTable()
+    rows = [
+        (
+            strings.index(sloc.filename),
+            sloc.line,
+            none_to_int(sloc.column),
+            none_to_int(sloc.discriminator),
+        )
+        for sloc in slocs
+    ]
+    metacache.write_table(fp, [starts, stops, max_stops], SLOC_RECORD,
+                          rows, strings)
+
+
+def load_sloc_info(filename):
+    """Load sloc info from the `filename` cache file."""
+
+    def int_to_none(value):
+        return None if value == -1 else value
+
+    def decode(index, fields):
+        filename_index, line, column, discriminator = fields
+        return Sloc(strings[filename_index], line, int_to_none(column),
+                    int_to_none(discriminator))
+
+    (starts, stops, max_stops), slocs, strings = metacache.map_table(
+        filename, 3, SLOC_RECORD, decode
+    )
+    return intervalmap.IntervalTree.from_columns(
+        starts, stops, max_stops, slocs
+    )
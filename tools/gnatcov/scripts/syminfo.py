@@ -3,9 +3,11 @@
 
 import collections
 import re
+import struct
 import subprocess
 
 import intervalmap
+import metacache
 
 
 CODE_SYMBOL_LINE = re.compile(
@@ -14,6 +16,15 @@ CODE_SYMBOL_LINE = re.compile(
 )
 Symbol = collections.namedtuple('Symbol', 'pc size name')
 
+# Layout of symbols in the metadata cache: index of the name in the strings
+# table. The address range comes from interval bounds.
+SYMBOL_RECORD = struct.Struct('=I')
+
+# Name of symbol info files in the metadata cache. Bump the version whenever
+# the way symbols are extracted or stored changes, so that stale entries are
+# not reused.
+SYM_CACHE_NAME = 'syminfo-1'
+
 
 def format_symbol(symbol):
     return '{} ({:x}-{:x})'.format(
@@ -22,30 +33,26 @@ def format_symbol(symbol):
     )
 
 def debug_interval(intval):
-    seen_bounds = set()
-    for i, bound in enumerate(intval.bounds):
-        print '{:02} - {:x}'.format(i, bound),
-        try:
-            value = intval.values[bound]
-        except KeyError:
-            print ''
-        else:
-            print '-> {:x}'.format(intval.bounds[i + 1]), value
-        seen_bounds.add(bound)
-    print '---'
-    for unseen in set(intval.values.keys()) - seen_bounds:
-        print '-> {:x}'.format(unseen), intval.values[unseen]
-    print '---'
+    for i, ((low, high), value) in enumerate(intval.items()):
+        print('{:02} - {:x} -> {:x} {}'.format(i, low, high, value))
+    print('---')
 
 def get_sym_info(exe_filename):
-    """Parse symbol info in `exe_filename` and return it as an interval map,
-    and the symbols could not be inserted in the interval map because of
-    address overlapping.
+    """Parse symbol info in `exe_filename` and return it as an interval tree.
 
-    The result maps from program counter to a symbol.
+    The result maps from program counter to the list of symbols that contain
+    it (symbols can overlap). It is cached on disk (see the metacache module).
     """
-    sym_info = intervalmap.IntervalMap()
-    overlap_syms = []
+    return metacache.fetch(
+        exe_filename, SYM_CACHE_NAME,
+        lambda: compute_sym_info(exe_filename),
+        dump_sym_info, load_sym_info
+    )
+
+
+def compute_sym_info(exe_filename):
+    """Uncached version of get_sym_info."""
+    sym_info = intervalmap.IntervalTree()
 
     # Let nm parse ELF and the symbol table for us.
     proc = subprocess.Popen(
@@ -57,7 +64,7 @@ def get_sym_info(exe_filename):
     while True:
         n += 1
         # Read as many lines as possible from nm.
-        line = proc.stdout.readline().decode('ascii')
+        line = proc.stdout.readline()
         if not line:
             break
 
@@ -68,13 +75,36 @@ def get_sym_info(exe_filename):
 
         pc = int(m.group('pc'), 16)
         size = int(m.group('size'), 16)
-        symbol = Symbol(pc, size, m.group('name'))
-        try:
-            sym_info[pc:pc + size] = symbol
-        except ValueError:
-            overlap_syms.append(symbol)
+        symbol = Symbol(pc, size, m.group('name').decode('ascii'))
+        sym_info[pc:pc + size] = symbol
+
+    return sym_info
+
 
-    return sym_info, overlap_syms
+def dump_sym_info(sym_info, fp):
+    """Write `sym_info` to the `fp` cache file."""
+    starts, stops, max_stops, symbols = sym_info.columns()
+    strings = metacache.StringTable()
+    rows = [(strings.index(symbol.name.encode('ascii')), )
+            for symbol in symbols]
+    metacache.write_table(fp, [starts, stops, max_stops], SYMBOL_RECORD,
+                          rows, strings)
+
+
+def load_sym_info(filename):
+    """Load symbol info from the `filename` cache file."""
+
+    def decode(index, fields):
+        name_index, = fields
+        return Symbol(starts[index], stops[index] - starts[index],
+                      strings[name_index].decode('ascii'))
+
+    (starts, stops, max_stops), symbols, strings = metacache.map_table(
+        filename, 3, SYMBOL_RECORD, decode
+    )
+    return intervalmap.IntervalTree.from_columns(
+        starts, stops, max_stops, symbols
+    )
 
 
 if __name__ == '__main__':
@@ -83,17 +113,11 @@ if __name__ == '__main__':
     binary = sys.argv[1]
     address = int(sys.argv[2], 16)
 
-    sym_info, overlap_syms = get_sym_info(binary)
-    if overlap_syms:
-        sys.stderr.write('warning: some symbols overlap with others:\n')
-        for sym in overlap_syms:
-            sys.stderr.write('  - {}\n'.format(syminfo.format_symbol(sym)))
-    try:
-        symbol = sym_info[address]
-    except KeyError:
-        print 'Not found'
+    symbols = get_sym_info(binary).at(address)
+    if not symbols:
+        print('Not found')
         sys.exit(1)
-    else:
+    for symbol in symbols:
         print(
             '{:#08x} is inside {}:'
             ' {:#08x}-{:#08x}'
@@ -1,18 +1,23 @@
 # -*- coding: utf-8 -*-
 
 import collections
-import re
-import subprocess
-
-import intervalmap
-
-
-TRACE_LINE = re.compile(
-    b'^(?P<start>[0-9a-f]+)-(?P<end>[0-9a-f]+) .: [0-9a-f]{2}'
-    b' (?P<special>-|t)(?P<fault>-|t)'
-    b'(?P<fallthrough>-|t)(?P<branch>-|t)'
-    b' block$'
-)
+import functools
+import heapq
+import operator
+import os.path
+import sys
+import tempfile
+
+try:
+    from SUITE import tracelib
+except ImportError:
+    # The trace files reader lives in the testsuite: make it importable when
+    # running scripts right from the source tree.
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        '..', '..', '..', 'testsuite'
+    ))
+    from SUITE import tracelib
 
 
 LeaveFlags = collections.namedtuple(
@@ -27,90 +32,137 @@ def merge_flags(f1, f2):
     ))
 
 
-def get_trace_info(traces):
-    """Parse trace info from `traces`. Return an interval map whose covered
-    elements are executed instructions addresses.
-    """
-    # Let gnatcov parse the traces for us.
-    proc = subprocess.Popen(
-        ['gnatcov', 'dump-trace', traces], stdout=subprocess.PIPE
+# Only consider trace entries for basic blocks that were completely executed:
+# the ones that have the block bit and not the fault one.
+SELECTED_OPS_MASK = tracelib.TraceOp.Block | tracelib.TraceOp.Fault
+SELECTED_OPS = tracelib.TraceOp.Block
+
+# Suffix for the names of index files for selected trace entries, next to
+# trace files (see open_trace_index).
+INDEX_SUFFIX = '.blocks' + tracelib.TraceIndex.SUFFIX
+
+# Bits of the trace entry op that make leave flags, in the order they are
+# displayed by `gnatcov dump-trace`.
+LEAVE_FLAGS_BITS = 0x0f
+
+
+def leave_flags_from_op(op):
+    """Return the LeaveFlags for a trace entry with the `op` operation."""
+    return LeaveFlags(
+        bool(op & 0x08),
+        bool(op & 0x04),
+        True,
+        bool(op & tracelib.TraceOp.Br1),
+        bool(op & tracelib.TraceOp.Br0),
     )
 
-    outs, errs = proc.communicate()
-    if proc.returncode != 0:
-        raise RuntimeError('gnatcov dump-trace returned an error')
-
-    # Parse its output and collect information.
-
-    # Mapping: end PC -> LeaveFlags
-    leave_flags = {}
-    # Mapping: start PC -> end PC (for each trace)
-    ranges = {}
-
-    # First collect all traces ranges, unifying ranges that start at the same
-    # address.
-    for line in outs.split(b'\n'):
-        m = TRACE_LINE.match(line)
-        if m:
-            pc_start = int(m.group('start'), 16)
-            # For gnatcov, the end address is executed, but for our interval
-            # map, the end bound is not covered.
-            pc_end = int(m.group('end'), 16) + 1
-
-            flags = LeaveFlags(
-                m.group('special') == 't',
-                m.group('fault') == 't',
-                True,
-                m.group('fallthrough') == 't',
-                m.group('branch') == 't',
+
+def is_selected_op(op):
+    """Return whether a trace entry with the `op` operation is selected."""
+    return op & SELECTED_OPS_MASK == SELECTED_OPS
+
+
+def open_trace_index(filename):
+    """Return a TraceIndex for the selected trace entries of the `filename`
+    trace file.
+
+    The index file is kept next to the trace file, so that it is reused by
+    next runs. If it cannot be written there, use a temporary index file.
+    """
+    try:
+        return tracelib.TraceIndex.open(
+            filename, filename + INDEX_SUFFIX, select=is_selected_op
+        )
+    except (IOError, OSError):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            return tracelib.TraceIndex.open(
+                filename, os.path.join(tmp_dir, 'trace' + INDEX_SUFFIX),
+                select=is_selected_op
             )
 
-            # If pc_start is already in the range, just take the longest trace.
-            try:
-                old_end = ranges[pc_start]
-            except KeyError:
-                ranges[pc_start] = pc_end
-            else:
-                ranges[pc_start] = max(pc_end, old_end)
-
-            try:
-                old_flags = leave_flags[pc_end]
-            except KeyError:
-                leave_flags[pc_end] = flags
-            else:
-                leave_flags[pc_end] = merge_flags(old_flags, flags)
-
-    # Then flatten the mapping to an interval map, for fast access. These two
-    # steps are needed since IntervalMap objects do not handle overlapping
-    # intervals.
-    executed_insns = intervalmap.IntervalMap()
-    last_interval = None
-    for pc_start in sorted(ranges):
-        pc_end = ranges[pc_start]
-
-        # Depending on overlapping, extend previous interval or add a new
-        # interval to the result.
-        if last_interval:
-            if last_interval[1] < pc_start:
-                executed_insns[last_interval[0]:last_interval[1]] = True
-                last_interval = (pc_start, pc_end)
-            else:
-                last_interval = (
-                    last_interval[0],
-                    max(last_interval[1], pc_end)
-                )
-        else:
-            last_interval = (pc_start, pc_end)
-
-    if last_interval:
-        executed_insns[last_interval[0]:last_interval[1]] = True
-
-    return (executed_insns, leave_flags)
+
+class ExecutedInsns(object):
+    """Set of executed instructions addresses, queried from trace indexes.
+
+    Like for `gnatcov dump-trace`, only trace entries for basic blocks that
+    were completely executed are considered but, unlike it, their end address
+    is not covered.
+    """
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def __contains__(self, pc):
+        return any(pc in index for index in self.indexes)
+
+    def items(self):
+        """Yield `((pc_start, pc_end), True)` items for the ranges of
+        executed instructions, sorted and merged like in an IntervalMap.
+        """
+        blocks = heapq.merge(*(
+            zip(index.starts, index.stops, index.ops)
+            for index in self.indexes
+        ))
+        range_start = range_end = None
+        for pc_start, pc_end, _ in blocks:
+            if range_end is None:
+                range_start, range_end = pc_start, pc_end
+            elif range_end < pc_start:
+                yield ((range_start, range_end), True)
+                range_start, range_end = pc_start, pc_end
+            elif range_end < pc_end:
+                range_end = pc_end
+        if range_end is not None:
+            yield ((range_start, range_end), True)
+
+
+class LeaveFlagsMap(object):
+    """Mapping from the end address of executed basic blocks (excluded) to
+    the corresponding LeaveFlags, queried from trace indexes. The leave
+    flags of all blocks that have the same end address are merged.
+    """
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def __getitem__(self, pc_end):
+        ops = [
+            op
+            for index in self.indexes
+            for _, stop, op in index.blocks_in(pc_end - 1, pc_end)
+            if stop == pc_end
+        ]
+        if not ops:
+            raise KeyError(pc_end)
+        return leave_flags_from_op(functools.reduce(operator.or_, ops))
+
+    def __contains__(self, pc_end):
+        try:
+            self[pc_end]
+        except KeyError:
+            return False
+        return True
+
+
+def get_trace_info(traces):
+    """Decode trace info from `traces`, a trace file name or a list of trace
+    file names.
+
+    Return a set-like object whose elements are executed instructions
+    addresses (see ExecutedInsns), and a mapping from the end address of
+    executed basic blocks (excluded) to the corresponding LeaveFlags (see
+    LeaveFlagsMap). Both answer queries from the trace index files (see
+    TraceIndex), which are created if needed.
+    """
+    if isinstance(traces, str):
+        traces = [traces]
+
+    indexes = [open_trace_index(filename) for filename in traces]
+    return (ExecutedInsns(indexes), LeaveFlagsMap(indexes))
 
 
 if __name__ == '__main__':
-    import sys
-    executed_insns, leave_flags = get_trace_info(sys.argv[1])
+    executed_insns, leave_flags = get_trace_info(sys.argv[1:])
     for (pc_start, pc_end), _ in executed_insns.items():
         print('{:x}-{:x}: {}'.format(
             pc_start, pc_end - 1, leave_flags[pc_end]